@@ -26,6 +26,15 @@ const double VEL_MIN_KMH   = 4.0;
 uint32_t t_last_ui = 0;
 const uint32_t UI_PERIOD_MS = 1500;
 
+// Name of the device when the application tracks many of them (sent as "id" in the JSON lines). Empty: not sent.
+static const char* DEVICE_ID = "";
+
+// Binary frames: the application sends 'B' to receive them instead of the JSON lines, and 'J' to go back to JSON
+static const uint8_t TRAMA_SYNC    = 0xA5; // Never sent in a JSON line
+static const uint8_t TRAMA_VERSION = 1;
+static const size_t  TRAMA_SIZE    = 26;
+bool bt_binario = false;
+
 static inline bool hasFix()
 {
   if (!gps.location.isValid()) return false;
@@ -132,7 +141,7 @@ static void btEnviarLineaJSON()
   int sats = gps.satellites.isValid() ? gps.satellites.value() : -1; // Connected satellites
   double hdop = gps.hdop.isValid() ? gps.hdop.value() / 100.0 : -1.0; // hdop
   snprintf(buf, sizeof(buf),
-    "{\"ts\":%lu,\"estado\":\"%s\",\"lat\":%.6f,\"lon\":%.6f,\"alt\":%.1f,\"vel_kmh\":%.2f,\"sats\":%d,\"hdop\":%.2f}\n",
+    "{\"ts\":%lu,\"estado\":\"%s\",\"lat\":%.6f,\"lon\":%.6f,\"alt\":%.1f,\"vel_kmh\":%.2f,\"sats\":%d,\"hdop\":%.2f%s%s%s}\n",
     (unsigned long)(millis()/1000UL),
     estado,
     lat,
@@ -140,7 +149,10 @@ static void btEnviarLineaJSON()
     alt,
     vel,
     sats,
-    hdop
+    hdop,
+    DEVICE_ID[0] ? ",\"id\":\"" : "", // Just when it has a name
+    DEVICE_ID,
+    DEVICE_ID[0] ? "\"" : ""
   );
 
   if (SerialBT.hasClient()) {
@@ -152,6 +164,76 @@ static void btEnviarLineaJSON()
   }
 }
 
+// CRC-16/CCITT-FALSE (the same as binascii.crc_hqx with 0xFFFF in Python)
+static uint16_t crc16(const uint8_t* data, size_t len)
+{
+  uint16_t crc = 0xFFFF;
+  while (len--)
+  {
+    crc ^= (uint16_t)(*data++) << 8;
+    for (uint8_t i = 0; i < 8; i++)
+      crc = (crc & 0x8000) ? (crc << 1) ^ 0x1021 : crc << 1;
+  }
+  return crc;
+}
+
+static inline uint8_t* ponerEntero(uint8_t* p, uint32_t value, uint8_t bytes) // Little endian
+{
+  for (uint8_t i = 0; i < bytes; i++)
+    *p++ = (value >> (8 * i)) & 0xFF;
+  return p;
+}
+
+static inline int32_t limitar(double value, int32_t minimo, int32_t maximo)
+{
+  if (value < minimo) return minimo;
+  if (value > maximo) return maximo;
+  return (int32_t)lround(value);
+}
+
+// This sends the same information as btEnviarLineaJSON, in a binary frame of 26 bytes (instead of ~130):
+// sync, version, ts (s), estado (0 SEARCHING, 1 UNSURE, 2 FIXED), lat and lon (millionths of degree), alt (dm), vel (hundredths of km/h),
+// sats, hdop (hundredths) and the CRC16 of all the previous bytes. Decoded by device_messages.py.
+static void btEnviarTrama()
+{
+  if (!SerialBT.hasClient()) { // The binary frame can't be read in the serial monitor
+    btEnviarLineaJSON();
+    return;
+  }
+  const char* estado = clasificarEstado();
+  uint8_t codigo = estado[0] == 'F' ? 2 : (estado[0] == 'U' ? 1 : 0);
+  bool locOK = gps.location.isValid() && gps.location.age() < 10000;
+  double lat = locOK ? gps.location.lat() : 0.0;
+  double lon = locOK ? gps.location.lng() : 0.0;
+  int sats = gps.satellites.isValid() ? gps.satellites.value() : -1;
+  double hdop = gps.hdop.isValid() ? gps.hdop.value() / 100.0 : -1.0;
+
+  uint8_t trama[TRAMA_SIZE];
+  uint8_t* p = trama;
+  *p++ = TRAMA_SYNC;
+  *p++ = TRAMA_VERSION;
+  p = ponerEntero(p, millis() / 1000UL, 4);
+  *p++ = codigo;
+  p = ponerEntero(p, (uint32_t)limitar(lat * 1e6, -90000000, 90000000), 4);
+  p = ponerEntero(p, (uint32_t)limitar(lon * 1e6, -180000000, 180000000), 4);
+  p = ponerEntero(p, (uint32_t)limitar(gps.altitude.meters() * 10.0, INT32_MIN, INT32_MAX), 4);
+  p = ponerEntero(p, (uint32_t)limitar(gps.speed.kmph() * 100.0, 0, 65535), 2);
+  *p++ = (uint8_t)(int8_t)limitar(sats, -1, 127);
+  p = ponerEntero(p, (uint32_t)limitar(hdop * 100.0, -100, 32767), 2);
+  ponerEntero(p, crc16(trama, TRAMA_SIZE - 2), 2);
+  SerialBT.write(trama, TRAMA_SIZE);
+}
+
+// Reads the commands of the application ('B' binary frames, 'J' JSON lines)
+static void btLeerComandos()
+{
+  while (SerialBT.available())
+  {
+    int c = SerialBT.read();
+    if (c == 'B') bt_binario = true;
+    else if (c == 'J') bt_binario = false;
+  }
+}
 
 
 void setup()
@@ -182,6 +264,7 @@ void setup()
 void loop()
 {
   gpsUpdate();
+  btLeerComandos();
 
   if (millis() - t_last_ui >= UI_PERIOD_MS)
   {
@@ -196,6 +279,7 @@ void loop()
       lcdMostrarError();
     }
     consolaMostrarDatos();
-    btEnviarLineaJSON();
+    if (bt_binario) btEnviarTrama();
+    else btEnviarLineaJSON();
   }
 }
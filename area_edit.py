@@ -0,0 +1,81 @@
+"""This module defines the edit session of an area: the points of the area being created or edited, while the user adds and removes
+markers on the map. The points are kept as a ring of linked vertices, so a marker is removed without searching the whole list, and the
+list of points is only built when the map needs to redraw the area (once per frame) or when it's saved."""
+
+import itertools
+import math
+
+
+class EditSession:
+    def __init__(self, ring= ()): # ring: the points of the edited area, in order (nothing when a new area is being created).
+        self._points = {} # vertex id -> (lat, lon)
+        self._next = {} # vertex id -> id of the next vertex of the ring
+        self._prev = {}
+        self._ids = {} # (lat, lon) -> vertex id, the markers are found by their position
+        self._first = None
+        self._new_ids = itertools.count()
+        self.changed = False # Some point has been added or removed
+        last = None
+        for point in ring:
+            last = self._link(tuple(point), last)
+
+    def __len__(self):
+        return len(self._points)
+
+    def __contains__(self, point):
+        return tuple(point) in self._ids
+
+    def _link(self, point, after): # Puts a new vertex after another one (or as the only vertex). Returns its id.
+        vertex = next(self._new_ids)
+        self._points[vertex] = point
+        self._ids[point] = vertex
+        if after is None:
+            self._first = vertex
+            self._next[vertex] = self._prev[vertex] = vertex
+        else:
+            following = self._next[after]
+            self._next[after] = vertex
+            self._prev[vertex] = after
+            self._next[vertex] = following
+            self._prev[following] = vertex
+        return vertex
+
+    def add(self, point): # Adds a point splitting the edge where it makes the shortest detour. Returns False if the point was already there.
+        point = (float(point[0]), float(point[1]))
+        if point in self._ids:
+            return False
+        after = None
+        if self._points:
+            best = None
+            for vertex, a in self._points.items(): # Edge from a to the next vertex
+                b = self._points[self._next[vertex]]
+                detour = math.dist(a, point) + math.dist(point, b) - math.dist(a, b)
+                if best is None or detour < best:
+                    best, after = detour, vertex
+        self._link(point, after)
+        self.changed = True
+        return True
+
+    def remove(self, point): # Removes the vertex at this position. Returns False if there's no vertex there.
+        vertex = self._ids.pop(tuple(point), None)
+        if vertex is None:
+            return False
+        del self._points[vertex]
+        previous, following = self._prev.pop(vertex), self._next.pop(vertex)
+        if vertex == following: # It was the last one
+            self._first = None
+        else:
+            self._next[previous] = following
+            self._prev[following] = previous
+            if vertex == self._first:
+                self._first = following
+        self.changed = True
+        return True
+
+    def points(self): # The points in the order of the ring, [(lat, lon), ...]
+        ring = []
+        vertex = self._first
+        for _ in range(len(self._points)):
+            ring.append(self._points[vertex])
+            vertex = self._next[vertex]
+        return ring
@@ -0,0 +1,297 @@
+"""This module imports and exports the areas as GeoJSON (FeatureCollection) and KML files. The files are read little by little, one feature
+or placemark at a time, so files with thousands of areas don't need to fit in memory. It can also be executed directly:
+python area_formats.py import <file> | export <file>"""
+
+import json
+import os
+import sys
+import tempfile
+import xml.etree.ElementTree as ET
+from xml.sax.saxutils import escape
+from area_repository import checked_ring
+from debug_logger_2 import log
+
+CHUNK_SIZE = 1 << 16 # Characters read from the file every time
+_WHITESPACE = " \t\n\r"
+
+
+def _ring_points(ring): # GeoJSON/KML rings are (lon, lat) and closed (the last point repeats the first one). Areas are [(lat, lon), ...], open.
+    points = [(float(point[1]), float(point[0])) for point in ring]
+    if len(points) > 1 and points[0] == points[-1]:
+        points.pop()
+    return points
+
+
+def _checked_area(name, ring): # checked_ring of a ring of the file, None (with a warning) if its coordinates can't even be read
+    try:
+        points = _ring_points(ring)
+    except (TypeError, ValueError, IndexError) as e:
+        log(f"[WARNING] Invalid Area: The area {name} is not valid (wrong coordinates: {e}). It has been removed.")
+        return None
+    return checked_ring(name, points)
+
+
+# GeoJSON
+
+class _JsonStream: # Decodes JSON values one by one from a file, keeping just a small part of it in memory.
+    def __init__(self, file, chunk_size= CHUNK_SIZE):
+        self.file = file
+        self.chunk_size = chunk_size
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    def _fill(self, size= None):
+        if self.eof:
+            return False
+        chunk = self.file.read(size or self.chunk_size)
+        if not chunk:
+            self.eof = True
+            return False
+        self.buffer = self.buffer[self.pos:] + chunk # What has already been decoded is dropped
+        self.pos = 0
+        return True
+
+    def peek(self): # Next character that isn't a blank, without consuming it ("" at the end of the file)
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in _WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self._fill():
+                return ""
+
+    def expect(self, chars):
+        char = self.peek()
+        if char not in chars:
+            raise ValueError(f"Invalid GeoJSON: expected one of {chars!r}, found {char!r}")
+        self.pos += 1
+        return char
+
+    def value(self):
+        self.peek()
+        size = self.chunk_size
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError: # The value continues in the next chunks
+                # Every failure decodes the value again from its start, so each time it reads as much as it has already read: a big
+                # polygon is decoded a few times (log n), not once per chunk.
+                size = max(size, len(self.buffer) - self.pos)
+                if not self._fill(size):
+                    raise ValueError("Invalid GeoJSON: unexpected end of the file")
+                continue
+            if end < len(self.buffer) or not self._fill(): # A number at the end of the buffer could continue in the next chunk
+                self.pos = end
+                return value
+
+
+def iter_geojson_features(path, chunk_size= CHUNK_SIZE): # Yields the features of a FeatureCollection, one by one.
+    with open(path, "r", encoding="utf-8") as file:
+        stream = _JsonStream(file, chunk_size)
+        stream.expect("{")
+        kind = None
+        found = False # A "features" member, the "type" can also come after it
+        if stream.peek() == "}":
+            raise ValueError("Invalid GeoJSON: expected a FeatureCollection, found an empty object")
+        while True:
+            key = stream.value()
+            stream.expect(":")
+            if key == "type":
+                kind = stream.value()
+                if kind != "FeatureCollection":
+                    raise ValueError(f"Invalid GeoJSON: expected a FeatureCollection, found a {kind}")
+            elif key == "features":
+                found = True
+                stream.expect("[")
+                if stream.peek() == "]":
+                    stream.pos += 1
+                else:
+                    while True:
+                        yield stream.value()
+                        if stream.expect(",]") == "]":
+                            break
+            else:
+                stream.value() # Other members of the collection (name, crs...) are skipped
+            if stream.expect(",}") == "}":
+                if not found and kind is None:
+                    raise ValueError("Invalid GeoJSON: expected a FeatureCollection, found no features")
+                return
+
+
+def iter_geojson_areas(path, chunk_size= CHUNK_SIZE): # Yields (name, points) for every valid polygon. MultiPolygons give an area per polygon.
+    for n, feature in enumerate(iter_geojson_features(path, chunk_size)):
+        try: # A feature with a wrong structure is skipped, like an invalid area, instead of stopping the whole import
+            areas = list(_feature_areas(feature, n))
+        except (AttributeError, TypeError, KeyError, IndexError) as e:
+            log(f"[WARNING] Invalid Area: The feature {n + 1} of {path} is not valid ({e!r}). It has been removed.")
+            continue
+        yield from areas
+
+
+def _feature_areas(feature, n):
+    properties = feature.get("properties") or {}
+    name = str(properties.get("name") or feature.get("id") or f"Area {n + 1}")
+    geometry = feature.get("geometry") or {}
+    if geometry.get("type") == "Polygon":
+        polygons = [geometry["coordinates"]]
+    elif geometry.get("type") == "MultiPolygon":
+        polygons = geometry["coordinates"]
+    else:
+        return # Points, lines... aren't areas
+    for k, polygon in enumerate(polygons):
+        area_name = name if len(polygons) == 1 else f"{name} #{k + 1}"
+        ring = _checked_area(area_name, polygon[0] if polygon else []) # Just the outer ring, areas have no holes
+        if ring is not None:
+            yield area_name, ring
+
+
+def write_geojson_areas(path, areas): # Writes the areas ({name: points} or (name, points) pairs) as a FeatureCollection, one feature at a time.
+    items = areas.items() if hasattr(areas, "items") else areas
+    count = 0
+    with _AtomicTextFile(path) as file:
+        file.write('{"type": "FeatureCollection", "features": [\n')
+        for name, points in items:
+            ring = [[lon, lat] for lat, lon in points]
+            ring.append(ring[0])
+            feature = {"type": "Feature", "properties": {"name": name}, "geometry": {"type": "Polygon", "coordinates": [ring]}}
+            file.write((",\n" if count else "") + json.dumps(feature))
+            count += 1
+        file.write("\n]}\n")
+    return count
+
+
+# KML
+
+def _local(tag): # Tag name without the namespace
+    return tag.rsplit("}", 1)[-1]
+
+
+def iter_kml_areas(path): # Yields (name, points) for every polygon of every Placemark. Each placemark is removed from memory once read.
+    n = 0
+    parents = [] # Elements that are open while parsing, to remove each placemark from its parent
+    for event, element in ET.iterparse(path, events=("start", "end")):
+        if event == "start":
+            parents.append(element)
+            continue
+        parents.pop()
+        if _local(element.tag) != "Placemark":
+            continue
+        n += 1
+        name = None
+        rings = []
+        for child in element.iter():
+            tag = _local(child.tag)
+            if tag == "name" and name is None:
+                name = (child.text or "").strip()
+            elif tag == "outerBoundaryIs":
+                for coordinates in child.iter():
+                    if _local(coordinates.tag) == "coordinates":
+                        rings.append([tuple(value.split(",")[:2]) for value in (coordinates.text or "").split()])
+        name = name or f"Area {n}"
+        for k, ring in enumerate(rings):
+            area_name = name if len(rings) == 1 else f"{name} #{k + 1}"
+            ring = _checked_area(area_name, ring)
+            if ring is not None:
+                yield area_name, ring
+        if parents: # The placemarks already read are removed, so the memory doesn't grow
+            parents[-1].remove(element)
+
+
+def write_kml_areas(path, areas): # Writes the areas as a KML document with a Placemark per area.
+    items = areas.items() if hasattr(areas, "items") else areas
+    count = 0
+    with _AtomicTextFile(path) as file:
+        file.write('<?xml version="1.0" encoding="UTF-8"?>\n<kml xmlns="http://www.opengis.net/kml/2.2">\n<Document>\n')
+        for name, points in items:
+            ring = list(points) + [points[0]]
+            coordinates = " ".join(f"{lon},{lat}" for lat, lon in ring)
+            file.write(f"<Placemark><name>{escape(name)}</name><Polygon><outerBoundaryIs><LinearRing><coordinates>{coordinates}"
+                       f"</coordinates></LinearRing></outerBoundaryIs></Polygon></Placemark>\n")
+            count += 1
+        file.write("</Document>\n</kml>\n")
+    return count
+
+
+class _AtomicTextFile: # A text file written in a temporary file, that replaces the destination just when everything has been written.
+    def __init__(self, path):
+        self.path = path
+
+    def __enter__(self):
+        fd, self.temp_path = tempfile.mkstemp(prefix=os.path.basename(self.path) + ".", suffix=".tmp", dir=os.path.dirname(os.path.abspath(self.path)))
+        self.file = os.fdopen(fd, "w", encoding="utf-8")
+        return self.file
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.file.close()
+        if exc_type is None:
+            os.replace(self.temp_path, self.path)
+        else:
+            os.remove(self.temp_path)
+        return False
+
+
+# By the file extension
+
+def iter_areas_file(path): # (name, points) of every valid area of a .geojson/.json or .kml file
+    extension = os.path.splitext(path)[1].lower()
+    if extension in (".geojson", ".json"):
+        return iter_geojson_areas(path)
+    if extension == ".kml":
+        return iter_kml_areas(path)
+    raise ValueError(f"Unknown areas file format: {extension}")
+
+
+def write_areas_file(path, areas):
+    extension = os.path.splitext(path)[1].lower()
+    if extension in (".geojson", ".json"):
+        return write_geojson_areas(path, areas)
+    if extension == ".kml":
+        return write_kml_areas(path, areas)
+    raise ValueError(f"Unknown areas file format: {extension}")
+
+
+def import_areas(path, engine, repository= None, batch_size= 1000): # Adds the areas of a file to the engine, in batches (one event each).
+    # Repeated names get a number, e.g. "Name (2)". Returns the number of imported areas.
+    batch = {}
+    count = 0
+    for name, points in iter_areas_file(path):
+        unique, k = name, 1
+        while unique in engine.areas or unique in batch:
+            k += 1
+            unique = f"{name} ({k})"
+        batch[unique] = points
+        if len(batch) >= batch_size:
+            count += _import_batch(engine, repository, batch)
+            batch = {}
+    if batch:
+        count += _import_batch(engine, repository, batch)
+    return count
+
+
+def _import_batch(engine, repository, batch):
+    engine.update_areas(batch)
+    if repository is not None and repository.incremental: # The database writes every batch, so the points don't stay in memory
+        repository.flush()
+    return len(batch)
+
+
+if __name__ == "__main__": # Imports or exports the areas of the configured repository, without opening the application.
+    from area_repository import open_area_repository
+    from geofencing_engine import GeofenceEngine
+
+    if len(sys.argv) != 3 or sys.argv[1] not in ("import", "export"):
+        print("Usage: python area_formats.py import <file.geojson|file.kml> | export <file.geojson|file.kml>")
+        sys.exit(1)
+    action, path = sys.argv[1], sys.argv[2]
+    repository = open_area_repository()
+    engine = GeofenceEngine()
+    engine.set_areas(repository.load())
+    if action == "import":
+        repository.attach(engine)
+        count = import_areas(path, engine, repository)
+        repository.flush()
+    else:
+        count = write_areas_file(path, ((name, engine.areas[name]) for name in engine.areas))
+    print(f"{count} areas {'imported from' if action == 'import' else 'exported to'} {path}")
@@ -0,0 +1,89 @@
+"""This module keeps a spatial index (STRtree) of the bounding boxes of every stored area, so a position can be checked against all
+of them at once. Only the few areas whose bounding box contains the position get the exact test."""
+
+import math
+from shapely import STRtree
+from shapely.geometry import Point, box
+from is_inside_area_function_2 import AreaGeometryCache, METERS_PER_DEGREE_LAT
+
+
+class AreaIndex:
+    def __init__(self, geometry_cache= None):
+        self.geometry_cache = geometry_cache if geometry_cache is not None else AreaGeometryCache() # Shared with the logic class if given
+        self._indexed = {} # name -> (version, AreaGeometry) of every area inside the tree
+        self._names = [] # Tree position -> area name
+        self._geometries = [] # Tree position -> AreaGeometry
+        self._tree = None
+        self._dirty = False
+        self._external = None # Areas with their own bounding box index (the SQLite R*Tree), instead of the STRtree
+        self._synced = None # (areas, cache changes, number of areas) of the last sync, to skip it when nothing has changed
+
+    def __len__(self):
+        return len(self._indexed)
+
+    def sync(self, areas): # Brings the index up to date with the areas dictionary. Only the areas whose version changed are rebuilt.
+        if hasattr(areas, "candidates"): # They're indexed by the database, the geometries are built when they're candidates
+            self._external = areas
+            return False
+        self._external = None
+        synced = (areas, self.geometry_cache.changes, len(areas))
+        if self._synced is not None and self._synced[0] is areas and self._synced[1:] == synced[1:]:
+            return False
+        changed = False
+        for name in list(self._indexed):
+            if name not in areas:
+                del self._indexed[name]
+                changed = True
+
+        for name, coords in areas.items():
+            version = self.geometry_cache.version(name)
+            entry = self._indexed.get(name)
+            if entry is not None and entry[0] == version:
+                continue
+            self._indexed[name] = (version, self.geometry_cache.get(name, coords))
+            changed = True
+
+        self._synced = synced
+        if changed:
+            self._dirty = True # The tree is bulk loaded the next time it's queried
+        return changed
+
+    def _build_tree(self): # STRtree can't be edited, but the geometries are already built, so this is just the bulk load of the boxes.
+        self._names = list(self._indexed.keys())
+        self._geometries = [self._indexed[name][1] for name in self._names]
+        self._tree = STRtree([geometry.polygon for geometry in self._geometries]) if self._geometries else None
+        self._dirty = False
+
+    def candidates(self, lat, lon): # Names of the areas whose bounding box contains the position
+        if self._external is not None:
+            return self._external.candidates(lat, lon)
+        if self._dirty:
+            self._build_tree()
+        if self._tree is None:
+            return []
+        return [self._names[i] for i in self._tree.query(Point(lon, lat))] # Shapely uses (lon, lat)
+
+    def candidates_near(self, lat, lon, radius_m): # Names of the areas whose bounding box is nearer than radius_m meters to the position
+        dlat = radius_m / METERS_PER_DEGREE_LAT
+        dlon = radius_m / (METERS_PER_DEGREE_LAT * max(math.cos(math.radians(lat)), 1e-6))
+        if self._external is not None:
+            return self._external.candidates_in_box(lat - dlat, lat + dlat, lon - dlon, lon + dlon)
+        if self._dirty:
+            self._build_tree()
+        if self._tree is None:
+            return []
+        return [self._names[i] for i in self._tree.query(box(lon - dlon, lat - dlat, lon + dlon, lat + dlat))]
+
+    def areas_containing(self, lat, lon): # Returns the set with the name of every area that contains the position.
+        if self._external is not None:
+            areas = self._external
+            return {name for name in areas.candidates(lat, lon) if self.geometry_cache.get(name, areas[name]).contains(lat, lon)}
+        if self._dirty:
+            self._build_tree()
+        if self._tree is None:
+            return set()
+        inside = set()
+        for i in self._tree.query(Point(lon, lat)):
+            if self._geometries[i].contains(lat, lon):
+                inside.add(self._names[i])
+        return inside
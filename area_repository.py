@@ -0,0 +1,329 @@
+"""This module stores the areas in the areas file. It knows which areas have changed (dirty), and writes them a moment later, grouping the
+changes, and atomically (a temporary file that replaces the old one), so a crash never leaves the file half written. Optionally, the areas
+can be stored in a SQLite database instead, which is read lazily (areas.json is then just an import/export format)."""
+
+import json
+import os
+import sys
+import sqlite3
+import threading
+from array import array
+from collections.abc import MutableMapping
+from config_manager import load_config, atomic_write_json
+from debug_logger_2 import log
+from is_inside_area_function_2 import canonical_ring, ring_problem
+
+configuration= load_config()
+
+def checked_ring(name, points, sort_if_invalid= False): # The canonical ring of an area that is being loaded or imported, None (with a warning) if it's invalid.
+    # sort_if_invalid is for the files of the previous versions, where the points were saved unordered and sorted when drawn.
+    try:
+        ring = canonical_ring(points, sort_if_invalid)
+    except ValueError as e:
+        log(f"[WARNING] Invalid Area: The area {name} is not valid ({e}). It has been removed.")
+        return None
+    if sort_if_invalid and ring_problem(points) is not None:
+        log(f"[INFO] The points of the area {name} were not in order, they have been sorted around its center.")
+    return ring
+
+
+def parse_areas(data): # From the file format {name: [[lat, lon], ...]} to {name: [(lat, lon), ...]}, removing the invalid areas.
+    areas = {}
+    for name, coords in data.items():
+        ring = checked_ring(name, coords, sort_if_invalid= True)
+        if ring is not None:
+            areas[name] = ring
+    return areas
+
+
+class AreaRepository:
+    incremental = False # The whole file is written every time, so it's better to write once after many changes
+
+    def __init__(self, path= None, save_delay= None):
+        self.path = path if path is not None else configuration["AREAS_FILE"]
+        self.save_delay = save_delay if save_delay is not None else configuration.get_float("AREAS_SAVE_DELAY")
+        self._get_areas = lambda: {}
+        self._dirty = set() # Names of the areas added, edited or removed since the last write
+        self._lock = threading.Lock()
+        self._timer = None
+
+    def load(self): # Returns every valid area of the file. If it doesn't exist, it's created empty.
+        if not os.path.exists(self.path):
+            atomic_write_json(self.path, {}, indent=None)
+            return {}
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                return parse_areas(json.load(f))
+        except Exception as e:
+            log(f"[ERROR] While loading {self.path}: {e}")
+            return {}
+
+    def attach(self, engine): # From now on, every change of the engine areas is saved. Must be called after loading them.
+        self._get_areas = lambda: engine.areas
+        engine.subscribe("areas", self.mark_dirty)
+
+    @property
+    def dirty(self):
+        return bool(self._dirty)
+
+    def mark_dirty(self, names): # The areas have changed, they'll be written after save_delay seconds.
+        with self._lock:
+            self._dirty.update(names)
+        self.save()
+
+    def save(self): # Schedules the write, if there's something to write. Many changes in a short time are just one write.
+        with self._lock:
+            if not self._dirty or self._timer is not None:
+                return
+            if self.save_delay <= 0:
+                self._timer = None
+            else:
+                self._timer = threading.Timer(self.save_delay, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+                return
+        self.flush()
+
+    def flush(self): # Writes the areas now, if anything has changed since the last write.
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            if not self._dirty:
+                return
+            dirty, self._dirty = self._dirty, set()
+            areas = dict(self._get_areas()) # A copy, the areas can change while it's written
+        try:
+            data = {name: [list(coord) for coord in coords] for name, coords in areas.items()}
+            atomic_write_json(self.path, data, indent=None)
+        except Exception as e:
+            log(f"[ERROR] While saving information in {self.path}: {e}")
+            with self._lock:
+                self._dirty |= dirty # They'll be written the next time
+
+
+# SQLite backend (optional, AREAS_BACKEND = "sqlite"). Every area is a row with its points packed in a blob and its bounding box, which is
+# also in an R*Tree table. At startup just the names and boxes are read, the points of an area are read the first time they're needed.
+
+def _pack_points(points): # [(lat, lon), ...] -> bytes (little endian doubles)
+    values = array("d", (value for point in points for value in point))
+    if sys.byteorder == "big":
+        values.byteswap()
+    return values.tobytes()
+
+def _unpack_points(blob):
+    values = array("d")
+    values.frombytes(blob)
+    if sys.byteorder == "big":
+        values.byteswap()
+    return list(zip(values[0::2], values[1::2]))
+
+def _bounding_box(points): # (min_lat, max_lat, min_lon, max_lon)
+    lats = [point[0] for point in points]
+    lons = [point[1] for point in points]
+    return (min(lats), max(lats), min(lons), max(lons))
+
+
+class LazyAreas(MutableMapping): # Works like the areas dictionary, but the points are read from the database when they're needed.
+    def __init__(self, repository, boxes):
+        self._repository = repository
+        self._boxes = boxes # name -> bounding box, of every area
+        self._points = {} # name -> points, of the areas already read or changed
+        self._unsaved = set() # Areas changed or removed that aren't in the database yet
+        self.lock = threading.RLock() # The changes come from the UI thread, the writes from the timer of the repository
+
+    def __getitem__(self, name):
+        with self.lock:
+            points = self._points.get(name)
+            if points is None:
+                if name not in self._boxes:
+                    raise KeyError(name)
+                points = self._repository.fetch(name)
+                self._points[name] = points
+            return points
+
+    def __setitem__(self, name, points):
+        points = list(points)
+        with self.lock:
+            self._points[name] = points
+            self._boxes[name] = _bounding_box(points)
+            self._unsaved.add(name)
+
+    def __delitem__(self, name):
+        with self.lock:
+            del self._boxes[name]
+            self._points.pop(name, None)
+            self._unsaved.add(name)
+
+    def __contains__(self, name): # Without reading the points
+        return name in self._boxes
+
+    def __iter__(self):
+        return iter(list(self._boxes))
+
+    def __len__(self):
+        return len(self._boxes)
+
+    def clear(self):
+        with self.lock:
+            self._unsaved.update(self._boxes)
+            self._boxes.clear()
+            self._points.clear()
+
+    def bounding_box(self, name):
+        return self._boxes[name]
+
+    def candidates(self, lat, lon): # Names of the areas whose bounding box contains the position, using the R*Tree of the database.
+        return self.candidates_in_box(lat, lat, lon, lon)
+
+    def candidates_in_box(self, min_lat, max_lat, min_lon, max_lon): # Names of the areas whose bounding box overlaps the box.
+        with self.lock:
+            names = [name for name in self._repository.query_box(min_lat, max_lat, min_lon, max_lon) if name not in self._unsaved]
+            for name in list(self._unsaved): # Changes not written yet are checked here
+                box = self._boxes.get(name)
+                if box is not None and box[0] <= max_lat and box[1] >= min_lat and box[2] <= max_lon and box[3] >= min_lon:
+                    names.append(name)
+            return names
+
+    def snapshot(self, names): # {name: its points, or None if it has been removed}, the objects that are going to be written.
+        with self.lock:
+            return {name: self[name] if name in self._boxes else None for name in names}
+
+    def mark_saved(self, written): # written: the snapshot that has been saved. The points of those areas are released (they're read again
+        # if they're needed), unless they've changed meanwhile: then they're still unsaved, and the next write saves them.
+        with self.lock:
+            for name, points in written.items():
+                if self._points.get(name) is points and (points is not None or name not in self._boxes):
+                    self._unsaved.discard(name)
+                    self._points.pop(name, None)
+
+
+SCHEMA_VERSION = 1 # PRAGMA user_version of the database, the areas are stored with their canonical ring
+
+
+class SqliteAreaRepository(AreaRepository):
+    incremental = True # Just the changed areas are written
+
+    def __init__(self, path= None, save_delay= None, json_path= None):
+        super().__init__(path if path is not None else configuration["AREAS_DB"], save_delay)
+        self.json_path = json_path if json_path is not None else configuration["AREAS_FILE"] # Imported when the database is created
+        self._connection = None
+        self._db_lock = threading.RLock() # The connection is used by the UI thread and the writing timer
+
+    def _connect(self):
+        if self._connection is None:
+            self._connection = sqlite3.connect(self.path, check_same_thread=False)
+            self._connection.executescript("""
+                CREATE TABLE IF NOT EXISTS areas (
+                    id INTEGER PRIMARY KEY,
+                    name TEXT UNIQUE NOT NULL,
+                    min_lat REAL, max_lat REAL, min_lon REAL, max_lon REAL,
+                    points BLOB NOT NULL
+                );
+                CREATE VIRTUAL TABLE IF NOT EXISTS areas_rtree USING rtree(id, min_lat, max_lat, min_lon, max_lon);
+            """)
+        return self._connection
+
+    def load(self): # Just the names and bounding boxes are read. The points are read by LazyAreas when they're needed.
+        try:
+            with self._db_lock:
+                connection = self._connect()
+                version = connection.execute("PRAGMA user_version").fetchone()[0]
+            if version == 0: # Just the first time, the areas of the JSON file are imported
+                if self.json_path and os.path.exists(self.json_path):
+                    count = self.import_json(self.json_path)
+                    log(f"[INFO] {count} areas have been imported from {self.json_path} to {self.path}")
+                with self._db_lock:
+                    self._connect().execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+            with self._db_lock:
+                rows = self._connect().execute("SELECT name, min_lat, max_lat, min_lon, max_lon FROM areas ORDER BY id").fetchall()
+            return LazyAreas(self, {row[0]: tuple(row[1:]) for row in rows})
+        except Exception as e:
+            log(f"[ERROR] While loading {self.path}: {e}")
+            return {}
+
+    def fetch(self, name):
+        with self._db_lock:
+            row = self._connect().execute("SELECT points FROM areas WHERE name = ?", (name,)).fetchone()
+        if row is None:
+            raise KeyError(name)
+        return _unpack_points(row[0])
+
+    def query(self, lat, lon):
+        return self.query_box(lat, lat, lon, lon)
+
+    def query_box(self, min_lat, max_lat, min_lon, max_lon):
+        with self._db_lock:
+            rows = self._connect().execute(
+                "SELECT areas.name FROM areas_rtree JOIN areas ON areas.id = areas_rtree.id"
+                " WHERE areas_rtree.min_lat <= ? AND areas_rtree.max_lat >= ? AND areas_rtree.min_lon <= ? AND areas_rtree.max_lon >= ?",
+                (max_lat, min_lat, max_lon, min_lon)).fetchall()
+        return [row[0] for row in rows]
+
+    def _write(self, connection, name, points):
+        box = _bounding_box(points)
+        connection.execute(
+            "INSERT INTO areas (name, min_lat, max_lat, min_lon, max_lon, points) VALUES (?, ?, ?, ?, ?, ?)"
+            " ON CONFLICT(name) DO UPDATE SET min_lat = excluded.min_lat, max_lat = excluded.max_lat,"
+            " min_lon = excluded.min_lon, max_lon = excluded.max_lon, points = excluded.points",
+            (name, *box, _pack_points(points)))
+        area_id = connection.execute("SELECT id FROM areas WHERE name = ?", (name,)).fetchone()[0]
+        connection.execute("INSERT OR REPLACE INTO areas_rtree (id, min_lat, max_lat, min_lon, max_lon) VALUES (?, ?, ?, ?, ?)", (area_id, *box))
+
+    def _delete(self, connection, name):
+        row = connection.execute("SELECT id FROM areas WHERE name = ?", (name,)).fetchone()
+        if row is not None:
+            connection.execute("DELETE FROM areas_rtree WHERE id = ?", row)
+            connection.execute("DELETE FROM areas WHERE id = ?", row)
+
+    def flush(self): # Writes just the changed areas, in one transaction.
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            if not self._dirty:
+                return
+            dirty, self._dirty = self._dirty, set()
+        areas = self._get_areas()
+        try:
+            if isinstance(areas, LazyAreas): # The points that are written, taken while the UI thread can't change them
+                written = areas.snapshot(dirty)
+            else:
+                written = {name: areas.get(name) for name in dirty}
+            with self._db_lock:
+                connection = self._connect()
+                with connection: # Commits at the end, or rolls back if there's an error
+                    for name, points in written.items():
+                        if points is not None:
+                            self._write(connection, name, points)
+                        else:
+                            self._delete(connection, name)
+            if isinstance(areas, LazyAreas):
+                areas.mark_saved(written)
+        except Exception as e:
+            log(f"[ERROR] While saving information in {self.path}: {e}")
+            with self._lock:
+                self._dirty |= dirty
+
+    def import_json(self, path): # Adds (or replaces) the areas of a JSON file with the areas.json format. Returns how many.
+        with open(path, "r", encoding="utf-8") as f:
+            areas = parse_areas(json.load(f))
+        with self._db_lock:
+            connection = self._connect()
+            with connection:
+                for name, points in areas.items():
+                    self._write(connection, name, points)
+        return len(areas)
+
+    def export_json(self, path): # Writes every area to a JSON file with the areas.json format.
+        with self._db_lock:
+            rows = self._connect().execute("SELECT name, points FROM areas ORDER BY id").fetchall()
+        data = {name: [list(point) for point in _unpack_points(blob)] for name, blob in rows}
+        atomic_write_json(path, data, indent=None)
+        return len(data)
+
+
+def open_area_repository(): # The repository chosen in the configuration (AREAS_BACKEND: "json" or "sqlite").
+    if configuration.get_str("AREAS_BACKEND").lower() == "sqlite":
+        return SqliteAreaRepository()
+    return AreaRepository()
@@ -0,0 +1,200 @@
+"""This module measures the speed of the geofencing functions without the UI, the map or the Bluetooth device. It can be executed
+directly: python benchmark_geofencing.py [number of areas]"""
+
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import numpy as np
+from area_index import AreaIndex
+from geofencing_engine import GeofenceEngine
+from is_inside_area_function_2 import is_inside_area, is_inside_area_batch, canonical_ring
+from area_repository import AreaRepository, SqliteAreaRepository
+from device_messages import decode_fix, encode_frame, MessageBuffer
+from sharded_evaluator import ShardedEvaluator
+
+
+def random_areas(count, seed= 1, center= (41.0, 2.0), spread= 1.0): # Creates count small random areas (5 to 12 points) around the center.
+    rnd = random.Random(seed)
+    areas = {}
+    for n in range(count):
+        lat0 = center[0] + rnd.uniform(-spread, spread)
+        lon0 = center[1] + rnd.uniform(-spread, spread)
+        size = rnd.uniform(0.002, 0.02)
+        points = []
+        for _ in range(rnd.randint(5, 12)):
+            points.append((lat0 + rnd.uniform(-size, size), lon0 + rnd.uniform(-size, size)))
+        areas[f"Area {n}"] = canonical_ring(points, sort_if_invalid= True) # Random points aren't in order
+    return areas
+
+
+def random_positions(count, seed= 2, center= (41.0, 2.0), spread= 1.0):
+    rnd = random.Random(seed)
+    return [(center[0] + rnd.uniform(-spread, spread), center[1] + rnd.uniform(-spread, spread)) for _ in range(count)]
+
+
+def report(title, seconds, operations): # Prints a line with the total time, the time per operation and the operations per second.
+    per_op = seconds / operations if operations else 0.0
+    rate = operations / seconds if seconds else float("inf")
+    print(f"{title:<45} {seconds * 1000:10.1f} ms  {per_op * 1e6:10.2f} us/op  {rate:14,.0f} op/s")
+
+
+def bench_area_index(area_count, fixes= 20000):
+    areas = random_areas(area_count)
+    positions = random_positions(fixes)
+
+    index = AreaIndex()
+    start = time.perf_counter()
+    index.sync(areas)
+    index.candidates(0.0, 0.0) # Forces the bulk load of the tree
+    report(f"AreaIndex build ({area_count} areas)", time.perf_counter() - start, area_count)
+
+    start = time.perf_counter()
+    for lat, lon in positions:
+        index.areas_containing(lat, lon)
+    report(f"AreaIndex.areas_containing ({area_count} areas)", time.perf_counter() - start, fixes)
+
+    name = next(iter(areas))
+    areas[name] = list(reversed(areas[name]))
+    index.geometry_cache.invalidate(name)
+    start = time.perf_counter()
+    index.sync(areas)
+    index.candidates(0.0, 0.0)
+    report("AreaIndex incremental rebuild (1 area)", time.perf_counter() - start, 1)
+
+
+def bench_batch(fixes= 1000000, area_count= 10, loop_fixes= 20000): # A whole recorded track against some areas, compared with the scalar function.
+    areas = random_areas(area_count, spread= 0.05)
+    rnd = np.random.default_rng(3)
+    lats = 41.0 + rnd.uniform(-0.05, 0.05, fixes)
+    lons = 2.0 + rnd.uniform(-0.05, 0.05, fixes)
+
+    start = time.perf_counter()
+    is_inside_area_batch(lats, lons, areas)
+    report(f"is_inside_area_batch ({fixes} fixes x {area_count} areas)", time.perf_counter() - start, fixes * area_count)
+
+    first = next(iter(areas.values()))
+    start = time.perf_counter()
+    for lat, lon in zip(lats[:loop_fixes], lons[:loop_fixes]):
+        is_inside_area(lat, lon, first)
+    report(f"is_inside_area loop ({loop_fixes} fixes x 1 area)", time.perf_counter() - start, loop_fixes)
+
+
+def bench_safe_radius(area_count, fixes= 20000, speed_kmh= 5.0): # A slow device walking around, with and without the safe radius shortcut.
+    areas = random_areas(area_count)
+    big = [(40.9, 1.9), (40.9, 2.1), (40.95, 2.15), (41.1, 2.1), (41.05, 2.0), (41.1, 1.9)] # A big, non convex area
+    areas["Big area"] = big
+    rnd = random.Random(4)
+    lat, lon = 41.0, 2.05
+    track = []
+    for n in range(fixes): # One fix per second
+        lat += rnd.uniform(-1, 1) * speed_kmh / 3.6 / 111320
+        lon += rnd.uniform(-1, 1) * speed_kmh / 3.6 / 84000
+        track.append((lat, lon, float(n)))
+
+    results = []
+    for safe_radius_max in (0, 1000):
+        engine = GeofenceEngine(dict(areas), position_timeout= 1e9, safe_radius_max= safe_radius_max)
+        engine.update_position(*track[0][:2], timestamp= 0.0)
+        engine.start_monitoring("Big area")
+        start = time.perf_counter()
+        inside = []
+        for lat, lon, t in track:
+            engine.evaluate(lat, lon, t, speed_kmh)
+            inside.append(frozenset(engine.containing))
+        title = "evaluate, safe radius" if safe_radius_max else "evaluate, every fix exact"
+        report(f"{title} ({engine.exact_checks} exact)", time.perf_counter() - start, fixes)
+        results.append(inside)
+    if results[0] != results[1]:
+        print("[ERROR] The safe radius shortcut gave a different result!")
+
+
+def bench_decoder(lines= 200000): # Decoding the messages sent by the ESP32: the generic JSON parser, the fixed format decoder and the binary frames.
+    template = '{{"ts":{},"estado":"FIXED","lat":{:.6f},"lon":{:.6f},"alt":120.5,"vel_kmh":3.25,"sats":8,"hdop":0.95}}'
+    data = [template.format(n, 41.0 + n * 1e-6, 2.0 + n * 1e-6) for n in range(lines)]
+
+    start = time.perf_counter()
+    for line in data:
+        json.loads(line)
+    report(f"json.loads ({lines} lines)", time.perf_counter() - start, lines)
+
+    start = time.perf_counter()
+    for line in data:
+        decode_fix(line)
+    report(f"decode_fix ({lines} lines)", time.perf_counter() - start, lines)
+
+    text = "".join(line + "\n" for line in data).encode()
+    frames = b"".join(encode_frame(decode_fix(line)) for line in data)
+    for name, stream in (("JSON lines", text), ("binary frames", frames)): # Like read_port: bulk reads, split and decoded
+        buffer = MessageBuffer()
+        start = time.perf_counter()
+        for offset in range(0, len(stream), 4096):
+            for message in buffer.feed(stream[offset:offset + 4096]):
+                decode_fix(message)
+        report(f"Stream of {name} ({len(stream) / lines:.0f} bytes/fix)", time.perf_counter() - start, lines)
+
+
+def bench_area_store(area_count, fixes= 5000): # Startup (loading every area) with the JSON file and the SQLite database.
+    areas = random_areas(area_count)
+    positions = random_positions(fixes)
+    with tempfile.TemporaryDirectory() as directory:
+        json_path = os.path.join(directory, "areas.json")
+        with open(json_path, "w", encoding="utf-8") as f:
+            json.dump({name: [list(point) for point in points] for name, points in areas.items()}, f)
+        SqliteAreaRepository(os.path.join(directory, "areas.db"), json_path= json_path).load() # Creates the database
+
+        start = time.perf_counter()
+        AreaRepository(json_path).load()
+        report(f"Load areas.json ({area_count} areas)", time.perf_counter() - start, 1)
+
+        repository = SqliteAreaRepository(os.path.join(directory, "areas.db"), json_path= json_path)
+        start = time.perf_counter()
+        lazy = repository.load()
+        report(f"Load areas.db, lazy ({area_count} areas)", time.perf_counter() - start, 1)
+
+        index = AreaIndex()
+        index.sync(lazy)
+        start = time.perf_counter()
+        for lat, lon in positions:
+            index.areas_containing(lat, lon)
+        report(f"R*Tree areas_containing ({area_count} areas)", time.perf_counter() - start, fixes)
+
+
+def bench_sharded(area_count, fixes= 200000, devices= 1000): # Fleet checks in 1 to N processes (every core), with the in-process run as reference.
+    areas = random_areas(area_count)
+    batch = [(n % devices, lat, lon) for n, (lat, lon) in enumerate(random_positions(fixes))]
+    counts = [0]
+    while counts[-1] < (os.cpu_count() or 1):
+        counts.append(min(max(counts[-1] * 2, 1), os.cpu_count() or 1))
+    reference = None
+    single = None # Time with one worker, to show the scaling
+    for workers in counts:
+        for shard in (("devices", "areas") if workers > 1 else ("devices",)):
+            start = time.perf_counter()
+            with ShardedEvaluator(areas, workers= workers, shard= shard) as evaluator:
+                evaluator.start()
+                started = time.perf_counter() - start
+                start = time.perf_counter()
+                result = evaluator.containing_batch(batch)
+                seconds = time.perf_counter() - start
+            if workers == 1:
+                single = seconds
+            title = f"Sharded, {workers} workers by {shard}" if workers else "Sharded, in this process"
+            scaling = f", x{single / seconds:.2f}" if single and workers > 1 else ""
+            report(f"{title} (start {started * 1000:.0f} ms{scaling})", seconds, fixes)
+            if reference is None:
+                reference = result
+            elif result != reference:
+                print("[ERROR] The sharded evaluation gave a different result!")
+
+
+if __name__ == "__main__":
+    area_count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    bench_area_index(area_count)
+    bench_batch()
+    bench_safe_radius(area_count)
+    bench_decoder()
+    bench_area_store(area_count)
+    bench_sharded(area_count)
@@ -1,22 +1,55 @@
-"""This module manages the configuration file and its default version in case it is corrupted or deleted."""
+"""This module manages the configuration file and its default version in case it is corrupted or deleted. The file is read just once:
+every module shares the same ConfigService, which keeps the values in memory, writes the changes atomically (and a bit later, grouping
+them) and notifies the subscribers, so the values can be changed while the application is running."""
 
 import json
 import os
-from datetime import datetime
+import tempfile
+import threading
+import atexit
 
 CONFIG_FILE = "config.json"
 
+CONFIG_SAVE_DELAY = 1.0 # Seconds the changes wait before being written, so many changes are just one write
+
 default_config = {
     "COM_PORT": "COM6",
+    "BT_PORT_MATCH": "", # Text to find the port of the device by its name, description or VID:PID (e.g. "GPS-ESP32" or "10c4:ea60"). Empty: just COM_PORT
     "BAUDRATE": 115200,
     "AREAS_FILE": "areas.json",
+    "AREAS_BACKEND": "json", # Where the areas are stored: "json" (AREAS_FILE) or "sqlite" (AREAS_DB, for many areas)
+    "AREAS_DB": "areas.db",
+    "AREAS_SAVE_DELAY": 1.0, # Seconds the area changes wait before being written, so many changes are just one write
     "LOG_FILE": "debug.log",
+    "LOG_FLUSH_INTERVAL": 0.5, # Maximum time (s) a log message waits in memory before being written to the file
+    "LOG_BATCH_SIZE": 100, # The log file is also flushed when this number of messages is waiting
+    "LOG_MAX_BYTES": 5000000, # The log file is archived when it reaches this size (0 for no limit), and also every new day
+    "LOG_BACKUP_COUNT": 10, # Number of compressed archives of the log file (debug.log.<date>.gz) that are kept
+    "TERMINAL_MAX_LINES": 1000, # The built-in terminal just keeps the last lines, the whole log is in the file
+    "LOG_TAIL_FILE": "", # An external log file to show in the built-in terminal (optional). The application messages are shown anyway.
     "INFO_FILE": "instructions.txt,",
-    "LAST_DATE": datetime.now().strftime("%Y-%m-%d"),
     "BT_TIMEOUT": 5,
-    "BT_CONNECTING_CYCLES": 5,
+    "BT_CONNECTING_CYCLES": 5, # Failed connection attempts before the indicator turns red (it keeps trying, without logging every attempt)
+    "BT_RETRY_MIN": 0.2, # Seconds between the first connection attempts, doubled after every failure...
+    "BT_RETRY_MAX": 10.0, # ...up to this
+    "BT_FORMAT": "json", # Format asked to the ESP32: "json" lines or "binary" frames (smaller, with a CRC). Both are understood.
+    "BT_DEBUG_ECHO": False, # Prints every message received from the device (just for debugging, it slows down the reading)
     "POSITION_TIMEOUT": 5, # Time since the last position fix to remove the current position
+    "GEOFENCE_CONFIRM_FIXES": 2, # Consecutive fixes needed to confirm that the device entered or left an area
+    "GEOFENCE_MARGIN_M": 0, # Fixes nearer than this to the edge of an area don't count for a transition (meters, 0 = off)
+    "GEOFENCE_DWELL_TIME": 60, # Time inside an area to send a DWELL event (seconds, 0 = never)
+    "GEOFENCE_SAFE_RADIUS_MAX": 1000, # Farthest distance to an edge that is used to skip the exact checks of the next fixes (meters, 0 = off)
+    "UI_REFRESH_MS": 50, # How often the UI takes the received messages and redraws the position (ms)
+    "POSITION_RENDER_MS": 0, # Minimum time between two redraws of the position and the geofencing state (ms, 0 = no limit)
+    "FIX_QUEUE_SIZE": 10000, # Maximum messages waiting for the UI, the oldest are dropped when it's full
     "ZOOM_LEVEL": 15, 
+    "MAP_TILE_SERVER": "https://a.tile.openstreetmap.org/{z}/{x}/{y}.png",
+    "MAP_MAX_ZOOM": 19,
+    "MAP_TILE_DB": "offline_tiles.db", # Local cache of map tiles, filled with: python tile_cache.py prefetch
+    "MAP_OFFLINE_ONLY": False, # The map just uses the cached tiles, without Internet
+    "MAP_PREFETCH_ZOOM_MIN": 10, # Zoom levels downloaded around the stored areas
+    "MAP_PREFETCH_ZOOM_MAX": 17,
+    "MAP_PREFETCH_MAX_TILES": 20000, # Most tiles a prefetch downloads, more must be asked for with --max-tiles
     "MARKER_COLOR_OUTSIDE": "grey",
     "MARKER_COLOR_CIRCLE": "white",
     "MARKER_POSITION_COLOR_OUTSIDE": "red",
@@ -24,22 +57,207 @@ default_config = {
     "MARKER_POSITION_COLOR_TEXT": "darkred",
 }
 
-def load_config(): # Returns the actual configuration. In case it doesn't exsist, it creates it and returns the default values.
-    if not os.path.exists(CONFIG_FILE):
-        save_config(default_config)
-        return default_config
+
+def atomic_write_json(path, data, indent): # Writes a temporary file and renames it, so the file is never half written.
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, temp_path = tempfile.mkstemp(prefix=os.path.basename(path) + ".", suffix=".tmp", dir=directory)
     try:
-        with open(CONFIG_FILE, "r", encoding="utf-8") as f:
-            return json.load(f)
-    except Exception as e:
-        print(f"[ERROR] While loading the configuration : {e}")
-        return default_config
-
-def save_config(config): # Saves the configuration in the config file.
-    with open(CONFIG_FILE, "w", encoding="utf-8") as f:
-        json.dump(config, f, indent=4)
-
-def edit_config(key, value): # Edits a specific characteristic of the configuration.
-    config= load_config()
-    config[key]= value
-    save_config(config)
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(data, f, indent=indent)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+TRUE_WORDS = ("1", "true", "yes", "on")
+FALSE_WORDS = ("0", "false", "no", "off", "")
+
+
+def parse_bool(value): # A boolean of the file, that can also be written by hand: true, "yes", "off", 1... ValueError if it isn't one.
+    if isinstance(value, str):
+        word = value.strip().lower()
+        if word in TRUE_WORDS:
+            return True
+        if word in FALSE_WORDS:
+            return False
+        raise ValueError(f"{value!r} isn't a boolean")
+    if isinstance(value, (bool, int, float)):
+        return bool(value)
+    raise TypeError(f"{type(value).__name__} isn't a boolean")
+
+
+class ConfigService: # The configuration in memory. It works like a dictionary, and also has typed getters and change notifications.
+    def __init__(self, path= CONFIG_FILE, defaults= None, save_delay= CONFIG_SAVE_DELAY):
+        self.path = path
+        self.defaults = dict(defaults if defaults is not None else default_config)
+        self.save_delay = save_delay
+        self._values = {}
+        self._coerced = {} # key -> value as written in the file, for the values that had to be converted (they're saved as they were)
+        self._lock = threading.RLock()
+        self._timer = None
+        self._subscribers = [] # (key or None for every key, callback)
+        self.reload()
+
+    def reload(self): # Reads the file again (e.g. if it has been edited by hand) and notifies the values that have changed.
+        loaded = {}
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, "r", encoding="utf-8") as f:
+                    loaded = json.load(f)
+            except Exception as e:
+                print(f"[ERROR] While loading the configuration : {e}")
+        with self._lock:
+            old = self._values
+            self._values, self._coerced = self._merge(loaded)
+            changed = {key: value for key, value in self._values.items() if old.get(key, value) != value}
+            missing = not os.path.exists(self.path) or any(key not in loaded for key in self.defaults)
+        if missing: # The file is created, or completed with the new default values
+            self.save_now()
+        for key, value in changed.items():
+            self._notify(key, value)
+
+    def _merge(self, loaded): # The defaults with the loaded values on top. Values with a wrong type are converted, or replaced by the default.
+        # Returns (values, {key: loaded value} of the converted ones).
+        values = dict(self.defaults)
+        coerced = {}
+        for key, value in loaded.items():
+            default = self.defaults.get(key)
+            numeric = isinstance(default, (int, float)) and not isinstance(default, bool)
+            if default is None or type(value) is type(default) or (numeric and isinstance(value, (int, float)) and not isinstance(value, bool)):
+                values[key] = value # Numbers are kept as they are, e.g. 2.5 for a timeout with the default 5 (they're read with get_float)
+                continue
+            try:
+                if isinstance(default, bool):
+                    values[key] = parse_bool(value)
+                elif numeric and isinstance(value, str):
+                    values[key] = float(value) if any(char in value for char in ".eE") else int(value)
+                else:
+                    values[key] = type(default)(value)
+            except (TypeError, ValueError):
+                print(f"[ERROR] While loading the configuration : {key} should be a {type(default).__name__}, the default value is used")
+            coerced[key] = value
+        return values, coerced
+
+    # Dictionary behaviour, so it can be used as before: configuration["KEY"]
+
+    def __getitem__(self, key):
+        return self._values[key]
+
+    def __setitem__(self, key, value):
+        self.set(key, value)
+
+    def __contains__(self, key):
+        return key in self._values
+
+    def __iter__(self):
+        return iter(dict(self._values))
+
+    def __len__(self):
+        return len(self._values)
+
+    def get(self, key, default= None):
+        return self._values.get(key, default)
+
+    def as_dict(self):
+        with self._lock:
+            return dict(self._values)
+
+    # Typed getters
+
+    def get_int(self, key):
+        return int(self._values[key])
+
+    def get_float(self, key):
+        return float(self._values[key])
+
+    def get_str(self, key):
+        return str(self._values[key])
+
+    def get_bool(self, key):
+        try:
+            return parse_bool(self._values[key])
+        except (TypeError, ValueError):
+            return bool(self.defaults.get(key))
+
+    # Changes
+
+    def set(self, key, value, save= True): # Changes a value, notifies the subscribers and schedules the write of the file.
+        with self._lock:
+            if key in self._values and self._values[key] == value:
+                return
+            self._values[key] = value
+            self._coerced.pop(key, None)
+        self._notify(key, value)
+        if save:
+            self.schedule_save()
+
+    def update(self, values, save= True):
+        for key, value in values.items():
+            self.set(key, value, save= False)
+        if save:
+            self.schedule_save()
+
+    def subscribe(self, callback, key= None): # callback(key, value) is called when the key (or any key, if it's None) changes.
+        self._subscribers.append((key, callback))
+        return callback
+
+    def unsubscribe(self, callback):
+        self._subscribers = [(key, cb) for key, cb in self._subscribers if cb is not callback]
+
+    def _notify(self, key, value):
+        for subscribed_key, callback in list(self._subscribers):
+            if subscribed_key is None or subscribed_key == key:
+                try:
+                    callback(key, value)
+                except Exception as e:
+                    print(f"[ERROR] While notifying the configuration change of {key}: {e}")
+
+    def schedule_save(self): # Many changes in a short time are written together.
+        with self._lock:
+            if self._timer is not None:
+                return
+            self._timer = threading.Timer(self.save_delay, self.save_now)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def save_now(self):
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            data = dict(self._values)
+            data.update(self._coerced) # What the user wrote is kept, only the values changed by the program are written
+        try:
+            atomic_write_json(self.path, data, indent=4)
+        except Exception as e:
+            print(f"[ERROR] While saving the configuration : {e}")
+
+    def flush(self): # Writes the pending changes now, if there are any.
+        if self._timer is not None:
+            self.save_now()
+
+
+_config = None
+_config_lock = threading.Lock()
+
+def load_config(): # Returns the actual configuration. In case it doesn't exsist, it creates it with the default values. It's read just once.
+    global _config
+    if _config is None:
+        with _config_lock:
+            if _config is None:
+                _config = ConfigService()
+                atexit.register(_config.flush)
+    return _config
+
+def save_config(config): # Saves the configuration in the config file, atomically.
+    values = config.as_dict() if isinstance(config, ConfigService) else dict(config)
+    atomic_write_json(CONFIG_FILE, values, indent=4)
+    if _config is not None and config is not _config:
+        _config.update(values, save= False)
+
+def edit_config(key, value): # Edits a specific characteristic of the configuration. It's written in the file a moment later.
+    load_config().set(key, value)
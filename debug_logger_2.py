@@ -1,29 +1,74 @@
 """This module manages all the log messages as well as the logging file. Also, updates the built-in terminal with the log messages and
-defines how the Bluetooth and satellite connection state is set."""
+defines how the Bluetooth and satellite connection state is set. Every message is published to the subscribed sinks (the log file, the
+terminal...) in memory. The file is written by a background thread, so log() never waits for the disk."""
 
 from datetime import datetime
 import os
-from config_manager import load_config, edit_config
+from config_manager import load_config
 import time
 import threading
-import tkinter as tk
+import queue
+import atexit
+import gzip
+import shutil
+try: # The UI parts of this module need tkinter, but the logging itself works without it (e.g. in a server without display).
+    import tkinter as tk
+except ImportError:
+    tk = None
 
 
 configuration = load_config()
 LOG_FILE = configuration["LOG_FILE"]
+LOG_FLUSH_INTERVAL = configuration.get_float("LOG_FLUSH_INTERVAL")
+LOG_BATCH_SIZE = configuration.get_int("LOG_BATCH_SIZE")
+LOG_MAX_BYTES = configuration.get_int("LOG_MAX_BYTES")
+LOG_BACKUP_COUNT = configuration.get_int("LOG_BACKUP_COUNT")
+
+TERMINAL_COLORS = { # Color of the terminal lines by their type. The rest are white.
+    "[INFO]": "yellow",
+    "[BLUETOOTH]": "lightblue",
+    "[ERROR]": "red",
+    "[WARNING]": "lightgreen"
+}
 
 
 # All these are global variables that will be accessible in the principal thread, but editable outside in this module.
 _ui_log_callback = None
 _bluetooth_label = None
 _reconnect_button = None
+_bluetooth_state = None # The last state set by the Bluetooth thread, and the last one shown by the mainloop
+_shown_bluetooth_state = None
+_log_subscribers = [] # Every function that receives the log messages (the written text, with the time and the line break)
+_log_subscribers_lock = threading.Lock()
+
+
 
 
+def subscribe_log(callback): # The callback is called with every log message, from the thread that logs it. It must be fast.
+    with _log_subscribers_lock:
+        if callback not in _log_subscribers:
+            _log_subscribers.append(callback)
+    return callback
 
+def unsubscribe_log(callback):
+    with _log_subscribers_lock:
+        if callback in _log_subscribers:
+            _log_subscribers.remove(callback)
 
-def set_ui_log_callback(callback_func):
+def _publish(text):
+    for callback in tuple(_log_subscribers):
+        try:
+            callback(text)
+        except Exception as e: # It cannot be logged, it would publish again
+            print(f"[ERROR] While publishing a log message: {e}")
+
+def set_ui_log_callback(callback_func): # Kept for compatibility, it's just a subscriber that replaces the previous one.
     global _ui_log_callback
+    if _ui_log_callback is not None:
+        unsubscribe_log(_ui_log_callback)
     _ui_log_callback = callback_func
+    if callback_func is not None:
+        subscribe_log(callback_func)
 
 def set_bluetooth_label(label):
     global _bluetooth_label
@@ -35,39 +80,230 @@ def set_reconnect_button(button):
 
 
 
+class LogWriter: # Keeps the log file open in a background thread and writes the messages in batches. It also rotates the file.
+    _FLUSH = object() # Special items of the queue
+    _STOP = object()
+    ROTATE_RETRY = 60.0 # Seconds until a rotation that failed is tried again
+
+    def __init__(self, path, flush_interval= LOG_FLUSH_INTERVAL, batch_size= LOG_BATCH_SIZE, max_bytes= LOG_MAX_BYTES, backup_count= LOG_BACKUP_COUNT):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.max_bytes = max_bytes # 0 means no size limit
+        self.backup_count = backup_count # Number of compressed archives that are kept
+        self._file = None
+        self._file_date = None # Day the active file belongs to
+        self._size = 0
+        self._next_rotation = 0.0 # time.monotonic() before which no rotation is tried
+        self._queue = queue.SimpleQueue()
+        self._thread = threading.Thread(target=self._run, daemon=True, name="LogWriter")
+        self._thread.start()
+
+    def write(self, text, urgent= None): # Non-blocking. Urgent messages (errors by default) are flushed as soon as they are written.
+        if urgent is None:
+            urgent = "[ERROR]" in text
+        self._queue.put((text, urgent))
+
+    def flush(self, timeout= 5): # Blocks until everything written before is in the file.
+        done = threading.Event()
+        self._queue.put((self._FLUSH, done))
+        done.wait(timeout)
+
+    def close(self, timeout= 5):
+        if self._thread.is_alive():
+            self._queue.put((self._STOP, None))
+            self._thread.join(timeout)
+
+    def _open(self):
+        self._file = open(self.path, "a", encoding="utf-8")
+        self._size = self._file.tell()
+        if self._size:
+            self._file_date = datetime.fromtimestamp(os.path.getmtime(self.path)).strftime("%Y-%m-%d")
+        else:
+            self._file_date = datetime.now().strftime("%Y-%m-%d")
+
+    def _rotate(self, today, header): # The active file is archived (compressed) and a new one is started, with a header.
+        self._file.close()
+        self._file = None
+        try:
+            base = f"{self.path}.{self._file_date}"
+            archive, n = base, 0
+            while os.path.exists(archive) or os.path.exists(archive + ".gz") or self._archive_numbers(base, n): # Rotated by size, more than one archive that day
+                n += 1
+                archive = f"{base}.{n}"
+            os.replace(self.path, archive)
+        except OSError as e: # E.g. on Windows, while another program has the file open. The messages go on in the active file until it can be rotated.
+            print(f"[ERROR] While rotating the log file, it will be tried again in {self.ROTATE_RETRY:g} s: {e}")
+            self._open()
+            self._next_rotation = time.monotonic() + self.ROTATE_RETRY
+            return
+        self._open()
+        self._file_date = today
+        if header:
+            self._write(header)
+        try:
+            with open(archive, "rb") as source, gzip.open(archive + ".gz", "wb") as target:
+                shutil.copyfileobj(source, target)
+            os.remove(archive)
+        except Exception as e:
+            print(f"[ERROR] While compressing the log file {archive}: {e}")
+        self._remove_old_archives()
+
+    def _archive_numbers(self, base, n): # True if there's an archive of that day with a number greater than n (the older ones may be removed)
+        directory = os.path.dirname(os.path.abspath(base))
+        prefix = os.path.basename(base) + "."
+        for name in os.listdir(directory):
+            number = name[len(prefix):-3] if name.startswith(prefix) and name.endswith(".gz") else ""
+            if number.isdigit() and int(number) > n:
+                return True
+        return False
+
+    def _remove_old_archives(self):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        prefix = os.path.basename(self.path) + "."
+        archives = [os.path.join(directory, name) for name in os.listdir(directory) if name.startswith(prefix) and name.endswith(".gz")]
+        archives.sort(key=os.path.getmtime, reverse=True)
+        for archive in archives[self.backup_count:]:
+            os.remove(archive)
+
+    def _write(self, text):
+        self._file.write(text)
+        self._size += len(text.encode("utf-8"))
+
+    def _run(self):
+        pending = 0 # Messages written but not flushed yet
+        last_flush = time.monotonic()
+        while True:
+            try:
+                item, extra = self._queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                item, extra = None, None
+            try:
+                if self._file is None:
+                    self._open()
+                if isinstance(item, str):
+                    today = datetime.now().strftime("%Y-%m-%d")
+                    if time.monotonic() < self._next_rotation: # The last rotation failed, not yet
+                        pass
+                    elif self._size and today != self._file_date: # A new day, the messages start in a new file
+                        self._rotate(today, None)
+                    elif self.max_bytes and self._size + len(item) > self.max_bytes:
+                        self._rotate(today, f"===== LOG {today} (continued) =====\n\n")
+                    self._write(item)
+                    pending += 1
+                if pending and (extra is True or item is self._FLUSH or item is self._STOP or pending >= self.batch_size
+                                or time.monotonic() - last_flush >= self.flush_interval):
+                    self._file.flush()
+                    pending = 0
+                    last_flush = time.monotonic()
+            except Exception as e: # The error cannot be logged, as it would be written here again
+                print(f"[ERROR] While writing the log file: {e}")
+                if self._file is not None:
+                    try:
+                        self._file.close()
+                    except Exception:
+                        pass
+                    self._file = None
+            if item is self._FLUSH:
+                extra.set()
+            elif item is self._STOP:
+                if self._file is not None:
+                    self._file.close()
+                return
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+def _get_writer():
+    global _writer
+    if _writer is None:
+        with _writer_lock:
+            if _writer is None:
+                _writer = LogWriter(LOG_FILE)
+    return _writer
+
+def _file_sink(text): # The log file is just another subscriber. The writer thread is started with the first message.
+    _get_writer().write(text)
+
+subscribe_log(_file_sink)
+
+def flush_log(): # Waits until every message has been written in the log file, e.g. before opening it.
+    if _writer is not None:
+        _writer.flush()
+
+def shutdown_logging(): # Writes everything pending and closes the file. It's also called automatically when the program ends.
+    global _writer
+    if _writer is not None:
+        _writer.close()
+        _writer = None
+
+atexit.register(shutdown_logging)
+
+
+
 def check_log_file(): # Just creates a log file in case it isn't present. All the "extra" documents should be created whenever they miss.
+    global _last_date
     date = datetime.now().strftime("%Y-%m-%d")
     if not os.path.exists(LOG_FILE):
         with open(LOG_FILE, "w", encoding="utf-8") as file:
             file.write("===== STARTING OF THE LOG FILE =====\n\n")
             header = f"===== LOG {date} ====="
             file.write(f"____________________________________________\n\n\n{header}\n\n")
-            edit_config("LAST_DATE", date)
             file.flush()
-            
+        _last_date = date
+
+
+def _log_file_date(): # The day of the last message in the log file, by its modification time.
+    try:
+        return datetime.fromtimestamp(os.path.getmtime(LOG_FILE)).strftime("%Y-%m-%d")
+    except OSError:
+        return None
+
+_last_date = _log_file_date() # When it changes, a header with the new date is written (and the writer starts a new file)
+
 
 def log(message): # Writes a string with the message, including the exact time it was emmited. Also updates the date of the log file if it's necessary.
-    date = datetime.now().strftime("%Y-%m-%d")
-    time = datetime.now().strftime("%H:%M:%S")
-    with open(LOG_FILE, "a", encoding="utf-8") as file:
-        if configuration.get("LAST_DATE") != date: # If the last saved date isn't the same as today, updates it and writes it in the log file.
-            configuration["LAST_DATE"]= date # This function relies on the config file, so if it is deleted, the date will be writen again.
-            edit_config("LAST_DATE", date)
-            header = f"===== LOG {date} ====="
-            file.write(f"____________________________________________\n\n\n{header}\n\n")
-            file.flush()
-        final_message= f"[{time}] --> {message}\n" # Writes the message
-        file.write(final_message)
-        file.flush()
-    
-    if _ui_log_callback is not None:
-        _ui_log_callback(final_message)
+    # The message is just published to the subscribers, e.g. the LogWriter thread writes it in the file.
+    now = datetime.now()
+    global _last_date
+    date = now.strftime("%Y-%m-%d")
+    if _last_date != date: # If the last date isn't the same as today, updates it and writes it in the log file.
+        _last_date = date
+        header = f"===== LOG {date} ====="
+        _publish(f"____________________________________________\n\n\n{header}\n\n")
+    final_message= f"[{now.strftime('%H:%M:%S')}] --> {message}\n" # Writes the message
+    _publish(final_message)
+
+
+# Built-in terminal. It receives the messages in memory, as a subscriber, instead of reading them back from the file.
+
+def attach_terminal(root, text_widget): # The messages can come from any thread, so they're kept here and the mainloop takes them on a timer
+    # (like drain_fixes does with the fixes). Must be called from the mainloop thread.
+    setup_terminal(text_widget)
+    pending = []
+    lock = threading.Lock()
+
+    def update():
+        with lock:
+            text = "".join(pending)
+            pending.clear()
+        if text:
+            _update_terminal(text, text_widget)
+        root.after(configuration.get_int("UI_REFRESH_MS"), update)
+
+    def sink(text): # No Tk calls here, it runs in whichever thread logs
+        with lock:
+            pending.append(text)
 
+    update()
+    return subscribe_log(sink)
 
-# Log tailer, for the build in terminal. The terminal works printing wathever change is made in the log file.
 
-def start_log_tailer(root, text_widget):
-    log_file = configuration["LOG_FILE"]
+# Log tailer, optional. It shows in the terminal an external file, printing wathever change is made in it.
+
+def start_log_tailer(root, text_widget, log_file):
+    setup_terminal(text_widget)
 
     if not os.path.exists(log_file):
         open(log_file, 'w').close() # We create the file if it doesn't exists.
@@ -97,33 +333,53 @@ def start_log_tailer(root, text_widget):
     # By using a thread, we're defining a secondary thread named LogTailer that will run this. If we just executed the function,
     # the while True loop will freeze the GUI, as the code would wait to the function to finish, but it would never happen.
 
-def _update_terminal(text, text_widget):
-    type_logs = {
-        "[INFO]": "yellow",
-        "[BLUETOOTH]": "lightblue",
-        "[ERROR]": "red",
-        "[WARNING]": "lightgreen"
-    }
+def setup_terminal(text_widget): # Creates the color tags just once, instead of checking them for every line.
+    for color in set(TERMINAL_COLORS.values()) | {"white"}:
+        text_widget.tag_config(color, foreground=color)
 
-    text_widget.config(state=tk.NORMAL)
+def _update_terminal(text, text_widget, max_lines= None):
+    max_lines = max_lines if max_lines is not None else configuration.get_int("TERMINAL_MAX_LINES") # It can be changed while running
+    at_bottom = text_widget.yview()[1] >= 0.999 # If the user has scrolled up to read something, we don't move the view
 
+    chunks = [] # (text, color) pairs, consecutive lines with the same color go together
     for line in text.splitlines(True):  # Don't delete the '\n'
         color = "white" # If the code don't find the correct color, instead of breaking, defines the default as white.
-        for type_log, c in type_logs.items():
+        for type_log, c in TERMINAL_COLORS.items():
             if type_log in line:
                 color = c
-                break 
-
-        if color not in text_widget.tag_names(): # In case the color variable isn't defined in the terminal
-            text_widget.tag_config(color, foreground=color)
+                break
+        if chunks and chunks[-1][1] == color:
+            chunks[-1][0].append(line)
+        else:
+            chunks.append(([line], color))
+    if not chunks:
+        return
+
+    args = []
+    for lines, color in chunks:
+        args.extend(("".join(lines), color))
 
-        text_widget.insert(tk.END, line, color) # We print the line at the end of the terminal with its respective color.
-
-    text_widget.see(tk.END) # It scrolls to the end at the moment
+    text_widget.config(state=tk.NORMAL)
+    text_widget.insert(tk.END, *args) # The whole batch is printed at the end of the terminal with one operation
+    line_count = int(text_widget.index("end-1c").split(".")[0])
+    if line_count > max_lines: # Works like a ring buffer, the oldest lines are removed so it never grows
+        text_widget.delete("1.0", f"{line_count - max_lines + 1}.0")
+    if at_bottom:
+        text_widget.see(tk.END)
     text_widget.config(state=tk.DISABLED)
 
 
-def actualize_bluetooth_state(state): # This actualizes a label that, by its background color, indicates the Bluetooth and satellite connection state.
+def actualize_bluetooth_state(state): # Sets the Bluetooth and satellite connection state. It's called from the Bluetooth thread, so the
+    # widgets aren't touched here: the state is just kept, and the mainloop shows it with apply_bluetooth_state().
+    global _bluetooth_state
+    _bluetooth_state = state
+
+def apply_bluetooth_state(): # Called by the mainloop (drain_fixes). Actualizes a label that, by its background color, indicates the last state.
+    global _shown_bluetooth_state
+    state = _bluetooth_state
+    if state is None or state == _shown_bluetooth_state: # Nothing new
+        return
+    _shown_bluetooth_state = state
     states_colors = {
         "FIXED": "darkgreen",
         "UNSURE": "lightgreen",
@@ -133,15 +389,12 @@ def actualize_bluetooth_state(state): # This actualizes a label that, by its bac
     }
     color = states_colors.get(state, "grey") # Once given a state, it sets its color by the dictionary defined previously. If it doesn't find it, just sets gray as the color.
     if _bluetooth_label is not None:
-        _bluetooth_label.after(0, lambda: _bluetooth_label.config(bg=color)) # We update the Bluetooth state indicator
+        _bluetooth_label.config(bg=color) # We update the Bluetooth state indicator
     else:
         log(f"[ERROR] No Bluetooth label set, state: {state}")
 
-    if _reconnect_button is not None:
-        def update_button(): # If the Bluetooth searching function isn't running and there's no connection, the reconnect button is enabled.
-            if state == "DISCONNECTED":
-                _reconnect_button.config(state=tk.NORMAL)
-            else:
-                _reconnect_button.config(state=tk.DISABLED)
-        _reconnect_button.after(0, update_button)
-
+    if _reconnect_button is not None: # If the Bluetooth searching function isn't running and there's no connection, the reconnect button is enabled.
+        if state == "DISCONNECTED":
+            _reconnect_button.config(state=tk.NORMAL)
+        else:
+            _reconnect_button.config(state=tk.DISABLED)
@@ -0,0 +1,195 @@
+"""This module decodes the messages of the positioning device. The ESP32 sends one JSON line per fix, always with the same fields and in the
+same order (see btEnviarLineaJSON in ESP32_main.ino), so they're decoded with one regular expression instead of the generic JSON parser,
+into a Fix with slots. Lines with another format still go through json.loads. The ESP32 can also send binary frames (btEnviarTrama), of
+FRAME_SIZE bytes with a CRC, and both formats are told apart by the first byte, so they can be mixed in the same stream.
+It can be executed directly, to decode a captured serial dump: python device_messages.py <file>"""
+
+import binascii
+import json
+import re
+import struct
+import sys
+import time
+
+STATES = ("SEARCHING", "UNSURE", "FIXED") # The satellite states the ESP32 can send
+CHUNK_SIZE = 1 << 16 # Bytes read at once from a dump file
+MAX_LINE = 4096 # A longer line without a newline is garbage, it's dropped
+
+# Binary frame: sync byte, version, ts (s), estado (index in STATES), lat and lon (millionths of degree), alt (dm), vel_kmh (hundredths),
+# sats, hdop (hundredths) and the CRC-16/CCITT-FALSE of all the bytes before it. Little endian, 26 bytes instead of ~130 of the JSON line.
+FRAME_SYNC = 0xA5 # Never sent in a JSON line (they're ASCII), so a frame can't be confused with text
+FRAME_VERSION = 1
+_FRAME = struct.Struct("<BBIBiiiHbhH")
+FRAME_SIZE = _FRAME.size
+BINARY_COMMAND = b"B" # Sent to the ESP32 to ask for binary frames, JSON_COMMAND to go back to the JSON lines
+JSON_COMMAND = b"J"
+
+_FIX_LINE = re.compile( # The values are checked by int() and float(), simple groups make the match much faster
+    r'\{"ts":([^,]*),"estado":"([^"]*)","lat":([^,]*),"lon":([^,]*),"alt":([^,]*),"vel_kmh":([^,]*),"sats":([^,]*),"hdop":([^,}]*)'
+    r'(?:,"id":"([^"]*)")?\}') # The id is only sent by the devices of a fleet
+
+
+class Fix: # A message of the device. ts: seconds since the ESP32 started. sats and hdop are -1 when the GPS doesn't know them.
+    # device: the "id" of the device, None if it doesn't send it (just one device, or a binary frame).
+    __slots__ = ("ts", "estado", "lat", "lon", "alt", "vel_kmh", "sats", "hdop", "device")
+
+    def __init__(self, ts, estado, lat, lon, alt= 0.0, vel_kmh= 0.0, sats= -1, hdop= -1.0, device= None):
+        self.ts = ts
+        self.estado = estado
+        self.lat = lat
+        self.lon = lon
+        self.alt = alt
+        self.vel_kmh = vel_kmh
+        self.sats = sats
+        self.hdop = hdop
+        self.device = device
+
+    def get(self, key, default= None): # Like a dictionary, so the code that received the decoded JSON still works
+        return getattr(self, key, default) if key in self.__slots__ else default
+
+    def __getitem__(self, key):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def as_dict(self):
+        return {key: getattr(self, key) for key in self.__slots__}
+
+    def __repr__(self):
+        return f"Fix({', '.join(f'{key}={getattr(self, key)!r}' for key in self.__slots__)})"
+
+
+def _checked(fix): # Raises ValueError if a field has an impossible value.
+    if fix.estado not in STATES:
+        raise ValueError(f"unknown state {fix.estado!r}")
+    if not (-90.0 <= fix.lat <= 90.0 and -180.0 <= fix.lon <= 180.0):
+        raise ValueError(f"invalid position {fix.lat}, {fix.lon}")
+    if fix.vel_kmh < 0:
+        raise ValueError(f"invalid speed {fix.vel_kmh}")
+    return fix
+
+
+def encode_line(fix): # The JSON line of a Fix, exactly as btEnviarLineaJSON writes it (with the newline).
+    device = f',"id":"{fix.device}"' if fix.device is not None else ""
+    return (f'{{"ts":{fix.ts},"estado":"{fix.estado}","lat":{fix.lat:.6f},"lon":{fix.lon:.6f},"alt":{fix.alt:.1f},'
+            f'"vel_kmh":{fix.vel_kmh:.2f},"sats":{fix.sats},"hdop":{fix.hdop:.2f}{device}}}\n')
+
+
+def frame_crc(frame): # CRC of a frame (all the bytes but the last two, where it's stored)
+    return binascii.crc_hqx(frame[:FRAME_SIZE - 2], 0xFFFF)
+
+
+def encode_frame(fix): # The binary frame of a Fix, the same the ESP32 sends.
+    fields = (FRAME_SYNC, FRAME_VERSION, fix.ts, STATES.index(fix.estado), round(fix.lat * 1e6), round(fix.lon * 1e6), round(fix.alt * 10),
+              min(round(fix.vel_kmh * 100), 0xFFFF), max(-1, min(fix.sats, 127)), max(-100, min(round(fix.hdop * 100), 0x7FFF)), 0)
+    frame = bytearray(_FRAME.pack(*fields))
+    struct.pack_into("<H", frame, FRAME_SIZE - 2, frame_crc(frame))
+    return bytes(frame)
+
+
+def decode_frame(frame): # Decodes a binary frame. Raises ValueError if it isn't a valid one.
+    if len(frame) != FRAME_SIZE or frame[0] != FRAME_SYNC:
+        raise ValueError("not a frame")
+    _, version, ts, state, lat, lon, alt, vel, sats, hdop, crc = _FRAME.unpack(frame)
+    if crc != frame_crc(frame):
+        raise ValueError("wrong CRC")
+    if version != FRAME_VERSION:
+        raise ValueError(f"unknown frame version {version}")
+    if state >= len(STATES):
+        raise ValueError(f"unknown state {state}")
+    return _checked(Fix(ts, STATES[state], lat / 1e6, lon / 1e6, alt / 10, vel / 100, sats, -1.0 if hdop < 0 else hdop / 100))
+
+
+def decode_fix(line): # Decodes a line (str or bytes) or a binary frame sent by the device. Raises ValueError if it isn't a valid message.
+    if isinstance(line, (bytes, bytearray)):
+        if line[:1] == b"\xa5":
+            return decode_frame(line)
+        line = line.decode(errors="replace")
+    match = _FIX_LINE.match(line)
+    if match is not None: # The format of the ESP32, the fast way
+        ts, estado, lat, lon, alt, vel, sats, hdop, device = match.groups()
+        try:
+            return _checked(Fix(int(ts), estado, float(lat), float(lon), float(alt), float(vel), int(sats), float(hdop), device))
+        except ValueError as e:
+            raise ValueError(f"invalid message ({e})") from None
+    try: # Any other JSON with the same fields (other order, spaces...)
+        data = json.loads(line)
+        fix = Fix(int(data["ts"]), str(data["estado"]), float(data["lat"]), float(data["lon"]), float(data.get("alt", 0.0)),
+                  float(data.get("vel_kmh", 0.0)), int(data.get("sats", -1)), float(data.get("hdop", -1.0)),
+                  None if data.get("id") is None else str(data["id"]))
+    except (ValueError, KeyError, TypeError, AttributeError) as e:
+        raise ValueError(f"invalid message ({e})") from None
+    return _checked(fix)
+
+
+class MessageBuffer: # Splits the bytes read in bulk from the port (or a file) into messages, keeping the incomplete last one for the next read.
+    # The messages are text lines (str, without the newline) or binary frames (bytes, with a right CRC). After garbage or a corrupted frame
+    # it looks for the next sync byte or newline, and the skipped bytes are counted in skipped.
+    def __init__(self):
+        self._rest = b""
+        self.skipped = 0
+
+    def feed(self, data): # Returns the complete messages of the data
+        buffer = self._rest + data if self._rest else bytes(data)
+        size = len(buffer)
+        messages = []
+        position = 0
+        while position < size:
+            if buffer[position] == FRAME_SYNC:
+                if size - position < FRAME_SIZE: # The rest of the frame hasn't arrived yet
+                    break
+                frame = buffer[position:position + FRAME_SIZE]
+                if struct.unpack_from("<H", frame, FRAME_SIZE - 2)[0] == frame_crc(frame):
+                    messages.append(frame)
+                    position += FRAME_SIZE
+                else: # It was just a byte that looked like a sync, or the frame is corrupted
+                    self.skipped += 1
+                    position += 1
+                continue
+            end = buffer.find(b"\n", position)
+            sync = buffer.find(b"\xa5", position, size if end == -1 else end)
+            if sync != -1: # A frame starts in the middle of the line, so the line is cut
+                self.skipped += sync - position
+                position = sync
+                continue
+            if end == -1:
+                break
+            messages.append(buffer[position:end].decode(errors="replace")) # The device sends ASCII, other bytes make the line invalid
+            position = end + 1
+        self._rest = buffer[position:]
+        if len(self._rest) > MAX_LINE:
+            self.skipped += len(self._rest)
+            self._rest = b""
+        return messages
+
+    def clear(self):
+        self._rest = b""
+
+
+def iter_dump_fixes(path, errors= None): # Decodes every message of a captured serial dump. errors, if given, is a list where the invalid ones are added.
+    buffer = MessageBuffer()
+    with open(path, "rb") as f:
+        while True:
+            data = f.read(CHUNK_SIZE)
+            messages = buffer.feed(data + (b"" if data else b"\n")) # At the end, the last line is complete
+            for line in messages:
+                if isinstance(line, str) and not line.strip():
+                    continue
+                try:
+                    yield decode_fix(line)
+                except ValueError:
+                    if errors is not None:
+                        errors.append(line)
+            if not data:
+                return
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        print("Usage: python device_messages.py <serial dump file>")
+        sys.exit(1)
+    errors = []
+    start = time.perf_counter()
+    count = sum(1 for _ in iter_dump_fixes(sys.argv[1], errors))
+    seconds = time.perf_counter() - start
+    print(f"{count} fixes decoded ({len(errors)} invalid messages) in {seconds:.2f} s, {count / seconds if seconds else 0:,.0f} fixes/s")
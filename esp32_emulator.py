@@ -0,0 +1,246 @@
+"""This module emulates the ESP32 on a Linux pseudo-terminal, so read_port can be tested without the microcontroller or the GPS: it sends the
+same messages as ESP32_main.ino (JSON lines, or binary frames when it receives 'B') at any rate, following a route through the stored
+areas, with the SEARCHING, UNSURE and FIXED states of a real start, malformed messages and stalls (no messages for a while, like a reboot).
+It can be executed directly: python esp32_emulator.py [options] (--help shows them). The name of the port is printed, set it as COM_PORT,
+or use --measure to read it with read_port in the same process and report the throughput, the reconnection time, the messages dropped by the device and the fixes missed by the reader."""
+
+import argparse
+import math
+import os
+import random
+import threading
+import time
+import tty
+from collections import deque
+from device_messages import Fix, encode_line, encode_frame, BINARY_COMMAND, JSON_COMMAND
+from is_inside_area_function_2 import AreaGeometry, METERS_PER_DEGREE_LAT
+
+MAX_PENDING = 1 << 16 # Bytes kept while the reader doesn't read (like the Bluetooth buffer of the ESP32), the next fixes are dropped
+TICK = 0.001 # Seconds between two writes, all the fixes due are written together
+
+
+def route_through_areas(areas, names= None, margin= 0.001): # Waypoints (lat, lon) that go from outside to a point inside every area, in turn.
+    # Areas: a dictionary of areas (or the areas of the repository), names: the areas to visit (all of them by default). The point is
+    # Shapely's representative point, always inside, unlike the centre of the box of a concave area.
+    from tile_cache import area_boxes
+    boxes = dict(zip(areas, area_boxes(areas)))
+    names = list(names) if names is not None else list(boxes)
+    if not names:
+        return []
+    min_lat, max_lat, min_lon, max_lon = boxes[names[0]]
+    route = [(min_lat - margin, min_lon - margin)] # Outside the first area, so it's entered
+    for name in names:
+        point = AreaGeometry(areas[name]).polygon.representative_point() # Shapely uses (lon, lat)
+        route.append((point.y, point.x))
+    route.append(route[0])
+    return route
+
+
+class Trajectory: # Moves along the waypoints at a constant speed, and starts again at the first one.
+    def __init__(self, waypoints, speed_kmh):
+        self.waypoints = [tuple(point) for point in waypoints] or [(0.0, 0.0)]
+        self.speed_kmh = speed_kmh
+        self._lengths = [] # Meters of every leg
+        for (lat0, lon0), (lat1, lon1) in zip(self.waypoints, self.waypoints[1:]):
+            cos_lat = math.cos(math.radians((lat0 + lat1) / 2))
+            self._lengths.append(math.hypot(lat1 - lat0, (lon1 - lon0) * cos_lat) * METERS_PER_DEGREE_LAT)
+        self._total = sum(self._lengths)
+
+    def position(self, seconds): # (lat, lon) after these seconds
+        if not self._total:
+            return self.waypoints[0]
+        distance = (self.speed_kmh / 3.6 * seconds) % self._total
+        for (lat0, lon0), (lat1, lon1), length in zip(self.waypoints, self.waypoints[1:], self._lengths):
+            if distance <= length:
+                part = distance / length if length else 0.0
+                return lat0 + (lat1 - lat0) * part, lon0 + (lon1 - lon0) * part
+            distance -= length
+        return self.waypoints[-1]
+
+
+class Esp32Emulator: # Sends the fixes through the master side of a pty, the reader opens port_name like a serial port.
+    def __init__(self, trajectory, rate= 1.0, searching= 2.0, unsure= 2.0, malformed= 0.0, stall_every= 0.0, stall_for= 0.0,
+                 reboot= False, seed= None, device= None):
+        self.trajectory = trajectory
+        self.device = device # The "id" sent in the messages (None: not sent, like the ESP32 by default)
+        self.rate = rate # Fixes per second
+        self.searching = searching # Seconds in SEARCHING (lat= 0, lon= 0) and then in UNSURE after every start
+        self.unsure = unsure
+        self.malformed = malformed # Probability of sending a malformed message instead of a fix
+        self.stall_every = stall_every # Seconds between stalls (0 = never) and their length
+        self.stall_for = stall_for
+        self.reboot = reboot # After a stall, ts and the states start again, like a reboot of the ESP32
+        self.binary = False # Changed by the commands of the reader
+        self.sent = 0 # Valid fixes written to the pty (completely)
+        self.malformed_sent = 0
+        self.dropped = 0 # Messages lost in the device: its buffer was full because the reader didn't read, or a stall cleared them
+        self.stall_ends = [] # time.perf_counter() of the end of every stall
+        self._random = random.Random(seed)
+        self._pending = bytearray()
+        self._queued = deque() # [bytes not written yet, is a valid fix] of every message in _pending, in order
+        self._stop = threading.Event()
+        self._master, self._slave = os.openpty()
+        tty.setraw(self._slave) # No echo or newline translation, the bytes arrive as they're sent
+        os.set_blocking(self._master, False)
+        self.port_name = os.ttyname(self._slave)
+
+    def fix_at(self, seconds, boot): # The fix the ESP32 would send this many seconds after starting (boot: seconds since the last start).
+        lat, lon = self.trajectory.position(seconds)
+        if boot < self.searching:
+            return Fix(int(boot), "SEARCHING", 0.0, 0.0, 0.0, 0.0, 0, 99.9, self.device)
+        if boot < self.searching + self.unsure:
+            return Fix(int(boot), "UNSURE", lat, lon, 120.0, self.trajectory.speed_kmh, 4, 3.1, self.device)
+        return Fix(int(boot), "FIXED", lat, lon, 120.0, self.trajectory.speed_kmh, 9, 0.9, self.device)
+
+    def _message(self, fix): # (the bytes of the fix, True), or (the bytes of a malformed message, False)
+        message = encode_frame(fix) if self.binary else encode_line(fix).encode()
+        if not self.malformed or self._random.random() >= self.malformed:
+            return message, True
+        kind = self._random.randrange(3)
+        if kind == 0: # Cut (the rest is lost)
+            message = message[:self._random.randrange(1, len(message) - 1)] + (b"" if self.binary else b"\n")
+        elif kind == 1: # Noise
+            message = bytes(self._random.randrange(128, 256) for _ in range(self._random.randrange(1, 40))) + b"\n"
+        elif self.binary: # A corrupted byte, the CRC doesn't match
+            corrupted = bytearray(message)
+            corrupted[self._random.randrange(2, len(corrupted) - 2)] ^= 0xFF
+            message = bytes(corrupted)
+        else: # An unknown state
+            message = message.replace(b'"estado":"', b'"estado":"X', 1)
+        return message, False
+
+    def _read_commands(self):
+        try:
+            commands = os.read(self._master, 1024)
+        except (BlockingIOError, OSError):
+            return
+        if BINARY_COMMAND in commands:
+            self.binary = commands.rfind(BINARY_COMMAND) > commands.rfind(JSON_COMMAND)
+        elif JSON_COMMAND in commands:
+            self.binary = False
+
+    def _write(self, data, valid):
+        if len(self._pending) + len(data) > MAX_PENDING:
+            self.dropped += 1
+            return
+        self._pending += data
+        self._queued.append([len(data), valid])
+
+    def _flush(self): # Writes what the pty accepts. A message counts as sent when its last byte is written.
+        while self._pending:
+            try:
+                written = os.write(self._master, self._pending)
+            except (BlockingIOError, OSError):
+                return
+            del self._pending[:written]
+            while written and self._queued:
+                message = self._queued[0]
+                part = min(written, message[0])
+                message[0] -= part
+                written -= part
+                if not message[0]:
+                    self._queued.popleft()
+                    if message[1]:
+                        self.sent += 1
+                    else:
+                        self.malformed_sent += 1
+
+    def _clear(self): # The messages not written yet are lost, like the buffer of the ESP32 when it reboots
+        self.dropped += len(self._queued)
+        self._queued.clear()
+        self._pending.clear()
+
+    def run(self, duration= None): # Sends fixes until stop() is called (or for duration seconds).
+        start = begin = time.perf_counter() # start moves forward after every stall, so the emulated time doesn't count them
+        boot_start = 0.0 # Emulated seconds of the last start
+        next_stall = self.stall_every or math.inf
+        count = 0 # Fixes sent, or dropped, since the start
+        while not self._stop.is_set():
+            if duration is not None and time.perf_counter() - begin >= duration:
+                break
+            now = time.perf_counter() - start
+            self._read_commands()
+            if now >= next_stall: # Nothing is sent during the stall
+                self._stop.wait(self.stall_for)
+                self._clear()
+                self.stall_ends.append(time.perf_counter())
+                start += self.stall_for
+                now = time.perf_counter() - start
+                next_stall += self.stall_every
+                count = int(now * self.rate)
+                if self.reboot:
+                    boot_start = now
+            due = int(now * self.rate) + 1 # Fixes that should have been sent by now
+            while count < due:
+                seconds = count / self.rate
+                self._write(*self._message(self.fix_at(seconds, seconds - boot_start)))
+                count += 1
+            self._flush()
+            self._stop.wait(min(TICK, 1 / self.rate))
+
+    def stop(self):
+        self._stop.set()
+
+    def close(self):
+        os.close(self._master)
+        os.close(self._slave)
+
+
+def measure(emulator, seconds): # Reads the emulator with read_port in a thread, and returns what arrived (prints a report).
+    from geofencing_read_bt_2 import read_port
+    received = []
+    threading.Thread(target= read_port, kwargs= dict(port= emulator.port_name, callback= lambda fix: received.append(time.perf_counter())),
+                     daemon= True).start()
+    start = time.perf_counter()
+    emulator.run(seconds)
+    time.sleep(0.5) # The last fixes are still being read
+    elapsed = time.perf_counter() - start
+    latencies = []
+    for end in emulator.stall_ends: # Time until the first fix received after every stall
+        after = [moment for moment in received if moment >= end]
+        if after:
+            latencies.append(after[0] - end)
+    missed = emulator.sent - len(received) # Written to the pty, but not given by read_port
+    print(f"Sent {emulator.sent} fixes and {emulator.malformed_sent} malformed messages in {elapsed:.1f} s, {emulator.dropped} messages dropped by the device")
+    print(f"Received {len(received)} fixes, {len(received) / elapsed:,.0f} fixes/s, {missed} missed by the reader ({missed / max(emulator.sent, 1):.1%})")
+    if latencies:
+        print(f"Reconnection after {len(latencies)} stalls: {sum(latencies) / len(latencies) * 1000:.1f} ms average, {max(latencies) * 1000:.1f} ms worst")
+    return received
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description= "Emulates the ESP32 on a pseudo-terminal.")
+    parser.add_argument("--rate", type= float, default= 1.0, help= "fixes per second (default 1, up to some thousands)")
+    parser.add_argument("--areas", nargs= "*", help= "go through these stored areas (all of them without names)")
+    parser.add_argument("--start", type= float, nargs= 2, default= (41.3874, 2.1686), metavar= ("LAT", "LON"), help= "position without --areas")
+    parser.add_argument("--speed", type= float, default= 5.0, help= "speed in km/h")
+    parser.add_argument("--searching", type= float, default= 2.0, help= "seconds in SEARCHING after every start")
+    parser.add_argument("--unsure", type= float, default= 2.0, help= "seconds in UNSURE after SEARCHING")
+    parser.add_argument("--malformed", type= float, default= 0.0, help= "probability of a malformed message (0 to 1)")
+    parser.add_argument("--stall-every", type= float, default= 0.0, help= "seconds between stalls (0 = never)")
+    parser.add_argument("--stall-for", type= float, default= 7.0, help= "length of the stalls, longer than BT_TIMEOUT to close the port")
+    parser.add_argument("--reboot", action= "store_true", help= "the stalls are reboots: ts and the states start again")
+    parser.add_argument("--seed", type= int, help= "for repeatable malformed messages")
+    parser.add_argument("--id", help= "name of the device, sent in every message (for fleet_ingest.py)")
+    parser.add_argument("--duration", type= float, help= "seconds to run (forever by default, Ctrl+C to stop)")
+    parser.add_argument("--measure", type= float, metavar= "SECONDS", help= "read the port with read_port and report the results")
+    options = parser.parse_args()
+
+    if options.areas is not None:
+        from area_repository import open_area_repository
+        stored = open_area_repository().load()
+        waypoints = route_through_areas(stored, options.areas or None)
+    else:
+        waypoints = [tuple(options.start)]
+    emulator = Esp32Emulator(Trajectory(waypoints, options.speed), options.rate, options.searching, options.unsure, options.malformed,
+                             options.stall_every, options.stall_for, options.reboot, options.seed, options.id)
+    try:
+        if options.measure:
+            measure(emulator, options.measure)
+        else:
+            print(f"Emulating the ESP32 on {emulator.port_name} at {options.rate:g} fixes/s (Ctrl+C to stop)")
+            emulator.run(options.duration)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        emulator.close()
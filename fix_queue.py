@@ -0,0 +1,32 @@
+"""This module defines the queue between the Bluetooth thread and the tkinter mainloop. The Bluetooth thread just puts the messages, and the
+mainloop takes all of them at a fixed rate, so the widgets are never touched from another thread."""
+
+import threading
+from collections import deque
+
+
+class FixQueue:
+    def __init__(self, maxsize= 10000): # When it's full, the oldest messages are dropped (and counted) instead of blocking the Bluetooth thread.
+        self._items = deque(maxlen= maxsize)
+        self._lock = threading.Lock()
+        self._dropped = 0
+
+    def __len__(self):
+        return len(self._items)
+
+    def put(self, item): # Called from the Bluetooth thread.
+        with self._lock:
+            if len(self._items) == self._items.maxlen:
+                self._dropped += 1
+            self._items.append(item)
+
+    def drain(self): # Called from the mainloop. Returns every pending message in order, so no geofencing transition is lost.
+        with self._lock:
+            items = list(self._items)
+            self._items.clear()
+        return items
+
+    def take_dropped(self): # Number of messages dropped since the last call.
+        with self._lock:
+            dropped, self._dropped = self._dropped, 0
+        return dropped
@@ -0,0 +1,244 @@
+"""This module receives the fixes of a fleet of devices at once, in a single thread, with asyncio: serial ports (only on Linux and macOS,
+the port is watched by the event loop) and TCP connections (e.g. a gateway for many trackers, or many emulators). Every device, known by
+the "id" of its messages (or by the port or connection they come from, if there's no id), has its own position, timeout and geofencing
+state, checked by the same GeofenceEngine. It can be executed directly: python fleet_ingest.py [--serial PORT ...] [--listen HOST:PORT]"""
+
+import argparse
+import asyncio
+import sys
+import time
+import serial
+from config_manager import load_config
+from debug_logger_2 import log
+from device_messages import decode_fix, MessageBuffer, BINARY_COMMAND, JSON_COMMAND
+from geofencing_read_bt_2 import retry_delay
+
+configuration= load_config()
+
+READ_SIZE = 1 << 16 # Bytes read at once from a stream
+LISTEN_BACKLOG = 1024 # Connections waiting to be accepted, many devices connect at once when the server starts
+WATCH_INTERVAL = 1.0 # Seconds between two checks of the position timeouts
+STATS_INTERVAL = 60.0 # Seconds between two summaries in the log, when it's executed directly
+SERIAL_SUPPORTED = sys.platform != "win32" # The event loops of Windows cannot watch a serial port (add_reader is just for sockets there)
+
+
+class DeviceState: # What the fleet knows of a device
+    __slots__ = ("device", "source", "fix", "position", "position_time", "last_seen", "fixes")
+
+    def __init__(self, device, source):
+        self.device = device
+        self.source = source # Port or connection of its last message
+        self.fix = None # Last message
+        self.position = None # (lat, lon) of the last valid fix, None if there's no position
+        self.position_time = 0.0
+        self.last_seen = 0.0
+        self.fixes = 0
+
+
+class FleetIngestor:
+    def __init__(self, engine, position_timeout= None, stream_timeout= None):
+        self.engine = engine # The transitions of every device are its "transition" events
+        self.devices = {} # device -> DeviceState
+        self.position_timeout = position_timeout if position_timeout is not None else configuration.get_float("POSITION_TIMEOUT")
+        self.stream_timeout = stream_timeout if stream_timeout is not None else configuration.get_float("BT_TIMEOUT")
+        self.streams = 0 # Streams being read now
+        self.fixes = 0 # Valid and invalid messages received since the start
+        self.invalid = 0
+
+    # Messages
+
+    def handle(self, fix, source, now= None): # A message of some device. Returns its TransitionEvents.
+        now = now if now is not None else time.time()
+        device = fix.device if fix.device is not None else source
+        state = self.devices.get(device)
+        if state is None:
+            state = self.devices[device] = DeviceState(device, source)
+            log(f"[INFO] New device {device} (from {source})")
+        state.source = source
+        state.fix = fix
+        state.last_seen = now
+        state.fixes += 1
+        self.fixes += 1
+        if fix.estado == "SEARCHING": # Cannot give a position if there's no fix
+            return ()
+        state.position = (fix.lat, fix.lon)
+        state.position_time = now
+        return self.engine.check_device(device, fix.lat, fix.lon, now, fix.vel_kmh, fix.ts)
+
+    def feed(self, buffer, data, source): # Decodes the bytes received from a stream, with its own MessageBuffer. Returns the valid messages.
+        now = time.time()
+        count = 0
+        for message in buffer.feed(data):
+            if isinstance(message, str):
+                message = message.strip()
+                if not message:
+                    continue
+            try:
+                fix = decode_fix(message)
+            except ValueError as e:
+                self.invalid += 1
+                log(f"[ERROR] [{source}] While decoding this message: {message if isinstance(message, str) else message.hex()} ({e})")
+                continue
+            self.handle(fix, source, now)
+            count += 1
+        return count
+
+    def check_timeouts(self, now= None): # Removes the positions that haven't been actualized. Returns the devices that lost it.
+        now = now if now is not None else time.time()
+        lost = []
+        for device, state in self.devices.items():
+            if state.position is not None and now - state.position_time > self.position_timeout:
+                state.position = None
+                self.engine.forget_device(device)
+                lost.append(device)
+        if lost:
+            log(f"[WARNING] The position of {len(lost)} devices has been lost: {', '.join(map(str, lost[:10]))}{'...' if len(lost) > 10 else ''}")
+        return lost
+
+    # Streams
+
+    async def read_stream(self, reader, source, received= None): # Reads an asyncio StreamReader until it ends or sends nothing during the
+        # stream timeout. Returns the valid messages it had. received: a list whose first item is kept up to date with that number (it's
+        # still known if the reading ends with an error).
+        buffer = MessageBuffer()
+        received = received if received is not None else [0]
+        self.streams += 1
+        try:
+            while True:
+                try:
+                    data = await asyncio.wait_for(reader.read(READ_SIZE), self.stream_timeout)
+                except asyncio.TimeoutError:
+                    log(f"[WARNING] [{source}] TIMEOUT: >{self.stream_timeout:g} s without messages --> Closed")
+                    return received[0]
+                if not data:
+                    log(f"[INFO] [{source}] Closed")
+                    return received[0]
+                received[0] += self.feed(buffer, data, source)
+                if buffer.skipped:
+                    log(f"[WARNING] [{source}] {buffer.skipped} corrupted bytes have been skipped")
+                    buffer.skipped = 0
+        finally:
+            self.streams -= 1
+
+    async def _connection(self, reader, writer): # A device (or a gateway) connected to the TCP server
+        source = "{}:{}".format(*writer.get_extra_info("peername")[:2])
+        log(f"[INFO] [{source}] Connected")
+        writer.write(_format_command())
+        try:
+            await self.read_stream(reader, source)
+        except (ConnectionError, OSError) as e:
+            log(f"[ERROR] [{source}] {e}")
+        finally:
+            writer.close()
+
+    async def listen(self, host, port): # Starts a TCP server, every connection is read as a stream of messages. Returns the server.
+        server = await asyncio.start_server(self._connection, host, port, backlog= LISTEN_BACKLOG)
+        log(f"[INFO] Receiving the fixes of the fleet on {host}:{port}")
+        return server
+
+    async def follow_serial(self, port, baud= None): # Reads a serial port forever, reconnecting like read_port (at once, then more slowly).
+        if not SERIAL_SUPPORTED:
+            log(f"[WARNING] [{port}] Serial ports cannot be read by the fleet on this system, it's skipped (use read_port, or a TCP gateway)")
+            return
+        baud = baud if baud is not None else configuration.get_int("BAUDRATE")
+        loop = asyncio.get_running_loop()
+        attempt = 0
+        while True:
+            await asyncio.sleep(retry_delay(attempt))
+            try: # Opening a port can take a while, so it's done in a thread
+                ser = await loop.run_in_executor(None, lambda: serial.Serial(port, baud, timeout= 0))
+            except Exception as e:
+                attempt += 1
+                if attempt <= configuration.get_int("BT_CONNECTING_CYCLES"):
+                    log(f"[ERROR] [{port}] While trying to connect: {e}")
+                continue
+            log(f"[INFO] [{port}] Connected")
+            received = [0] # Valid messages of this port, the fixes of the rest of the fleet don't mean that it works
+            watched = False # If the port has been added to the loop, so it must be removed
+            try:
+                ser.write(_format_command())
+                reader = _serial_reader(loop, ser)
+                watched = True
+                await self.read_stream(reader, port, received)
+            except Exception as e:
+                log(f"[ERROR] [{port}] While reading the port: {e}")
+            finally:
+                if watched:
+                    loop.remove_reader(ser.fileno())
+                ser.close()
+            attempt = 0 if received[0] else attempt + 1 # At once if it was working
+
+    async def watch_timeouts(self):
+        while True:
+            await asyncio.sleep(WATCH_INTERVAL)
+            self.check_timeouts()
+
+    async def run(self, serial_ports= (), listen= None): # Reads every port and the TCP server (host, port) until it's cancelled.
+        tasks = [asyncio.create_task(self.follow_serial(port)) for port in serial_ports]
+        tasks.append(asyncio.create_task(self.watch_timeouts()))
+        server = await self.listen(*listen) if listen else None
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+            if server is not None:
+                server.close()
+
+
+def _format_command(): # Asks the devices for the format of BT_FORMAT (they send JSON if they don't understand it)
+    return BINARY_COMMAND if configuration["BT_FORMAT"] == "binary" else JSON_COMMAND
+
+
+def _serial_reader(loop, ser): # A StreamReader fed by the event loop when the port has data, without a thread.
+    reader = asyncio.StreamReader(limit= READ_SIZE)
+
+    def readable():
+        try:
+            data = ser.read(ser.in_waiting or 1)
+        except Exception as e:
+            loop.remove_reader(ser.fileno())
+            reader.set_exception(e)
+            return
+        if data:
+            reader.feed_data(data)
+
+    loop.add_reader(ser.fileno(), readable)
+    return reader
+
+
+async def _main(options):
+    from area_repository import open_area_repository
+    from geofencing_engine import GeofenceEngine
+
+    engine = GeofenceEngine(open_area_repository().load())
+    fleet = FleetIngestor(engine)
+    listen = None
+    if options.listen:
+        host, _, port = options.listen.rpartition(":")
+        listen = (host or "0.0.0.0", int(port))
+
+    async def stats():
+        while True:
+            await asyncio.sleep(STATS_INTERVAL)
+            located = sum(1 for state in fleet.devices.values() if state.position is not None)
+            log(f"[INFO] {len(fleet.devices)} devices ({located} with position), {fleet.streams} streams, {fleet.fixes} fixes, {fleet.invalid} invalid")
+
+    statistics = asyncio.create_task(stats())
+    try:
+        await fleet.run(options.serial, listen)
+    finally:
+        statistics.cancel()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description= "Receives the fixes of many devices at once.")
+    parser.add_argument("--serial", nargs= "*", default= [], metavar= "PORT", help= "serial ports to read")
+    parser.add_argument("--listen", metavar= "HOST:PORT", help= "receive the fixes through TCP connections")
+    options = parser.parse_args()
+    if not options.serial and not options.listen:
+        parser.error("give some --serial port or --listen")
+    try:
+        asyncio.run(_main(options))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,118 @@
+"""This module turns the geofencing checks of every fix into transitions: ENTER, EXIT and DWELL (the device has been inside an area for
+some time). There's a small state machine for every device and area, with hysteresis, so a position that jumps around the edge of an
+area doesn't produce a transition on every fix."""
+
+import threading
+from config_manager import load_config
+from debug_logger_2 import log
+
+configuration= load_config()
+
+ENTER = "ENTER"
+EXIT = "EXIT"
+DWELL = "DWELL"
+DEFAULT_DEVICE = "local" # The device connected by Bluetooth
+
+
+class TransitionEvent:
+    __slots__ = ("kind", "device", "area", "lat", "lon", "timestamp")
+
+    def __init__(self, kind, device, area, lat, lon, timestamp):
+        self.kind = kind
+        self.device = device
+        self.area = area
+        self.lat = lat
+        self.lon = lon
+        self.timestamp = timestamp
+
+    def __repr__(self):
+        return f"TransitionEvent({self.kind}, device={self.device!r}, area={self.area!r}, lat={self.lat}, lon={self.lon}, timestamp={self.timestamp})"
+
+
+class _AreaState: # State of a device in an area
+    __slots__ = ("inside", "pending", "entered_at", "dwelled")
+
+    def __init__(self):
+        self.inside = False # Confirmed state
+        self.pending = 0 # Consecutive fixes that say the opposite of the confirmed state
+        self.entered_at = None
+        self.dwelled = False # The DWELL event has already been sent for this stay
+
+
+class TransitionTracker:
+    def __init__(self, confirm_fixes= None, dwell_time= None, margin_m= None, distance= None):
+        # confirm_fixes: consecutive fixes needed to confirm a transition. margin_m: fixes nearer than this to the edge don't count (0 = off).
+        # dwell_time: seconds inside an area to send DWELL (0 = never). distance(area, lat, lon): meters to the edge, needed for margin_m.
+        self.confirm_fixes = max(1, confirm_fixes if confirm_fixes is not None else configuration.get_int("GEOFENCE_CONFIRM_FIXES"))
+        self.dwell_time = dwell_time if dwell_time is not None else configuration.get_float("GEOFENCE_DWELL_TIME")
+        self.margin_m = margin_m if margin_m is not None else configuration.get_float("GEOFENCE_MARGIN_M")
+        self.distance = distance
+        self._states = {} # device -> {area: _AreaState}, just the areas the device is in or is entering
+        self._subscribers = []
+        self._lock = threading.Lock()
+
+    def subscribe(self, callback): # The callback receives every TransitionEvent.
+        self._subscribers.append(callback)
+        return callback
+
+    def unsubscribe(self, callback):
+        if callback in self._subscribers:
+            self._subscribers.remove(callback)
+
+    def reset(self, device= None): # Forgets the state of a device (or of every device). The next fix is taken as it is, without hysteresis.
+        with self._lock:
+            if device is None:
+                self._states.clear()
+            else:
+                self._states.pop(device, None)
+
+    def forget_area(self, area): # The area has been removed or edited, the devices will be checked again from zero.
+        with self._lock:
+            for states in self._states.values():
+                states.pop(area, None)
+
+    def is_inside(self, device, area): # Confirmed state
+        state = self._states.get(device, {}).get(area)
+        return state is not None and state.inside
+
+    def inside_areas(self, device):
+        return {area for area, state in self._states.get(device, {}).items() if state.inside}
+
+    def update(self, device, containing, lat, lon, timestamp): # containing: areas that contain the fix. Returns the events, and notifies them.
+        events = []
+        with self._lock:
+            first = device not in self._states
+            states = self._states.setdefault(device, {})
+            for area in set(containing) | set(states):
+                inside = area in containing
+                state = states.get(area)
+                if state is None:
+                    state = states[area] = _AreaState()
+                if inside != state.inside:
+                    if first or self._counts(area, lat, lon):
+                        state.pending += 1
+                    if first or state.pending >= self.confirm_fixes:
+                        state.inside = inside
+                        state.pending = 0
+                        state.entered_at = timestamp if inside else None
+                        state.dwelled = False
+                        events.append(TransitionEvent(ENTER if inside else EXIT, device, area, lat, lon, timestamp))
+                else:
+                    state.pending = 0
+                if state.inside and not state.dwelled and self.dwell_time > 0 and timestamp - state.entered_at >= self.dwell_time:
+                    state.dwelled = True
+                    events.append(TransitionEvent(DWELL, device, area, lat, lon, timestamp))
+                if not state.inside and not state.pending:
+                    del states[area] # Just the areas the device is in (or entering) are kept
+        for event in events:
+            for callback in list(self._subscribers):
+                try:
+                    callback(event)
+                except Exception as e:
+                    log(f"[ERROR] While notifying the transition {event.kind} of {event.area}: {e}")
+        return events
+
+    def _counts(self, area, lat, lon): # With a margin, the fixes too near the edge don't count for a transition
+        if self.margin_m <= 0 or self.distance is None:
+            return True
+        return self.distance(area, lat, lon) >= self.margin_m
@@ -0,0 +1,277 @@
+"""This module holds the geofencing engine: the areas, the current position, the monitoring state and the events. It doesn't use tkinter at
+all, so it can run without a display (as a service, in a benchmark...). The UI just subscribes to its events and shows them."""
+
+import math
+import time
+from config_manager import load_config
+from debug_logger_2 import log
+from is_inside_area_function_2 import AreaGeometryCache, METERS_PER_DEGREE_LAT, canonical_ring
+from area_index import AreaIndex
+from geofence_events import TransitionTracker, DEFAULT_DEVICE
+
+configuration= load_config()
+
+# Events the engine emits, and the arguments every subscriber receives:
+# "position"         -> lat, lon, state           A new valid position fix
+# "position_lost"    -> (nothing)                 No position fix during POSITION_TIMEOUT seconds
+# "monitoring"       -> active, area, reason      The geofencing function has been started or stopped
+# "status"           -> area, inside, containing  The monitored area has been entered or left (confirmed), while monitoring
+# "transition"       -> event                     A TransitionEvent (ENTER, EXIT or DWELL) of any area, while monitoring
+# "areas"            -> names                     Some areas have been added, edited or removed
+EVENTS = ("position", "position_lost", "monitoring", "status", "transition", "areas")
+
+
+class GeofenceEngine:
+    def __init__(self, areas= None, position_timeout= None, safe_radius_max= None):
+        self.geometry_cache = AreaGeometryCache() # Prepared geometry of every area, rebuilt only when the area changes
+        self.area_index = AreaIndex(self.geometry_cache) # Spatial index of every area, to know all the areas that contain the position
+        self.areas = {}
+        self.position = None # (lat, lon) of the last valid fix, None if there's no position
+        self.state = None # Last satellite state sent by the device (SEARCHING, UNSURE, FIXED)
+        self.last_position_time = 0
+        self.position_timeout = position_timeout if position_timeout is not None else configuration.get_float("POSITION_TIMEOUT")
+        self.monitoring = False
+        self.monitored_area = None # Name of the area the geofencing function checks
+        self.inside = None # Result of the last check, None if it hasn't been checked
+        self.containing = set() # Every area that contained the last position
+        self.transitions = TransitionTracker(distance= self.distance_to_boundary) # Turns the checks of every fix into ENTER/EXIT/DWELL
+        self.transitions.subscribe(lambda event: self._emit("transition", event))
+        self.safe_radius_max = safe_radius_max if safe_radius_max is not None else configuration.get_float("GEOFENCE_SAFE_RADIUS_MAX")
+        self._safe = None # (lat, lon, time, device time, radius, cos(lat)) of the last exact check, see _containing()
+        self.device_containing = {} # Other devices (see check_device): device -> areas that contained its last position
+        self._device_safe = {} # device -> its _safe
+        self.exact_checks = 0 # Fixes checked against the areas, and fixes that reused the last result
+        self.skipped_checks = 0
+        self._subscribers = {event: [] for event in EVENTS}
+        if position_timeout is None: # Follows the configuration, it can be changed while running
+            configuration.subscribe(self._on_config_changed, "POSITION_TIMEOUT")
+        if areas:
+            self.set_areas(areas)
+
+    def _on_config_changed(self, key, value):
+        self.position_timeout = configuration.get_float(key)
+
+    # Events
+
+    def subscribe(self, event, callback): # The callback will be called with the arguments of the event (see EVENTS).
+        if event not in self._subscribers:
+            raise ValueError(f"Unknown event: {event}")
+        self._subscribers[event].append(callback)
+        return callback
+
+    def unsubscribe(self, event, callback):
+        if callback in self._subscribers.get(event, []):
+            self._subscribers[event].remove(callback)
+
+    def _emit(self, event, *args):
+        for callback in list(self._subscribers[event]):
+            try:
+                callback(*args)
+            except Exception as e: # A subscriber shouldn't stop the engine or the other subscribers
+                log(f"[ERROR] While notifying the event {event}: {e}")
+
+    # Areas
+
+    def set_areas(self, areas): # Replaces every area, e.g. when they're loaded from the file. The mapping is used as it is (it can be lazy).
+        self.areas = areas
+        self.geometry_cache.invalidate()
+        self._forget_safe()
+        self.sync_index()
+        self._emit("areas", list(self.areas))
+
+    def set_area(self, name, coords): # Adds or edits an area. The points must be in order, raises ValueError if they aren't a valid area.
+        self.areas[name] = canonical_ring(coords)
+        self.geometry_cache.invalidate(name)
+        self._forget_safe()
+        self._emit("areas", [name])
+
+    def update_areas(self, areas): # Adds or edits many areas at once (e.g. when importing them), with just one event.
+        rings = {name: canonical_ring(coords) for name, coords in areas.items()} # Everything is checked before changing anything
+        for name, ring in rings.items():
+            self.areas[name] = ring
+            self.geometry_cache.invalidate(name)
+        self._forget_safe()
+        self._emit("areas", list(areas))
+
+    def remove_area(self, name):
+        if name not in self.areas:
+            return
+        self.areas.pop(name)
+        self.geometry_cache.invalidate(name)
+        self.transitions.forget_area(name)
+        self._forget_safe()
+        if self.monitoring and name == self.monitored_area:
+            self.stop_monitoring(reason= "area_removed")
+        self._emit("areas", [name])
+
+    def clear_areas(self):
+        names = list(self.areas)
+        self.areas.clear()
+        self.geometry_cache.invalidate()
+        self.transitions.reset()
+        self.device_containing.clear()
+        self._forget_safe()
+        if self.monitoring:
+            self.stop_monitoring(reason= "area_removed")
+        self._emit("areas", names)
+
+    def _forget_safe(self): # The areas have changed, the next fix of every device is checked exactly
+        self._safe = None
+        self._device_safe.clear()
+
+    def sync_index(self): # Brings the spatial index up to date, just the changed areas are rebuilt.
+        self.area_index.sync(self.areas)
+
+    def ring(self, name): # The cached ring of an area, [(lat, lon), ...] in order. The map draws the same ring the geofencing checks.
+        return self.geometry_cache.get(name, self.areas[name]).ring
+
+    def is_inside(self, name, lat, lon): # Checks a single area, using its cached geometry.
+        if name is None or name not in self.areas:
+            return False
+        return self.geometry_cache.contains(name, self.areas[name], lat, lon)
+
+    def areas_containing(self, lat, lon): # Every area that contains the position.
+        self.sync_index()
+        return self.area_index.areas_containing(lat, lon)
+
+    def distance_to_boundary(self, name, lat, lon): # Meters from the position to the edge of an area.
+        if name not in self.areas:
+            return 0.0
+        return self.geometry_cache.get(name, self.areas[name]).distance_to_boundary(lat, lon)
+
+    # Position
+
+    def process_message(self, msg): # Handles a message from the positioning device, with the format sent by the ESP32.
+        lat = msg.get("lat")
+        lon = msg.get("lon")
+        state = msg.get("estado")
+        self.state = state
+        if lat is None or lon is None or state == "SEARCHING": # Cannot give a position if there's no fix
+            return
+        self.update_position(lat, lon, state, speed_kmh= msg.get("vel_kmh"), device_time= msg.get("ts"))
+
+    def update_position(self, lat, lon, state= None, timestamp= None, speed_kmh= None, device_time= None):
+        # device_time: the "ts" of the ESP32 (seconds since it started), it doesn't depend on when the message is taken from the queue.
+        self.position = (lat, lon)
+        self.last_position_time = timestamp if timestamp is not None else time.time()
+        self._emit("position", lat, lon, state)
+        if self.monitoring:
+            self.evaluate(lat, lon, self.last_position_time, speed_kmh, device_time)
+
+    def evaluate(self, lat, lon, timestamp= None, speed_kmh= None, device_time= None): # The geofencing check of every area. Just the transitions are logged and notified, not every fix.
+        timestamp = timestamp if timestamp is not None else time.time()
+        self.containing, self._safe = self._containing(lat, lon, timestamp, speed_kmh, device_time, self._safe, self.containing)
+        for event in self.transitions.update(DEFAULT_DEVICE, self.containing, lat, lon, timestamp):
+            self._log_transition(event)
+        inside = self.transitions.is_inside(DEFAULT_DEVICE, self.monitored_area)
+        if inside != self.inside: # The label only changes when the confirmed state of the monitored area does
+            self.inside = inside
+            self._emit("status", self.monitored_area, self.inside, self.containing)
+        return self.inside
+
+    def check_device(self, device, lat, lon, timestamp= None, speed_kmh= None, device_time= None):
+        # The geofencing check of a position of another device (e.g. one of a fleet, see fleet_ingest.py), with its own safe radius and
+        # transitions. It doesn't change the position or the monitoring state of the application. Returns the TransitionEvents.
+        timestamp = timestamp if timestamp is not None else time.time()
+        containing, safe = self._containing(lat, lon, timestamp, speed_kmh, device_time, self._device_safe.get(device),
+                                            self.device_containing.get(device, ()))
+        self.device_containing[device] = containing
+        if safe is None:
+            self._device_safe.pop(device, None)
+        else:
+            self._device_safe[device] = safe
+        events = self.transitions.update(device, containing, lat, lon, timestamp)
+        for event in events:
+            self._log_transition(event)
+        return events
+
+    def forget_device(self, device): # The device has no position anymore, its next fix gives its state directly.
+        self.device_containing.pop(device, None)
+        self._device_safe.pop(device, None)
+        self.transitions.reset(device)
+
+    def _log_transition(self, event):
+        who = "The positioning device" if event.device == DEFAULT_DEVICE else f"The device {event.device}"
+        if event.kind == "ENTER":
+            log(f"[INFO] {who} has entered the area {event.area}!")
+        elif event.kind == "EXIT":
+            log(f"[INFO] {who} has left the area {event.area}!")
+        else:
+            log(f"[INFO] {who} has been inside the area {event.area} for {self.transitions.dwell_time:g} s")
+
+    def _containing(self, lat, lon, timestamp, speed_kmh, device_time, safe, previous): # Like areas_containing(), but reuses the last result when possible.
+        # After an exact check, the distance to the nearest edge of any area is a safe radius: while the device can't have gone farther,
+        # given the elapsed time and its speed, and the fix isn't farther either (the GPS can jump), no area can have been entered or left.
+        # safe and previous: the _safe and the result of the last check of the device. Returns (areas containing the position, new safe).
+        if safe is not None:
+            safe_lat, safe_lon, safe_time, safe_device_time, radius, cos_lat = safe
+            if device_time is not None and safe_device_time is not None and device_time >= safe_device_time:
+                elapsed = device_time - safe_device_time + 1 # ts has whole seconds, so up to one more second can have passed
+            else:
+                elapsed = max(timestamp - safe_time, 0.0)
+            if (speed_kmh or 0.0) / 3.6 * elapsed < radius:
+                dy = (lat - safe_lat) * METERS_PER_DEGREE_LAT
+                dx = (lon - safe_lon) * METERS_PER_DEGREE_LAT * cos_lat
+                if dx * dx + dy * dy < radius * radius:
+                    self.skipped_checks += 1
+                    return previous, safe
+        self.exact_checks += 1
+        containing = self.areas_containing(lat, lon)
+        radius = self.safe_radius(lat, lon, containing)
+        return containing, ((lat, lon, timestamp, device_time, radius, math.cos(math.radians(lat))) if radius > 0 else None)
+
+    def safe_radius(self, lat, lon, containing= None): # Meters from the position to the nearest edge of any area (at most GEOFENCE_SAFE_RADIUS_MAX).
+        if self.safe_radius_max <= 0:
+            return 0.0
+        if containing is None:
+            containing = self.areas_containing(lat, lon)
+        radius = self.safe_radius_max
+        for name in containing:
+            radius = min(radius, self.distance_to_boundary(name, lat, lon))
+        for name in self.area_index.candidates_near(lat, lon, radius): # The areas outside can't be nearer than their bounding box
+            if name not in containing:
+                radius = min(radius, self.distance_to_boundary(name, lat, lon))
+        return radius
+
+    def check_position_timeout(self, now= None): # Removes the position if it hasn't been actualized. Should be called periodically.
+        now = now if now is not None else time.time()
+        if now - self.last_position_time <= self.position_timeout:
+            return False
+        if self.position is not None:
+            self.position = None
+            log(f"[WARNING] The position has been lost!")
+            self._emit("position_lost")
+        if self.monitoring:
+            self.stop_monitoring(reason= "position_lost")
+        return True
+
+    # Geofencing function
+
+    def start_monitoring(self, area_name):
+        if self.position is None:
+            raise ValueError("cannot start without a fixed position")
+        if area_name not in self.areas:
+            raise ValueError("cannot start without a valid area")
+        self.monitoring = True
+        self.monitored_area = area_name
+        self.inside = None
+        self._safe = None
+        self.transitions.reset(DEFAULT_DEVICE) # The first check gives the state directly, without waiting for more fixes
+        log(f"[INFO] Starting geofencing function...")
+        self._emit("monitoring", True, area_name, None)
+
+    def stop_monitoring(self, reason= None): # The reason is None when the user stops it.
+        if not self.monitoring:
+            return
+        area = self.monitored_area
+        self.monitoring = False
+        self.monitored_area = None
+        self.inside = None
+        self.containing = set()
+        if reason == "position_lost":
+            log("[WARNING] Geofencing stopped automatically due to position loss!")
+        elif reason == "area_removed":
+            log("[WARNING] Geofencing stopped because its area has been removed!")
+        else:
+            log(f"[INFO] Stopping geofencing function...")
+        self._emit("monitoring", False, area, reason)
@@ -1,40 +1,52 @@
 """This module hold all the logic that will be used for the application, from the UI module. Takes care of everything, from the areas management
-to the map viewing and edditing."""
+to the map viewing and edditing. The areas, the position and the geofencing state are owned by the GeofenceEngine (geofencing_engine.py),
+this class just edits them through the UI and shows the engine events on the widgets."""
 
 import tkinter as tk
 import tkintermapview as tkmap
+from tkintermapview.utility_functions import decimal_to_osm
 from tkinter import messagebox as mbox
-from is_inside_area_function_2 import order_points_for_polygon
+from tkinter import filedialog as fdialog
+from is_inside_area_function_2 import canonical_ring
+from area_edit import EditSession
+from geofencing_engine import GeofenceEngine
+from area_repository import open_area_repository
+from area_formats import import_areas, write_areas_file
 from config_manager import load_config, edit_config
-from debug_logger_2 import check_log_file, log
-import json, os
-import time
+from debug_logger_2 import check_log_file, log, flush_log
+import os, atexit, time
 
 configuration= load_config()
-FILE_NAME= configuration["AREAS_FILE"]
+AREA_FILE_TYPES= [("GeoJSON", "*.geojson *.json"), ("KML", "*.kml")]
+REDRAW_INTERVAL_MS= 16 # While editing, the area is redrawn at most once per frame
+TILE_SIZE= 256 # Pixels of a map tile, to know how many pixels the position has moved
 check_log_file() # This ensures the log file exists before editing it
 
 class GeofenceLogic: # We define everything inside a class, because it will be imported from the UI module.
     def __init__(self, area_name, area_points, area_list,
                  delete_button, save_add_button, edit_button, tk_map, geofence_button, geofence_status, reconnect_button, connection_status,
-                 terminal, ui_lat, ui_lon, center_button):
+                 terminal, ui_lat, ui_lon, center_button, engine= None):
+        self.engine = engine if engine is not None else GeofenceEngine() # Areas, position and geofencing state, without any widget
         self.area_name = area_name
         self.area_points = area_points
-        self.original_area_coords = None
-        self.deleted_markers = []
         self.area_list = area_list
         self.delete_button = delete_button
         self.save_add_button = save_add_button
         self.edit_button = edit_button
         self.geofence_button= geofence_button
-        self.areas = {}
         self.edit_name = None
         self.adding= False
-        self.new_markers= []
+        self.session= None # EditSession with the points of the area being created or edited
+        self._redraw_scheduled= False
         self.tk_map= tk_map
         self.polygon= None
-        self.pos_marker= None
+        self.polygon_name= None # Name of the stored area drawn on the map, the one the geofencing function checks
+        self.pos_marker= None # The same marker is moved with every fix
+        self._marker_pixel= None # (zoom, x, y) where the position marker was drawn
+        self.repository= open_area_repository() # Writes the areas file (or database) when they change, a moment later and atomically
         self.load_areas_local()
+        self.repository.attach(self.engine)
+        atexit.register(self.repository.flush) # The last changes are written when the application is closed
         self.geofence_status= geofence_status # Label that shows if you're in or out the area
         self.reconnect_button= reconnect_button # Restablish the connection, just when connection_status is red. 
         self.connection_status= connection_status # Label just of colour
@@ -42,63 +54,95 @@ class GeofenceLogic: # We define everything inside a class, because it will be i
         self.ui_lat= ui_lat # Text boxes that shows the current position
         self.ui_lon= ui_lon # Text boxes that shows the current position
         self.center_button= center_button # Centers the position of the map to the actual position
-        self.last_position_time= 0
+        self._pending_position= None # The position and status are redrawn once per batch of fixes, with the last values
+        self._pending_status= None
+        self._render_scheduled= False
+        self._last_render= 0.0
+
+        # The widgets just show what happens in the engine
+        self.engine.subscribe("position", self.on_position)
+        self.engine.subscribe("position_lost", self.on_position_lost)
+        self.engine.subscribe("monitoring", self.on_monitoring)
+        self.engine.subscribe("status", self.on_status)
         self.check_position_loop()
 
+    @property
+    def areas(self): # The areas are stored in the engine, this is just a shortcut. They must be edited through the engine methods.
+        return self.engine.areas
+
+    @property
+    def last_position_time(self):
+        return self.engine.last_position_time
+
     def check_position_loop(self): # Checks if the position is being actualized
-        now = time.time()
-        if now - self.last_position_time > configuration["POSITION_TIMEOUT"]:
+        if self.engine.check_position_timeout():
             self.clear_marker()
             self.center_button.config(state=tk.DISABLED)
-            lat_text = self.ui_lat.cget("text")
-            lon_text = self.ui_lon.cget("text")
-            if lat_text or lon_text:
-                log(f"[WARNING] The position has been lost!")
-            self.ui_lat.config(text= "")
-            self.ui_lon.config(text= "")
-            if self.geofence_button.cget("text") == "Stop":
-                self.geofence_button.config(text="Start")
-                self.area_list.config(state=tk.NORMAL)
-                self.edit_button.config(state=tk.NORMAL)
-                self.save_add_button.config(state=tk.NORMAL)
-                self.delete_button.config(state=tk.NORMAL)
-                self.geofence_status.config(fg="black", bg="grey", text="Start the application")
-                log("[WARNING] Geofencing stopped automatically due to position loss!")
 
         self.tk_map.after(1000, self.check_position_loop) # Executes itself a second after
 
+    def on_position(self, lat, lon, state): # Engine event: a new position fix. Just the last one of a burst is drawn.
+        self._pending_position = (lat, lon)
+        self._schedule_render()
 
+    def on_position_lost(self): # Engine event: there's no position fix since POSITION_TIMEOUT seconds
+        self._pending_position = None
+        self.clear_marker()
+        self.center_button.config(state=tk.DISABLED)
+        self.ui_lat.config(text= "")
+        self.ui_lon.config(text= "")
 
-    def load_areas_local(self): # Loads the areas JSON to a variable of the class
-        if not os.path.exists(FILE_NAME):
-            with open(FILE_NAME, "w") as f:
-                json.dump({}, f)
-            self.areas = {}
-            return
+    def on_monitoring(self, active, area, reason): # Engine event: the geofencing function has started or stopped. Blocks or unblocks the UI.
+        if active:
+            self.geofence_button.config(text= "Stop")
+            self.area_name.config(state= tk.DISABLED)
+            self.area_points.config(state= tk.DISABLED)
+            self.area_list.config(state= tk.DISABLED)
+            self.edit_button.config(state= tk.DISABLED)
+            self.save_add_button.config(state= tk.DISABLED)
+            self.delete_button.config(state= tk.DISABLED)
+        else:
+            self.geofence_button.config(text= "Start")
+            self.area_list.config(state= tk.NORMAL)
+            self.edit_button.config(state= tk.NORMAL)
+            self.save_add_button.config(state= tk.NORMAL)
+            self.delete_button.config(state= tk.NORMAL)
+            self.geofence_status.config(fg= "black", bg= "grey", text= "Start the application")
 
-        try:
-            with open(FILE_NAME, "r") as f:
-                data = json.load(f)
-                self.areas = {name: [tuple(coord) for coord in coords] for name, coords in data.items()}
-                areas= {}
-                keys= self.areas.keys()
-                for key in keys:
-                    if len(self.areas[key]) < 3:
-                        log(f"[WARNING] Invalid Area: The area {key} has less than three points. It has been removed.")
-                    else:
-                        areas[key]= self.areas[key]
-                self.areas= areas
-        except Exception as e:
-            log(f"[ERROR] While loading {FILE_NAME}: {e}")
-            self.areas = {}
+    def on_status(self, area, inside, containing): # Engine event: the result of the geofencing check. Just the last one of a burst is shown.
+        self._pending_status = inside
+        self._schedule_render()
+
+    def _schedule_render(self): # However many fixes arrive together, the widgets are redrawn once, when tkinter is idle (and not more often than POSITION_RENDER_MS).
+        if not self._render_scheduled:
+            self._render_scheduled = True
+            wait = self._last_render + configuration.get_float("POSITION_RENDER_MS") / 1000 - time.monotonic()
+            if wait > 0:
+                self.tk_map.after(int(wait * 1000) + 1, self.render_pending)
+            else:
+                self.tk_map.after_idle(self.render_pending)
+
+    def render_pending(self):
+        self._render_scheduled = False
+        self._last_render = time.monotonic()
+        position, self._pending_position = self._pending_position, None
+        inside, self._pending_status = self._pending_status, None
+        if position is not None and self.engine.position is not None: # The position could have been lost meanwhile
+            self.actualize_current_position(*position)
+        if inside is not None and self.engine.monitoring:
+            if inside:
+                self.geofence_status.config(fg= "lightblue", bg= "green", text= "INSIDE THE AREA!")
+            else:
+                self.geofence_status.config(fg= "lightblue", bg= "darkred", text= "OUTSIDE THE AREA!")
 
-    def save_areas_local(self): # Saves the areas in a JSON format.
-        try:
-            data = {name: [list(coord) for coord in coords] for name, coords in self.areas.items()}
-            with open(FILE_NAME, "w") as f:
-                json.dump(data, f, indent=2)
-        except Exception as e:
-            log(f"[ERROR] While saving information in {FILE_NAME}: {e}")
+
+
+    def load_areas_local(self): # Loads the areas JSON to the engine
+        self.engine.set_areas(self.repository.load())
+
+    def save_areas_local(self): # Saves the areas in a JSON format. Nothing is written if no area has changed, and the write waits a moment to group the changes.
+        self.repository.save()
+        self.engine.sync_index() # Just the areas that have changed are rebuilt
 
     def clean_interface(self):
         self.clear_polygon()
@@ -183,7 +227,7 @@ class GeofenceLogic: # We define everything inside a class, because it will be i
         else: # The UI is in delete mode, so every area is selected should be removed.
             answer= mbox.askyesno("Delete Selection", f"Are you sure you want to delete -{name}-?")
             if answer:
-                self.areas.pop(name)
+                self.engine.remove_area(name)
                 self.area_list.delete(selected_index)
                 log(f"[INFO] The user has deleted the area {name}")
             else:
@@ -203,6 +247,7 @@ class GeofenceLogic: # We define everything inside a class, because it will be i
 
 
             self.clean_interface()
+            self.session= EditSession()
             self.area_list.select_clear(0, tk.END)
             self.area_name.insert(0, "New area")
             self.save_add_button.config(text="Save")
@@ -219,13 +264,15 @@ class GeofenceLogic: # We define everything inside a class, because it will be i
                 return
 
             if self.edit_name: # If you were editing an existent area...
-                base = [p for p in self.areas[self.edit_name] if p not in self.deleted_markers] # Saves the area without edits.
-                final_coords = base + self.new_markers # Combines the base with the markers added to the map.
+                final_coords = self.edited_points() # The original area without the removed points, and the new ones where they fit.
                 
                 if len(final_coords) < 3:
                     log(f"[WARNING] While saving an area: the area must have at least 3 points!")
                     mbox.showwarning("Invalid Area", "The area must have at least 3 points!")
                     return
+                final_coords = self.checked_ring(final_coords)
+                if final_coords is None:
+                    return
 
                 if name != self.edit_name:
                     if name in self.areas:
@@ -233,12 +280,12 @@ class GeofenceLogic: # We define everything inside a class, because it will be i
                         mbox.showwarning("Rename Area", f"The area -{name}- already exists!")
                         return
                     #  Here, we rename it by removing the previous one and saving the new one.
-                    self.areas.pop(self.edit_name, None)
-                    self.areas[name] = final_coords
+                    self.engine.remove_area(self.edit_name)
+                    self.engine.set_area(name, final_coords)
                     log(f"[INFO] The user has renamed the area -{self.edit_name}- to -{name}-.")
                 else:
                     # Just actualize coords.
-                    self.areas[name] = final_coords
+                    self.engine.set_area(name, final_coords)
                     log(f"[INFO] The user has eddited the area -{name}-.")
                 area_to_select = name
 
@@ -247,8 +294,7 @@ class GeofenceLogic: # We define everything inside a class, because it will be i
                 self.clean_interface()
                 self.area_name.config(state=tk.DISABLED)
                 self.area_list.config(state=tk.NORMAL)
-                self.new_markers = []
-                self.deleted_markers = []
+                self.session = None
                 self.edit_name = None
                 self.adding = False
                 self.geofence_button.config(state=tk.NORMAL)
@@ -260,12 +306,15 @@ class GeofenceLogic: # We define everything inside a class, because it will be i
                     mbox.showwarning("Add A New Area", f"The name '{name}' already exists. Choose another one.")
                     return 
 
-                if len(self.new_markers) < 3:
+                if self.session is None or len(self.session) < 3:
                     log(f"[WARNING] While creating a new area: the area must have at least 3 points!")
                     mbox.showwarning("Invalid Area", "An area must have at least three valid points.")
                     return
 
-                self.areas[name] = self.new_markers[:]
+                final_coords = self.checked_ring(self.edited_points())
+                if final_coords is None:
+                    return
+                self.engine.set_area(name, final_coords)
                 self.area_list.insert(tk.END, name)
                 self.area_list.selection_clear(0, tk.END)
 
@@ -279,7 +328,7 @@ class GeofenceLogic: # We define everything inside a class, because it will be i
                 self.area_name.config(state=tk.DISABLED)
                 self.area_list.config(state=tk.NORMAL)
                 self.area_list.selection_set(0)
-                self.new_markers = []
+                self.session = None
                 self.adding = False
                 self.geofence_button.config(state=tk.NORMAL)
 
@@ -288,7 +337,7 @@ class GeofenceLogic: # We define everything inside a class, because it will be i
             if answer:
                 self.area_list.delete(0, tk.END)
                 log("[INFO] The user has deleted all the areas.")
-                self.areas= {}
+                self.engine.clear_areas()
             self.geofence_button.config(state=tk.NORMAL)
             self.save_add_button.config(text= "Add")
             self.delete_button.config(text= "Delete")
@@ -336,8 +385,7 @@ class GeofenceLogic: # We define everything inside a class, because it will be i
             self.edit_name = None
             return
 
-        self.original_area_coords = list(self.areas[self.edit_name])
-        self.deleted_markers = []
+        self.session = EditSession(self.areas[self.edit_name])
 
         text = self.area_points.get("1.0", tk.END)
         coords = self.string_to_coords(text)
@@ -391,8 +439,7 @@ class GeofenceLogic: # We define everything inside a class, because it will be i
 
                 
                 # We initialize the temporal values
-                self.new_markers = []
-                self.deleted_markers = []
+                self.session = None
                 self.edit_name = None
                 self.adding = False
 
@@ -405,48 +452,67 @@ class GeofenceLogic: # We define everything inside a class, because it will be i
         self.adding= False
 
 
+    def edited_points(self): # The points of the area being created or edited, in the order of its edge.
+        return self.session.points() if self.session is not None else []
+
+    def add_edit_point(self, point): # A marker added on the map. It splits the edge of the area it's nearest to. Returns False if it isn't added.
+        if self.session is None or not self.session.add(point):
+            return False
+        self.request_polygon_redraw()
+        return True
+
+    def request_polygon_redraw(self): # Many markers added or removed in the same frame are drawn just once.
+        if not self._redraw_scheduled:
+            self._redraw_scheduled = True
+            self.tk_map.after(REDRAW_INTERVAL_MS, self.actualize_polygon)
+
+    def checked_ring(self, points): # The ring that will be stored, or None (warning the user) if the points aren't a valid area.
+        try:
+            return canonical_ring(points, sort_if_invalid= True) # If the edges cross, the markers are taken as unordered
+        except ValueError as e:
+            log(f"[WARNING] While saving an area: the area is not valid, {e}!")
+            mbox.showwarning("Invalid Area", f"The area is not valid: {e}.")
+            return None
+
     def clear_polygon(self): # We remove the area
         if self.polygon:
             self.polygon.delete()
             self.polygon = None
+        self.polygon_name = None
 
 
     def set_polygon(self, name, color= "blue", out_color= "black", border_with= 2): # We put an area on the map
         self.clear_polygon()
-        ordered_coords = order_points_for_polygon(self.areas[name])
         self.polygon= self.tk_map.set_polygon(
-            ordered_coords, 
+            self.engine.ring(name), 
             name= name,
             fill_color=color, 
             outline_color=out_color, 
             border_width=border_with
             )
+        self.polygon_name= name
         
     def actualize_polygon(self, color="blue", out_color="black", border_with=2, name=""):
-        if self.edit_name: # If we were editing an existent area
-            # Action: orginal area - removed points + new points
-            base = [p for p in self.areas[self.edit_name] if p not in self.deleted_markers]
-            combined = base + self.new_markers
-            if len(combined) >= 3:
-                ordered = order_points_for_polygon(combined)
-                self.clear_polygon()
-                self.polygon = self.tk_map.set_polygon(ordered, name=self.edit_name, fill_color=color, outline_color=out_color, border_width=border_with)
-            else:
-                self.clear_polygon()
+        # Action: orginal area - removed points + new points (or just the new points, if we were creating a new area)
+        self._redraw_scheduled = False
+        if self.session is None: # The edition ended before the redraw
+            return
+        points = self.edited_points()
+        if len(points) < 3:
+            self.clear_polygon()
+        elif self.polygon is not None and not self.polygon.deleted: # The same polygon is moved, instead of deleting and creating it again
+            self.polygon.position_list = points
+            self.polygon.draw()
+            self.polygon_name = None # It isn't a stored area anymore
         else:
-            # We were creating a new area
-            if len(self.new_markers) >= 3:
-                ordered = order_points_for_polygon(self.new_markers)
-                self.clear_polygon()
-                self.polygon = self.tk_map.set_polygon(ordered, name=name, fill_color=color, outline_color=out_color, border_width=border_with)
-            else:
-                self.clear_polygon()
+            self.polygon = self.tk_map.set_polygon(points, name=self.edit_name or name, fill_color=color, outline_color=out_color, border_width=border_with)
 
                 
     def clear_marker(self): # Removes the position marker
         if self.pos_marker:
             self.pos_marker.delete()
             self.pos_marker= None
+        self._marker_pixel= None
     
     def remove_map_marker(self, marker): # Removes any marker on the map, it happens when you click on them
         if not self.edit_name and not self.adding:
@@ -455,36 +521,34 @@ class GeofenceLogic: # We define everything inside a class, because it will be i
         ans = mbox.askyesno("Remove Marker", "Are you sure you want to remove this marker?")
         if ans:
             lat, lon = marker.position
-            marker_coords = (lat, lon)
-            
-            # If it is a marker added while editing:
-            if marker_coords in self.new_markers:
-                self.new_markers.remove(marker_coords)
-            # If it is a marker of the original area:
-            elif self.edit_name and marker_coords in self.areas.get(self.edit_name, []):
-                # We just add it to the removed points intead of removing it from the original area 
-                if marker_coords not in self.deleted_markers:
-                    self.deleted_markers.append(marker_coords)
-            else:
+            # The point is removed from the edit session, the stored area doesn't change until it's saved
+            if self.session is None or not self.session.remove((lat, lon)):
                 return
 
             marker.delete()
-            self.actualize_polygon()
+            self.request_polygon_redraw()
 
 
     def create_marker(self, lat, lon, text= "Current Position", text_color= configuration["MARKER_POSITION_COLOR_TEXT"], marker_color_outside= configuration["MARKER_POSITION_COLOR_OUTSIDE"], marker_color_circle= configuration["MARKER_POSITION_COLOR_CIRCLE"]):
+        # The marker is created once and then moved, just when the position has moved at least a pixel at the current zoom.
         if lat is None or lon is None:
             self.clear_marker()
             return
-        self.clear_marker()
-        self.pos_marker = self.tk_map.set_marker(lat, lon, text, text_color= text_color, marker_color_outside= marker_color_outside, marker_color_circle= marker_color_circle)
+        zoom = self.tk_map.zoom
+        x, y = decimal_to_osm(lat, lon, zoom)
+        pixel = (zoom, x * TILE_SIZE, y * TILE_SIZE)
+        if self.pos_marker is None or self.pos_marker.deleted: # It's also deleted when the markers of the areas are cleared
+            self.pos_marker = self.tk_map.set_marker(lat, lon, text, text_color= text_color, marker_color_outside= marker_color_outside, marker_color_circle= marker_color_circle)
+        elif self._marker_pixel is None or self._marker_pixel[0] != zoom or abs(pixel[1] - self._marker_pixel[1]) >= 1 or abs(pixel[2] - self._marker_pixel[2]) >= 1:
+            self.pos_marker.set_position(lat, lon)
+        else:
+            return
+        self._marker_pixel = pixel
 
 
     def geofencing_function(self): # Blocks every action the user can do, except canceling this function 
-        if self.geofence_button.cget("text")== "Start":
-            lat_text = self.ui_lat.cget("text")
-            lon_text = self.ui_lon.cget("text")
-            if not lat_text or not lon_text:
+        if not self.engine.monitoring:
+            if self.engine.position is None:
                 log(f"[WARNING] While starting the geofencing application: cannot start without a fixed position!")
                 mbox.showwarning("Start Geofencing Aplication", "You cannot start the aplication without a fixed position!")
                 return
@@ -492,23 +556,17 @@ class GeofenceLogic: # We define everything inside a class, because it will be i
                 log(f"[WARNING] While starting the geofencing application: cannot start without a valid area!")
                 mbox.showwarning("Start Geofencing Aplication", "You cannot start the aplication without an area!")
                 return
-            self.geofence_button.config(text= "Stop")
-            self.area_name.config(state= tk.DISABLED)
-            self.area_points.config(state= tk.DISABLED)
-            self.area_list.config(state= tk.DISABLED)
-            self.edit_button.config(state= tk.DISABLED)
-            self.save_add_button.config(state= tk.DISABLED)
-            self.delete_button.config(state= tk.DISABLED)
-            log(f"[INFO] Starting geofencing function...")
+            self.engine.start_monitoring(self.polygon_name) # The widgets are blocked by on_monitoring
                     
         else:
-            self.geofence_button.config(text= "Start")
-            self.area_list.config(state= tk.NORMAL)
-            self.edit_button.config(state= tk.NORMAL)
-            self.save_add_button.config(state= tk.NORMAL)
-            self.delete_button.config(state= tk.NORMAL)
-            self.geofence_status.config(fg= "black", bg= "grey", text= "Start the application")
-            log(f"[INFO] Stopping geofencing function...")
+            self.engine.stop_monitoring()
+
+
+    def is_inside_selected_area(self, lat, lon): # The geofencing check against the area drawn on the map. Uses the cached geometry, so it's just one prepared test.
+        return self.engine.is_inside(self.polygon_name, lat, lon)
+
+    def areas_containing(self, lat, lon): # Every stored area that contains the position, not just the one drawn on the map.
+        return self.engine.areas_containing(lat, lon)
 
 
     def actualize_current_position(self, lat, lon): # Updates the current position
@@ -518,7 +576,6 @@ class GeofenceLogic: # We define everything inside a class, because it will be i
             self.ui_lon.config(text=str(lon))
             self.center_button.config(state=tk.NORMAL)
             self.create_marker(lat, lon)
-            self.last_position_time = time.time()
         else:
             self.clear_marker()
             self.center_button.config(state=tk.DISABLED)
@@ -526,10 +583,7 @@ class GeofenceLogic: # We define everything inside a class, because it will be i
 
     def center_view(self): # Centers the view to the current position.
         try:
-            lat_text = self.ui_lat.cget("text")
-            lon_text = self.ui_lon.cget("text")
-            lat = float(lat_text)
-            lon = float(lon_text)
+            lat, lon = self.engine.position
 
 
             self.tk_map.set_position(lat, lon)
@@ -539,8 +593,34 @@ class GeofenceLogic: # We define everything inside a class, because it will be i
             log(f"[ERROR] Cannot center the view in the actual position: {e}")
             self.center_button.config(state= tk.DISABLED)
 
+    def import_areas_file(self): # Adds every area of a GeoJSON or KML file. They're added in batches, and the list and the file are updated once.
+        path = fdialog.askopenfilename(title="Import Areas", filetypes=AREA_FILE_TYPES)
+        if not path:
+            return
+        try:
+            count = import_areas(path, self.engine, self.repository)
+            log(f"[INFO] The user has imported {count} areas from {path}")
+        except Exception as e:
+            log(f"[ERROR] While importing the areas of {path}: {e}")
+            mbox.showerror("Import Areas", f"The areas couldn't be imported: {e}")
+        finally: # The batches imported before an error are already in the engine, they're saved and shown too
+            self.save_areas_local()
+            self.refresh_area_list()
+
+    def export_areas_file(self): # Writes every area to a GeoJSON or KML file, by the extension chosen.
+        path = fdialog.asksaveasfilename(title="Export Areas", filetypes=AREA_FILE_TYPES, defaultextension=".geojson")
+        if not path:
+            return
+        try:
+            count = write_areas_file(path, ((name, self.areas[name]) for name in self.areas))
+            log(f"[INFO] The user has exported {count} areas to {path}")
+        except Exception as e:
+            log(f"[ERROR] While exporting the areas to {path}: {e}")
+            mbox.showerror("Export Areas", f"The areas couldn't be exported: {e}")
+
     def open_log_file(self): # Action activated by a UI button, opens the log file to the user.
         check_log_file()
+        flush_log() # The messages still in memory are written before opening it
         LOG_FILE= configuration["LOG_FILE"]
         try:
             os.startfile(LOG_FILE)
@@ -550,7 +630,7 @@ class GeofenceLogic: # We define everything inside a class, because it will be i
 
     def open_instructions_file(self): # As the previous one, but with the usage guide
         file_path = configuration["INFO_FILE"]
-        text= f"	---GEOFENCING APPLICATION USAGE GUIDE---\n\nBY LEO SARRIA\n\nThis application allows you to define virtual geographic areas and check, using a GPS receiver and an ESP32 STEAMakers microcontroller, whether your current position is inside or outside those areas.\n\nIn this document, you will see a simple explanation of how to use every function of this interface.\n\n\nAREAS MANAGEMENT:\n\nEach area is composed of the following elements:\n\n· Area name: Will show you the name of the area, or let you enter it when needed\n· Area points list: a non-editable textbox that shows every point an area is made of\n· Areas list: a list with every created area, it is automatically saved in the app file.\n· Delete, add and edit buttons\n\nTo add an area, you must click that button, write a name that is not repeated, and define at least three points. Then, click save. You can cancel the action.\n\nIn order to edit an area, the method is the same, but the name is set (although still editable) as well as some points. When cancelled, the area returns to its last version.\n\nTo delete areas, click the button -Delete-. Then you can click on whichever area you want to remove, and click Accept in the confirmation message. Or remove them all at once.\n\n\nMAP USAGE:\n\nThe map is interactive. When creating or editing an area, you can define points by right-clicking with the mouse, and clicking -Add Marker-. To remove one, just click on it.\nWith the mouse wheel, you can adjust the map scale, and by dragging it, you can move it.\n\nIt's important to understand that the map NEEDS AN INTERNET CONNECTION in order to work.\n\n\nBLUETOOTH AND SATELLITE CONNECTION, POSITION FIX:\n\nThe color indicator shows the state of the Bluetooth connection to the microcontroller or the satellite connection's quality:\n· Dark green: the Bluetooth connection is established and the position is clear\n· Light green: the Bluetooth connection is established and the position is unclear\n· Yellow: the Bluetooth connection is established but there's no position yet\n· Orange: there's no Bluetooth connection and it's searching actively to establish it.\n· Red: the Bluetooth connection search time has ended without success, so it stopped searching for it. you can restart the search by the -Reconnect- button.\n\nOnce there's a position fix, you will see the values in the -Current Position- part. Then you will be able to center the view on the position.\n\n\nGEOFENCING APPLICATION:\n\nTo start it, it needs a position fix and a selected area. It will check if the position is inside the area or not, and update the label consequently.\n\n\nLOG TERMINAL AND LOG FILE:\n\nThe black terminal you can see on the bottom left of the application shows every message that is saved in the log file. You can view it by clicking its respective button.\nIt is saved in the application directory.\n\n\n\nAll areas are saved automatically in a file called -areas.json- in the application folder."
+        text= f"	---GEOFENCING APPLICATION USAGE GUIDE---\n\nBY LEO SARRIA\n\nThis application allows you to define virtual geographic areas and check, using a GPS receiver and an ESP32 STEAMakers microcontroller, whether your current position is inside or outside those areas.\n\nIn this document, you will see a simple explanation of how to use every function of this interface.\n\n\nAREAS MANAGEMENT:\n\nEach area is composed of the following elements:\n\n· Area name: Will show you the name of the area, or let you enter it when needed\n· Area points list: a non-editable textbox that shows every point an area is made of\n· Areas list: a list with every created area, it is automatically saved in the app file.\n· Delete, add and edit buttons\n\nTo add an area, you must click that button, write a name that is not repeated, and define at least three points. Then, click save. You can cancel the action.\n\nIn order to edit an area, the method is the same, but the name is set (although still editable) as well as some points. When cancelled, the area returns to its last version.\n\nTo delete areas, click the button -Delete-. Then you can click on whichever area you want to remove, and click Accept in the confirmation message. Or remove them all at once.\n\nAreas can also be imported from GeoJSON or KML files (for example, thousands of boundaries at once) with the -Import Areas- button, and every area can be exported to those formats with the -Export Areas- button.\n\n\nMAP USAGE:\n\nThe map is interactive. When creating or editing an area, you can define points by right-clicking with the mouse, and clicking -Add Marker-. To remove one, just click on it.\nWith the mouse wheel, you can adjust the map scale, and by dragging it, you can move it.\n\nIt's important to understand that the map NEEDS AN INTERNET CONNECTION in order to work, unless its tiles have been saved before: running -python tile_cache.py prefetch- downloads the map around every stored area (from a tile server that allows it, set in MAP_TILE_SERVER, not the OpenStreetMap one) (and -python tile_cache.py import <file.mbtiles>- imports an existing tile archive), so it also works without connection.\n\n\nBLUETOOTH AND SATELLITE CONNECTION, POSITION FIX:\n\nThe color indicator shows the state of the Bluetooth connection to the microcontroller or the satellite connection's quality:\n· Dark green: the Bluetooth connection is established and the position is clear\n· Light green: the Bluetooth connection is established and the position is unclear\n· Yellow: the Bluetooth connection is established but there's no position yet\n· Orange: there's no Bluetooth connection and it's searching actively to establish it.\n· Red: the Bluetooth connection couldn't be established yet. It keeps searching, each time less often; the -Reconnect- button searches again at once.\n\nOnce there's a position fix, you will see the values in the -Current Position- part. Then you will be able to center the view on the position.\n\n\nGEOFENCING APPLICATION:\n\nTo start it, it needs a position fix and a selected area. It will check if the position is inside the area or not, and update the label consequently.\n\n\nLOG TERMINAL AND LOG FILE:\n\nThe black terminal you can see on the bottom left of the application shows every message that is saved in the log file. You can view it by clicking its respective button.\nIt is saved in the application directory.\n\n\n\nAll areas are saved automatically in a file called -areas.json- in the application folder."
         if not os.path.exists(file_path):
             with open(file_path, "w", encoding="utf-8") as f:
                 f.write(text)
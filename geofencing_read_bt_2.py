@@ -1,67 +1,141 @@
-"""This module takes care of all the Bluetooth connection logic, reading the port, managing reconnections and showing errors."""
+"""This module takes care of all the Bluetooth connection logic, reading the port, managing reconnections and showing errors. The port can be
+found by its name, description or VID:PID (BT_PORT_MATCH), and the connection is retried forever, waiting a bit longer after every failure."""
 
+import random
+import threading
 import serial
-import json
+from serial.tools import list_ports
 import time
 from config_manager import load_config
 from debug_logger_2 import log, actualize_bluetooth_state
+from device_messages import decode_fix, MessageBuffer, BINARY_COMMAND, JSON_COMMAND
 
 
 configuration= load_config()
 
-PORT = configuration["COM_PORT"]
 BAUD = configuration["BAUDRATE"]
+READ_TIMEOUT = 0.5 # Seconds a read waits for the first byte, so the timeouts are noticed soon
 
+_reconnect_now = threading.Event() # Set by the Reconnect button, the next connection attempt starts at once
 
-def read_port(port=PORT, baud=BAUD, callback=None):
-    m= 0
+
+def reconnect_now(): # Makes the reading thread try to connect right now, instead of waiting for its next attempt.
+    _reconnect_now.set()
+
+
+def candidate_ports(port= None, match= None): # The ports to try: the ones whose name, description or VID:PID contain match, then the configured one.
+    port = port if port is not None else configuration.get_str("COM_PORT")
+    match = (match if match is not None else configuration.get_str("BT_PORT_MATCH")).strip().lower()
+    ports = []
+    if match:
+        try:
+            for info in list_ports.comports():
+                texts = [info.device, info.description, info.hwid]
+                if info.vid is not None:
+                    texts.append(f"{info.vid:04x}:{info.pid:04x}")
+                if any(text and match in text.lower() for text in texts):
+                    ports.append(info.device)
+        except Exception as e:
+            log(f"[WARNING] [BLUETOOTH] Cannot list the serial ports: {e}")
+    if port and port not in ports:
+        ports.append(port)
+    return ports
+
+
+def retry_delay(attempt): # Seconds to wait before the next connection attempt: doubles after every failure (with some randomness), up to BT_RETRY_MAX.
+    if attempt == 0:
+        return 0.0
+    delay = min(configuration.get_float("BT_RETRY_MAX"), configuration.get_float("BT_RETRY_MIN") * 2 ** (attempt - 1))
+    return delay * random.uniform(0.5, 1.0) # So many devices (or a device that reboots) don't retry all at the same time
+
+
+def connect(ports, baud): # Opens the first port that works. Returns (serial, port), or (None, error) if none could be opened.
+    error = None
+    for port in ports:
+        try:
+            return serial.Serial(port, baud, timeout= READ_TIMEOUT), port
+        except Exception as e:
+            error = f"{port}: {e}"
+    return None, error or "there's no port to connect to"
+
+
+def read_port(port= None, baud= BAUD, callback= None): # Reads the port forever. port: the port to use when BT_PORT_MATCH finds nothing (COM_PORT by default).
+    attempt= 0 # Failed connection attempts since the last connection
     ser = None
     last= 0
+    buffer= MessageBuffer() # Everything waiting in the port is read at once, and split into messages (JSON lines or binary frames) here
+    state= None # Last satellite state shown, the indicator is only updated when it changes
+    echo= configuration.get_bool("BT_DEBUG_ECHO")
     while True:
         if ser: # If there's a serial connection... the first iteration won't be.
-            m= 0
-            line = ser.readline().decode(errors="ignore").strip() # We get the last line
-            if line: # If there's a new message
+            try:
+                data = ser.read(ser.in_waiting or 1) # Waits (up to the port timeout) for the first byte, then takes everything that has arrived
+            except Exception as e: # The device has been disconnected (e.g. it has restarted), it's connected again at once
+                log(f"[ERROR] [BLUETOOTH] While reading the port: {e} --> Port closed")
+                data = None
+            if data: # If there's a new message
                 last = time.time() # In order of managing the timeout
+                attempt= 0 # The device works, if it's lost it's connected again at once
+            skipped= buffer.skipped
+            for line in buffer.feed(data or b""):
+                if isinstance(line, str): # A JSON line, the binary frames are already complete
+                    line = line.strip()
+                    if not line:
+                        continue
                 try:
-                    msg = json.loads(line)
-                    print(f"[BLUETOOTH] Received the message {msg}") # This should not be log as it is in the normal functioning of the application,
-                        # because the log file would be overloaded. Just for viewing, IT COULD BE REMOVED.
-                    actualize_bluetooth_state(msg["estado"]) # This will indicate the satellite connection state.
-                    if callback:
-                        callback(msg)
-                except json.JSONDecodeError:
-                    log(f"[ERROR] [BLUETOOTH] While decoding this json message: {line}")
+                    fix = decode_fix(line)
+                except ValueError as e:
+                    log(f"[ERROR] [BLUETOOTH] While decoding this message: {line if isinstance(line, str) else line.hex()} ({e})")
+                    continue
+                if echo: # Not in the log, the file would be overloaded. Just for viewing.
+                    print(f"[BLUETOOTH] Received the message {fix}")
+                if fix.estado != state:
+                    state = fix.estado
+                    actualize_bluetooth_state(state) # This will indicate the satellite connection state.
+                if callback:
+                    callback(fix)
+            if buffer.skipped > skipped: # Corrupted bytes between the messages, the reading continues with the next good one
+                log(f"[WARNING] [BLUETOOTH] {buffer.skipped - skipped} corrupted bytes have been skipped")
 
             # This part is important, because if the microcontroler restarts, the connection will still be defined although it's not longer being used.
-            if time.time() - last > configuration["BT_TIMEOUT"]: # If there has been no message for the timeout time established...
-                log("[BLUETOOTH] TIMEOUT: >5 s without messages --> Port closed") # The port closes
+            timeout= time.time() - last > configuration.get_float("BT_TIMEOUT") # If there has been no message for the timeout time established...
+            if timeout:
+                log(f"[BLUETOOTH] TIMEOUT: >{configuration['BT_TIMEOUT']} s without messages --> Port closed") # The port closes
+            if data is None or timeout:
                 actualize_bluetooth_state("CONNECTING")
-                ser.close()
-                ser= None
-                last = time.time()
-                time.sleep(0.2)
-        else:  # If there's no serial connection...
-            if m <= configuration["BT_CONNECTING_CYCLES"]: # The code will try to connect during the cycles given by default
                 try:
-                    if m == 0: # This is the first iteration of searching a connection
-                        log(f"[BLUETOOTH] Starting connection to PORT {port}...")
-                        actualize_bluetooth_state("CONNECTING")
-                    else: # The code has been trying to connect for "m" turns.
-                        log(f"[BLUETOOTH] Trying to reconnect to PORT {port}...") 
-                        actualize_bluetooth_state("CONNECTING")
-                    time.sleep(0.1)
-                    ser= serial.Serial(port, baud, timeout=2) # This make take some seconds, if it cannot connect, it sends an error, so takes the execution to the except section instead of continuing.
-                    log(f"[BLUETOOTH] Connected to {port}") # The connection has been established.
-                    actualize_bluetooth_state("SEARCHING")
-                    last = time.time()
-                except Exception as e:
-                    log(f"[ERROR] While trying to connect to the bluetooth device: {e}") # This usualy means that there's no connection established and the max time has been spend.
-                    actualize_bluetooth_state("CONNECTING")
-                    time.sleep(1)
-                    m+= 1
-            else: # Once the "m" turns has been spend, stops searching connection. Can be reactivated with the Reconnect button.
-                log(f"[WARNING] Couldn't establish connection to PORT {port}. The time finished.")
-                actualize_bluetooth_state("DISCONNECTED")
-                return # Stops the loop
-
+                    ser.close()
+                except Exception:
+                    pass
+                ser= None
+                buffer.clear()
+                state= None
+                attempt+= 1 # Soon if it was sending data, and more and more slowly if a port opens but doesn't work
+        else:  # If there's no serial connection... it never stops trying, but waits more and more between the attempts.
+            if _reconnect_now.wait(retry_delay(attempt)): # The Reconnect button has been pressed
+                _reconnect_now.clear()
+                attempt= 0
+            cycles= configuration.get_int("BT_CONNECTING_CYCLES")
+            ports= candidate_ports(port)
+            if attempt == 0: # This is the first iteration of searching a connection
+                log(f"[BLUETOOTH] Starting connection to {', '.join(ports) or 'any port'}...")
+                actualize_bluetooth_state("CONNECTING")
+            elif attempt <= cycles: # The code has been trying to connect for some turns, then it keeps trying without flooding the log.
+                log(f"[BLUETOOTH] Trying to reconnect to {', '.join(ports) or 'any port'}...")
+            ser, connected = connect(ports, baud)
+            if ser is None:
+                attempt+= 1
+                if attempt <= cycles:
+                    log(f"[ERROR] While trying to connect to the bluetooth device: {connected}") # This usualy means that the device is off or away.
+                if attempt == max(cycles, 1): # Red, the Reconnect button makes it try at once. It keeps trying anyway.
+                    log(f"[WARNING] Couldn't establish connection. It will keep trying every {configuration['BT_RETRY_MAX']} s at most.")
+                    actualize_bluetooth_state("DISCONNECTED")
+                continue
+            try:
+                ser.write(BINARY_COMMAND if configuration["BT_FORMAT"] == "binary" else JSON_COMMAND) # Both are read anyway, an old firmware ignores it
+            except Exception as e:
+                log(f"[WARNING] [BLUETOOTH] Cannot send the message format to the device: {e}")
+            log(f"[BLUETOOTH] Connected to {connected}") # The connection has been established.
+            actualize_bluetooth_state("SEARCHING")
+            state= "SEARCHING"
+            last = time.time()
@@ -5,38 +5,34 @@ import tkinter as tk
 import tkintermapview as tkmap
 from geofencing_logic_V5 import GeofenceLogic
 import threading
-from time import sleep
+import os
 from config_manager import load_config
-from geofencing_read_bt_2 import read_port
-from is_inside_area_function_2 import is_inside_area
-from debug_logger_2 import log, start_log_tailer, set_bluetooth_label, set_reconnect_button
+from geofencing_read_bt_2 import read_port, reconnect_now
+from fix_queue import FixQueue
+from tile_cache import open_tile_cache
+from debug_logger_2 import log, attach_terminal, start_log_tailer, set_bluetooth_label, set_reconnect_button, apply_bluetooth_state
 
 configuration= load_config()
 
-def start_bt_thread(geofence: GeofenceLogic): # It starts the port reading as a secondary thread.
+fix_queue= FixQueue(configuration.get_int("FIX_QUEUE_SIZE")) # The Bluetooth thread puts the messages here, the mainloop takes them
+
+def start_bt_thread(geofence: GeofenceLogic): # It starts the port reading as a secondary thread. It doesn't touch any widget, just the queue.
     def loop():
-        read_port(callback=lambda msg: execute_action(msg, geofence))
+        read_port(callback=fix_queue.put)
     threading.Thread(target=loop, daemon=True).start()
 
+def drain_fixes(geofence: GeofenceLogic): # Runs in the mainloop at a fixed rate. Every message is checked, but the map is redrawn once per batch.
+    for msg in fix_queue.drain():
+        execute_action(msg, geofence)
+    dropped = fix_queue.take_dropped()
+    if dropped:
+        log(f"[WARNING] [BLUETOOTH] {dropped} messages have been dropped, the UI couldn't keep up with the device!")
+    apply_bluetooth_state() # The Bluetooth thread just keeps the last state, it's shown here
+    Geofence.after(configuration.get_int("UI_REFRESH_MS"), lambda: drain_fixes(geofence))
+
 def execute_action(msg, geofence: GeofenceLogic): # It actualizes the current position and checks the geofencing function if activated.
     try:
-        lat = msg.get("lat")
-        lon = msg.get("lon")
-        state= msg.get("estado")
-        if lat is not None and lon is not None:
-            if not state == "SEARCHING": # Cannot give a position if there's no fix
-                geofence.create_marker(lat= lat, lon= lon)
-                geofence.actualize_current_position(lat= lat, lon= lon)
-
-                if geofence.geofence_button.cget("text")== "Stop" and geofence.polygon: # If the geofencing function is activated.
-                    inside = is_inside_area(lat, lon, geofence.polygon.position_list)
-                    if inside:
-                        log(f"[INFO] The positioning device is inside the area!")
-                        logic.geofence_status.config(fg= "lightblue", bg= "green", text= "INSIDE THE AREA!")
-                    else:
-                        log(f"[INFO] The positioning device is NOT inside the area!")
-                        logic.geofence_status.config(fg= "lightblue", bg= "darkred", text= "OUTSIDE THE AREA!")
-
+        geofence.engine.process_message(msg) # The engine notifies the widgets through the events GeofenceLogic is subscribed to
     except Exception as e:
         log(f"[ERROR] While executing execute_action: {e}")
 
@@ -98,8 +94,10 @@ edit_button.config(state= tk.DISABLED)
 info_button = tk.Button(frame_left, text= "Info", bg= "lightyellow", border= 3)
 info_button.grid(row= 4, column= 1, padx= 5, pady= 5, sticky= "ew")
 
-lab_x= tk.Label(frame_left, text= "")
-lab_x.grid(row= 5, column= 0)
+import_button = tk.Button(frame_left, text= "Import Areas")
+import_button.grid(row= 5, column= 0, padx= 5, pady= 5, sticky= "ew")
+export_button = tk.Button(frame_left, text= "Export Areas")
+export_button.grid(row= 5, column= 1, padx= 5, pady= 5, sticky= "ew")
 lab_3= tk.Label(frame_left, text= "Logs Terminal:")
 lab_3.grid(row= 6, column= 0, sticky= "s")
 log_button= tk.Button(frame_left, text= "Log File")
@@ -109,7 +107,10 @@ log_button.grid(row= 6, column= 1, sticky= "s", padx= 3)
 
 # Right Side
 # Map
-Map = tkmap.TkinterMapView(frame_right)
+open_tile_cache().close() # Creates the tile cache if it doesn't exist, the map reads the tiles from there before downloading them
+Map = tkmap.TkinterMapView(frame_right, database_path= os.path.abspath(configuration["MAP_TILE_DB"]), use_database_only= configuration.get_bool("MAP_OFFLINE_ONLY"),
+                           max_zoom= configuration.get_int("MAP_MAX_ZOOM"))
+Map.set_tile_server(configuration["MAP_TILE_SERVER"], max_zoom= configuration.get_int("MAP_MAX_ZOOM"))
 Map.grid(row=1, column=0, padx=5, pady=5, sticky="nsew")
 Map.set_position(41, 2)
 
@@ -173,17 +174,13 @@ logic= GeofenceLogic(area_name= area_name, area_points= area_points, area_list=
 set_bluetooth_label(logic.connection_status)
 set_reconnect_button(reconnect_button)
 
-def reconnect_bluetooth():
+def reconnect_bluetooth(): # The reading thread never stops, this makes it try to connect now instead of waiting for its next attempt
     logic.reconnect_button.config(state= tk.DISABLED)
-    Geofence.after(3000, lambda: start_bt_thread(logic))
+    reconnect_now()
 
 def add_marker_event(coords):
-    if logic.edit_name or logic.adding:
+    if (logic.edit_name or logic.adding) and logic.add_edit_point(coords):
         __ = Map.set_marker(coords[0], coords[1], text="", marker_color_outside= configuration["MARKER_COLOR_OUTSIDE"], marker_color_circle= configuration["MARKER_COLOR_CIRCLE"], command= logic.remove_map_marker) # We create markers that'll remove when clicked
-        logic.new_markers.append(coords)
-        logic.actualize_polygon()
-    else:
-        logic.new_markers= []
 
 Map.add_right_click_menu_command(label="Add Marker",
                                         command=add_marker_event,
@@ -199,6 +196,8 @@ center_button.config(command= logic.center_view)
 reconnect_button.config(command= reconnect_bluetooth)
 log_button.config(command= logic.open_log_file)
 info_button.config(command= logic.open_instructions_file)
+import_button.config(command= logic.import_areas_file)
+export_button.config(command= logic.export_areas_file)
 
 
 
@@ -206,13 +205,17 @@ Map.bind("<Button>", on_map_click)
 
 logic.refresh_area_list()
 
-start_log_tailer(Geofence, terminal) # Starts the built-in terminal logic
-sleep(0.1)
+attach_terminal(Geofence, terminal) # Starts the built-in terminal logic, it receives every log message
+if configuration.get("LOG_TAIL_FILE"): # It can also show an external log file
+    start_log_tailer(Geofence, terminal, configuration["LOG_TAIL_FILE"])
 
 log("\n\n[INFO] Application Started!\n")
 
 
-# start_bt_thread(logic) --> Sometimes didn't open the principal window, so this fixes it.
-Geofence.after(3000, lambda: start_bt_thread(logic))
+drain_fixes(logic) # Starts taking the received messages from the queue
+
+# start_bt_thread(logic) --> Sometimes didn't open the principal window (the thread used the widgets before the mainloop), so it starts
+# as soon as the mainloop is running.
+Geofence.after_idle(lambda: start_bt_thread(logic))
 
 Geofence.mainloop()
\ No newline at end of file
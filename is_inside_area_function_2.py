@@ -1,9 +1,22 @@
-"""This module just defines the geofencing function and helps with the creation of the areas."""
+"""This module just defines the geofencing function and helps with the creation of the areas. It also keeps a cache of the prepared
+geometries of every area, so the polygon isn't rebuilt for every position fix, and a batch version of the function for whole tracks."""
 
-from shapely.geometry import Point, Polygon
+from shapely.geometry import LineString, Point, Polygon
+import numpy as np
 import math
 
-def order_points_for_polygon(points):
+try: # Shapely 2 prepares the geometry in place and can test raw coordinates, older versions wrap it in a prepared object.
+    from shapely import prepare as _prepare, contains_xy as _contains_xy
+except ImportError:
+    from shapely.prepared import prep as _prep
+    _prepare = None
+    _contains_xy = None
+
+MIN_AREA_POINTS = 3 # An area needs at least three points
+
+
+def order_points_for_polygon(points): # Sorts the points by their angle around the center. Just for unordered points (e.g. markers put anywhere),
+    # as it changes the shape of the areas that aren't star-shaped. The stored areas are already in order, see canonical_ring().
     if len(points) < 3:
         return points
     
@@ -18,9 +31,165 @@ def order_points_for_polygon(points):
 
 
 
-def is_inside_area(lat, lon, area_coords): # Area coords has the format [(lat1, lon1), (lat2, lon2), ...] at least 3 tuples. This is the geofencing function
-    ordered_coords = order_points_for_polygon(area_coords)
+def _clean_ring(points): # [(lat, lon), ...] without repeated consecutive points, nor the last point repeating the first one
+    ring = []
+    for point in points:
+        point = (float(point[0]), float(point[1]))
+        if not ring or point != ring[-1]:
+            ring.append(point)
+    if len(ring) > 1 and ring[0] == ring[-1]:
+        ring.pop()
+    return ring
+
+
+def _signed_area(ring): # Shoelace formula with (lon, lat). Positive when the points go counter-clockwise.
+    total = 0.0
+    previous_lat, previous_lon = ring[-1]
+    for lat, lon in ring:
+        total += previous_lon * lat - lon * previous_lat
+        previous_lat, previous_lon = lat, lon
+    return total / 2
+
+
+def ring_problem(points): # Why the points, in this order, can't be the edge of an area. None if they can.
+    ring = _clean_ring(points)
+    if len(ring) < MIN_AREA_POINTS:
+        return "it has less than three different points"
+    if Polygon([(lon, lat) for lat, lon in ring]).is_valid:
+        return None
+    (lat0, lon0), (lat1, lon1) = ring[0], ring[1]
+    if all((lat1 - lat0) * (lon - lon0) == (lon1 - lon0) * (lat - lat0) for lat, lon in ring[2:]):
+        return "all its points are aligned"
+    return "its edges cross each other"
+
+
+def canonical_ring(points, sort_if_invalid= False): # The form every area is stored with: [(lat, lon), ...] in the order of its edge,
+    # counter-clockwise and starting at its lowest point. Raises ValueError if it isn't a valid area. With sort_if_invalid, points that
+    # aren't in order are sorted around the center (the areas of the previous versions were drawn like that).
+    ring = _clean_ring(points)
+    problem = ring_problem(ring)
+    if problem is not None and sort_if_invalid:
+        ring = _clean_ring(order_points_for_polygon(ring))
+        problem = ring_problem(ring)
+    if problem is not None:
+        raise ValueError(problem)
+    if _signed_area(ring) < 0:
+        ring.reverse()
+    start = ring.index(min(ring))
+    return ring[start:] + ring[:start]
+
+
+def is_inside_area(lat, lon, area_coords, sort_points= False): # Area coords has the format [(lat1, lon1), (lat2, lon2), ...] at least 3 tuples. This is the geofencing function
+    # The points must be in the order of the edge (as the areas are stored). sort_points sorts them first, for unordered points.
+    ordered_coords = order_points_for_polygon(area_coords) if sort_points else area_coords
     punto = Point(lon, lat)  # Shapely uses (lon, lat), not (lat, lon)
     poligono_coords = [(lon_, lat_) for lat_, lon_ in ordered_coords] # Another time, as Shapely uses (lon, lat), all the structure changes
     poligono = Polygon(poligono_coords)
-    return poligono.contains(punto)
\ No newline at end of file
+    return poligono.contains(punto)
+
+
+def prepare_polygon(polygon): # Returns an object with a fast contains() method, whatever the Shapely version is.
+    if _prepare is None:
+        return _prep(polygon)
+    _prepare(polygon)
+    return polygon
+
+
+METERS_PER_DEGREE_LAT = 111320.0 # Approximately, enough for distances inside an area
+
+
+class AreaGeometry: # Everything the geofencing function needs from an area, computed just once.
+    __slots__ = ("ring", "polygon", "prepared", "_metric")
+
+    def __init__(self, area_coords):
+        self.ring = [tuple(point) for point in area_coords] # [(lat, lon), ...] as stored, shared by the map and the geofencing check
+        self.polygon = Polygon([(lon, lat) for lat, lon in self.ring]) # Shapely uses (lon, lat)
+        self.prepared = prepare_polygon(self.polygon)
+        self._metric = None # The boundary in meters (longitudes not scaled yet), built the first time a distance is needed
+
+    def contains(self, lat, lon):
+        if _contains_xy is not None:
+            return bool(_contains_xy(self.prepared, lon, lat))
+        return self.prepared.contains(Point(lon, lat))
+
+    def distance_to_boundary(self, lat, lon): # Distance in meters from the position to the nearest edge of the area (inside or outside).
+        # The area is projected to a local plane (equirectangular) centred on the position, the same plane the geofencing engine uses to
+        # measure how far the device has moved. Around the centroid instead, tall areas far from the equator would give longer distances.
+        if self._metric is None:
+            self._metric = np.array([(lon_, lat_) for lat_, lon_ in self.ring + self.ring[:1]]) * METERS_PER_DEGREE_LAT
+        scale_lon = math.cos(math.radians(lat))
+        boundary = LineString(self._metric * (scale_lon, 1.0))
+        return boundary.distance(Point(lon * METERS_PER_DEGREE_LAT * scale_lon, lat * METERS_PER_DEGREE_LAT))
+
+
+class AreaGeometryCache: # Keeps the geometry of every area by its name and version. The version changes whenever the area is edited or removed.
+    def __init__(self):
+        self._versions = {}
+        self._entries = {} # name -> (version, AreaGeometry)
+        self.changes = 0 # Number of invalidations, to know quickly if anything has changed
+
+    def version(self, name):
+        return self._versions.get(name, 0)
+
+    def invalidate(self, name= None): # Called when an area changes. Without name, every area is invalidated (e.g. when all of them are deleted).
+        names = list(self._versions.keys() | self._entries.keys()) if name is None else [name]
+        self.changes += 1
+        for key in names:
+            self._versions[key] = self._versions.get(key, 0) + 1
+            self._entries.pop(key, None)
+
+    def get(self, name, area_coords): # Returns the cached geometry, building it only if the area has changed since the last time.
+        version = self._versions.get(name, 0)
+        entry = self._entries.get(name)
+        if entry is not None and entry[0] == version:
+            return entry[1]
+        geometry = AreaGeometry(area_coords)
+        self._entries[name] = (version, geometry)
+        return geometry
+
+    def contains(self, name, area_coords, lat, lon): # The cached equivalent of is_inside_area()
+        return self.get(name, area_coords).contains(lat, lon)
+
+
+def _ray_casting(ring, lats, lons): # NumPy version of the even-odd rule, for Shapely versions without contains_xy. Points on the edges may go either way.
+    inside = np.zeros(lats.shape, dtype=bool)
+    previous_lat, previous_lon = ring[-1]
+    for lat, lon in ring:
+        crosses = (lat > lats) != (previous_lat > lats)
+        if crosses.any():
+            edge_lon = lon + (lats[crosses] - lat) * (previous_lon - lon) / (previous_lat - lat)
+            inside[crosses] ^= lons[crosses] < edge_lon
+        previous_lat, previous_lon = lat, lon
+    return inside
+
+
+def is_inside_area_batch(lats, lons, areas, geometry_cache= None): # Batch version of is_inside_area, for whole recorded tracks.
+    # lats and lons are arrays (or lists) with the same length. areas can be the coords of one area, a list of them or a dictionary
+    # {name: coords}. Returns a boolean matrix with one row per position and one column per area (in the same order they're given).
+    lats = np.asarray(lats, dtype=float).ravel()
+    lons = np.asarray(lons, dtype=float).ravel()
+    if lats.shape != lons.shape:
+        raise ValueError("lats and lons must have the same length")
+
+    if isinstance(areas, dict):
+        items = list(areas.items())
+    elif len(areas) and np.ndim(areas[0]) == 1: # Just one area, [(lat, lon), ...] (or an (N, 2) array)
+        items = [(None, areas)]
+    else:
+        items = [(None, coords) for coords in areas]
+
+    result = np.zeros((lats.size, len(items)), dtype=bool)
+    for column, (name, coords) in enumerate(items):
+        if geometry_cache is not None and name is not None:
+            geometry = geometry_cache.get(name, coords)
+        else:
+            geometry = AreaGeometry(coords)
+        min_lon, min_lat, max_lon, max_lat = geometry.polygon.bounds
+        candidates = np.flatnonzero((lats >= min_lat) & (lats <= max_lat) & (lons >= min_lon) & (lons <= max_lon)) # Cheap bounding box filter first
+        if candidates.size == 0:
+            continue
+        if _contains_xy is not None:
+            result[candidates, column] = _contains_xy(geometry.prepared, lons[candidates], lats[candidates])
+        else:
+            result[candidates, column] = _ray_casting(geometry.ring, lats[candidates], lons[candidates])
+    return result
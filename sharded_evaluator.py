@@ -0,0 +1,150 @@
+"""This module checks the fixes of many devices against many areas in several processes, so the work isn't limited to one core by the GIL.
+Every worker process keeps a spatial index with prepared geometries: on Linux the workers are forked after the index is built, so they
+inherit it without copying anything, elsewhere the areas are sent once to every worker when it starts. The fixes are sent in micro-batches
+(NumPy arrays), and the workers answer with (fix, area) pairs. The areas can be split between the workers ("areas", every batch goes to
+all of them) or the devices ("devices", every worker has all the areas and gets the fixes of some devices, always the same ones)."""
+
+import itertools
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import shapely
+from shapely import STRtree
+from is_inside_area_function_2 import AreaGeometry
+
+BATCH_SIZE = 2048 # Fixes sent to a worker at once: bigger batches have less overhead, smaller ones less latency
+SHARD_MODES = ("devices", "areas")
+
+_shards = {} # key -> _Shard, built before forking the workers (they inherit it), or by the worker itself
+_new_keys = itertools.count()
+_OUTSIDE = frozenset()
+
+
+class _Shard: # The areas a worker checks: a tree of their bounding boxes and their prepared polygons
+    def __init__(self, area_ids, rings):
+        self.area_ids = np.asarray(area_ids, dtype= np.int64) # Position in the tree -> number of the area in the evaluator
+        self.polygons = np.array([AreaGeometry(ring).polygon for ring in rings], dtype= object) # Prepared by AreaGeometry
+        self.tree = STRtree(self.polygons) if len(self.polygons) else None
+
+    def containing(self, lats, lons): # (fix numbers, area numbers) of every fix inside an area
+        if self.tree is None or not len(lats):
+            empty = np.empty(0, dtype= np.int64)
+            return empty, empty
+        fixes, areas = self.tree.query(shapely.points(lons, lats)) # Every fix inside a bounding box, with the box
+        inside = shapely.contains_xy(self.polygons[areas], lons[fixes], lats[fixes]) # The exact test of every pair, in one call
+        return fixes[inside], self.area_ids[areas[inside]]
+
+
+def _start_worker(key, area_ids= None, rings= None): # Runs in every new worker. With fork, the shard is already there.
+    if key not in _shards:
+        _shards[key] = _Shard(area_ids, rings)
+
+
+def _check_batch(key, lats, lons): # Runs in a worker
+    return _shards[key].containing(lats, lons)
+
+
+class ShardedEvaluator:
+    def __init__(self, areas, workers= None, shard= "devices", batch_size= BATCH_SIZE):
+        # areas: {name: ring}, the rings as stored (see canonical_ring). workers: processes, all the cores by default (0: no processes,
+        # everything in this one, to compare). Changes to the areas need a new evaluator.
+        if shard not in SHARD_MODES:
+            raise ValueError(f"Unknown shard mode: {shard}")
+        self.names = list(areas)
+        self.shard = shard
+        self.batch_size = batch_size
+        self.workers = workers if workers is not None else os.cpu_count() or 1
+        rings = [areas[name] for name in self.names]
+        shards = max(self.workers, 1)
+        if shard == "areas":
+            parts = [list(range(n, len(rings), shards)) for n in range(shards)]
+        else:
+            parts = [list(range(len(rings)))] * shards
+        fork = "fork" in multiprocessing.get_all_start_methods()
+        self._keys = []
+        self._executors = []
+        built = {} # With device shards every worker has the same areas, built just once
+        for part in parts:
+            key = f"{os.getpid()}-{next(_new_keys)}"
+            self._keys.append(key)
+            if fork or not self.workers:
+                part_key = tuple(part) if shard == "areas" else None
+                if part_key not in built:
+                    built[part_key] = _Shard(part, [rings[n] for n in part])
+                _shards[key] = built[part_key]
+            if not self.workers:
+                continue
+            if fork: # One process per shard, so the fixes of a device (or the areas of a shard) always go to the same one
+                executor = ProcessPoolExecutor(1, multiprocessing.get_context("fork"), _start_worker, (key,))
+            else:
+                executor = ProcessPoolExecutor(1, None, _start_worker, (key, part, [rings[n] for n in part]))
+            self._executors.append(executor)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        for executor in self._executors:
+            executor.shutdown(cancel_futures= True)
+        self._executors = []
+        for key in self._keys:
+            _shards.pop(key, None)
+
+    def start(self): # Starts every worker now, instead of with the first batch (so the first fixes don't wait for it).
+        for future in [executor.submit(len, ()) for executor in self._executors]:
+            future.result()
+
+    def _submit(self, shard, lats, lons):
+        if not self.workers:
+            return _Done(_shards[self._keys[shard]].containing(lats, lons))
+        return self._executors[shard].submit(_check_batch, self._keys[shard], lats, lons)
+
+    def containing_batch(self, fixes): # fixes: [(device, lat, lon), ...]. Returns the set of names of the areas that contain every fix
+        # (the fixes outside every area share an empty frozenset).
+        count = len(fixes)
+        lats = np.fromiter((fix[1] for fix in fixes), dtype= float, count= count)
+        lons = np.fromiter((fix[2] for fix in fixes), dtype= float, count= count)
+        shards = max(self.workers, 1)
+        jobs = [] # (future, numbers of its fixes in the list)
+        if self.shard == "areas":
+            for start in range(0, count, self.batch_size):
+                numbers = np.arange(start, min(start + self.batch_size, count))
+                for shard in range(shards):
+                    jobs.append((self._submit(shard, lats[numbers], lons[numbers]), numbers))
+        else:
+            devices = np.fromiter((hash(fix[0]) % shards for fix in fixes), dtype= np.int64, count= count)
+            for shard in range(shards):
+                mine = np.flatnonzero(devices == shard)
+                for start in range(0, len(mine), self.batch_size):
+                    numbers = mine[start:start + self.batch_size]
+                    jobs.append((self._submit(shard, lats[numbers], lons[numbers]), numbers))
+        result = [_OUTSIDE] * count # Most fixes aren't inside any area, they share the same empty set
+        names = self.names
+        for future, numbers in jobs:
+            fix_numbers, area_numbers = future.result()
+            for fix, area in zip(numbers[fix_numbers].tolist(), area_numbers.tolist()):
+                containing = result[fix]
+                if containing is _OUTSIDE:
+                    containing = result[fix] = set()
+                containing.add(names[area])
+        return result
+
+    def evaluate(self, fixes, tracker): # fixes: [(device, lat, lon, timestamp), ...], in order. Returns the TransitionEvents of a TransitionTracker.
+        events = []
+        for (device, lat, lon, timestamp), containing in zip(fixes, self.containing_batch(fixes)):
+            events.extend(tracker.update(device, containing, lat, lon, timestamp))
+        return events
+
+
+class _Done: # A result already computed, with the interface of a future (when there are no workers)
+    __slots__ = ("value",)
+
+    def __init__(self, value):
+        self.value = value
+
+    def result(self):
+        return self.value
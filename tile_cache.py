@@ -0,0 +1,210 @@
+"""This module keeps a local cache of map tiles in a SQLite database, with the same tables tkintermapview reads (so the map loads the tiles
+from the disk, and works without Internet). The tiles that cover the stored areas are downloaded in advance, or imported from an MBTiles
+file. The public OpenStreetMap servers forbid bulk downloads, so the prefetch needs another tile server (MAP_TILE_SERVER), e.g. a paid
+provider or a server of your own. It can be executed directly: python tile_cache.py prefetch [min zoom] [max zoom] [--max-tiles N] |
+import <file.mbtiles>"""
+
+import math
+import sqlite3
+import sys
+import urllib.request
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from tkintermapview.utility_functions import decimal_to_osm
+from config_manager import load_config
+from debug_logger_2 import log
+
+configuration= load_config()
+
+DOWNLOAD_THREADS = 2 # Tile servers don't like many connections at once
+USER_AGENT = "GeofencingApplication-TilePrefetch/1.0" # So the server knows who downloads, instead of the one the map sends
+FORBIDDEN_SERVERS = ("tile.openstreetmap.org",) # Their usage policy forbids downloading tiles in advance
+INSERT_BATCH = 500 # Tiles written in every transaction
+
+
+def open_tile_cache(path= None, tile_server= None): # Opens (and creates if needed) the tile database, with the tables tkintermapview uses.
+    path = path if path is not None else configuration["MAP_TILE_DB"]
+    tile_server = tile_server if tile_server is not None else configuration["MAP_TILE_SERVER"]
+    connection = sqlite3.connect(path)
+    connection.executescript("""
+        CREATE TABLE IF NOT EXISTS server (url VARCHAR(300) PRIMARY KEY NOT NULL, max_zoom INTEGER NOT NULL);
+        CREATE TABLE IF NOT EXISTS tiles (
+            zoom INTEGER NOT NULL, x INTEGER NOT NULL, y INTEGER NOT NULL, server VARCHAR(300) NOT NULL, tile_image BLOB NOT NULL,
+            CONSTRAINT fk_server FOREIGN KEY (server) REFERENCES server (url),
+            CONSTRAINT pk_tiles PRIMARY KEY (zoom, x, y, server)
+        );
+        CREATE TABLE IF NOT EXISTS sections (
+            position_a VARCHAR(100) NOT NULL, position_b VARCHAR(100) NOT NULL, zoom_a INTEGER NOT NULL, zoom_b INTEGER NOT NULL,
+            server VARCHAR(300) NOT NULL,
+            CONSTRAINT fk_server FOREIGN KEY (server) REFERENCES server (url),
+            CONSTRAINT pk_tiles PRIMARY KEY (position_a, position_b, zoom_a, zoom_b, server)
+        );
+    """)
+    with connection:
+        connection.execute("INSERT OR IGNORE INTO server (url, max_zoom) VALUES (?, ?)", (tile_server, configuration.get_int("MAP_MAX_ZOOM")))
+    return connection
+
+
+def area_boxes(areas): # (min_lat, max_lat, min_lon, max_lon) of every area. The SQLite areas give it without reading their points.
+    for name in areas:
+        if hasattr(areas, "bounding_box"):
+            yield areas.bounding_box(name)
+        else:
+            points = areas[name]
+            lats = [point[0] for point in points]
+            lons = [point[1] for point in points]
+            yield (min(lats), max(lats), min(lons), max(lons))
+
+
+def _tile_range(box, zoom): # (x0, x1, y0, y1) of the tiles that cover the box at this zoom, both ends included
+    min_lat, max_lat, min_lon, max_lon = box
+    x0, y0 = decimal_to_osm(max_lat, min_lon, zoom) # Upper left corner (the y of the tiles grows to the south)
+    x1, y1 = decimal_to_osm(min_lat, max_lon, zoom)
+    last = 2 ** zoom - 1
+    return max(0, math.floor(x0)), min(last, math.floor(x1)), max(0, math.floor(y0)), min(last, math.floor(y1))
+
+
+def tiles_for_box(box, zoom): # (zoom, x, y) of every tile that covers the box at this zoom
+    x0, x1, y0, y1 = _tile_range(box, zoom)
+    for x in range(x0, x1 + 1):
+        for y in range(y0, y1 + 1):
+            yield zoom, x, y
+
+
+def tiles_for_areas(areas, zoom_min, zoom_max, max_tiles= None): # Every tile that covers some area, without repeating the tiles shared by near areas.
+    # With max_tiles, a ValueError is raised as soon as there would be more, before building the tiles of the box that passes it.
+    tiles = set()
+    for box in area_boxes(areas):
+        for zoom in range(zoom_min, zoom_max + 1):
+            if max_tiles is not None:
+                x0, x1, y0, y1 = _tile_range(box, zoom)
+                if len(tiles) + max(x1 - x0 + 1, 0) * max(y1 - y0 + 1, 0) > max_tiles:
+                    raise ValueError(f"The areas need more than {max_tiles} map tiles between zoom {zoom_min} and {zoom_max}")
+            tiles.update(tiles_for_box(box, zoom))
+    return tiles
+
+
+def _covers(ranges, tile): # If some (x0, x1, y0, y1) of the zoom of the tile contains it
+    zoom, x, y = tile
+    return any(x0 <= x <= x1 and y0 <= y <= y1 for x0, x1, y0, y1 in ranges.get(zoom, ()))
+
+
+def check_tile_server(tile_server): # Raises a ValueError if the tiles of this server cannot be downloaded in advance.
+    host = (urllib.parse.urlsplit(tile_server).hostname or "").lower()
+    for forbidden in FORBIDDEN_SERVERS:
+        if host == forbidden or host.endswith("." + forbidden):
+            raise ValueError(f"The tiles of {host} cannot be downloaded in advance (its usage policy forbids it), set another MAP_TILE_SERVER"
+                             " or import an MBTiles file")
+
+
+def _missing_tiles(connection, tiles, tile_server):
+    stored = set(connection.execute("SELECT zoom, x, y FROM tiles WHERE server = ?", (tile_server,)).fetchall())
+    return sorted(tiles - stored)
+
+
+def _download(tile_server, tile):
+    zoom, x, y = tile
+    url = tile_server.replace("{x}", str(x)).replace("{y}", str(y)).replace("{z}", str(zoom))
+    request = urllib.request.Request(url, headers={"User-Agent": USER_AGENT})
+    try:
+        with urllib.request.urlopen(request, timeout= 20) as response:
+            return tile, response.read()
+    except Exception as e:
+        log(f"[WARNING] Cannot download the map tile {zoom}/{x}/{y}: {e}")
+        return tile, None
+
+
+def _insert(connection, tile_server, rows):
+    with connection:
+        connection.executemany("INSERT OR REPLACE INTO tiles (zoom, x, y, server, tile_image) VALUES (?, ?, ?, ?, ?)",
+                               [(zoom, x, y, tile_server, data) for (zoom, x, y), data in rows])
+
+
+def prefetch_areas(areas, zoom_min= None, zoom_max= None, path= None, tile_server= None, max_tiles= None): # Downloads the tiles of every area that
+    # aren't stored yet. Returns (downloaded, failed). The tiles already in the database aren't downloaded again. If the areas need more
+    # than max_tiles (MAP_PREFETCH_MAX_TILES by default) or the server forbids it, a ValueError is raised and nothing is downloaded.
+    zoom_min = zoom_min if zoom_min is not None else configuration.get_int("MAP_PREFETCH_ZOOM_MIN")
+    zoom_max = zoom_max if zoom_max is not None else configuration.get_int("MAP_PREFETCH_ZOOM_MAX")
+    tile_server = tile_server if tile_server is not None else configuration["MAP_TILE_SERVER"]
+    max_tiles = max_tiles if max_tiles is not None else configuration.get_int("MAP_PREFETCH_MAX_TILES")
+    check_tile_server(tile_server)
+    tiles = tiles_for_areas(areas, zoom_min, zoom_max, max_tiles)
+    connection = open_tile_cache(path, tile_server)
+    try:
+        missing = _missing_tiles(connection, tiles, tile_server)
+        log(f"[INFO] Downloading {len(missing)} map tiles (zoom {zoom_min} to {zoom_max})...")
+        downloaded, failed, rows = 0, 0, []
+        with ThreadPoolExecutor(max_workers= DOWNLOAD_THREADS) as pool:
+            for tile, data in pool.map(lambda tile: _download(tile_server, tile), missing):
+                if data is None:
+                    failed += 1
+                    continue
+                rows.append((tile, data))
+                if len(rows) >= INSERT_BATCH:
+                    _insert(connection, tile_server, rows)
+                    downloaded += len(rows)
+                    rows = []
+        if rows:
+            _insert(connection, tile_server, rows)
+            downloaded += len(rows)
+        log(f"[INFO] {downloaded} map tiles have been downloaded, {failed} failed.")
+        return downloaded, failed
+    finally:
+        connection.close()
+
+
+def import_mbtiles(mbtiles_path, areas= None, zoom_min= None, zoom_max= None, path= None, tile_server= None): # Copies the tiles of an MBTiles file.
+    # The tiles are stored as if they came from the configured tile server, so the map finds them. With areas, just the tiles that cover them
+    # (between zoom_min and zoom_max) are copied. Returns the number of copied tiles.
+    tile_server = tile_server if tile_server is not None else configuration["MAP_TILE_SERVER"]
+    wanted = None # zoom -> tile ranges of the boxes of the areas, not every tile (there can be millions)
+    if areas is not None:
+        zoom_min = zoom_min if zoom_min is not None else configuration.get_int("MAP_PREFETCH_ZOOM_MIN")
+        zoom_max = zoom_max if zoom_max is not None else configuration.get_int("MAP_PREFETCH_ZOOM_MAX")
+        wanted = {zoom: [_tile_range(box, zoom) for box in area_boxes(areas)] for zoom in range(zoom_min, zoom_max + 1)}
+    source = sqlite3.connect(f"file:{mbtiles_path}?mode=ro", uri= True)
+    connection = open_tile_cache(path, tile_server)
+    count = 0
+    try:
+        rows = []
+        for zoom, column, row, data in source.execute("SELECT zoom_level, tile_column, tile_row, tile_data FROM tiles"):
+            tile = (zoom, column, 2 ** zoom - 1 - row) # MBTiles counts the rows from the south (TMS)
+            if wanted is not None and not _covers(wanted, tile):
+                continue
+            rows.append((tile, data))
+            if len(rows) >= INSERT_BATCH:
+                _insert(connection, tile_server, rows)
+                count += len(rows)
+                rows = []
+        if rows:
+            _insert(connection, tile_server, rows)
+            count += len(rows)
+    finally:
+        source.close()
+        connection.close()
+    log(f"[INFO] {count} map tiles have been imported from {mbtiles_path}")
+    return count
+
+
+if __name__ == "__main__": # Fills the tile cache with the tiles of the stored areas, without opening the application.
+    from area_repository import open_area_repository
+
+    arguments = sys.argv[1:]
+    max_tiles = None
+    if "--max-tiles" in arguments[:-1]: # More tiles than MAP_PREFETCH_MAX_TILES, it must be asked for explicitly
+        position = arguments.index("--max-tiles")
+        max_tiles = int(arguments[position + 1])
+        del arguments[position:position + 2]
+    if not arguments or arguments[0] not in ("prefetch", "import") or (arguments[0] == "import" and len(arguments) != 2):
+        print("Usage: python tile_cache.py prefetch [min zoom] [max zoom] [--max-tiles N] | import <file.mbtiles>")
+        sys.exit(1)
+    if arguments[0] == "prefetch":
+        zooms = [int(value) for value in arguments[1:3]]
+        try:
+            downloaded, failed = prefetch_areas(open_area_repository().load(), *zooms, max_tiles= max_tiles)
+        except ValueError as e:
+            print(e)
+            sys.exit(1)
+        print(f"{downloaded} tiles downloaded, {failed} failed")
+    else:
+        print(f"{import_mbtiles(arguments[1])} tiles imported")